@@ -0,0 +1,120 @@
+import gzip
+import io
+import os
+import pathlib
+import tarfile
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.archive import ArchiveReader, create_archive
+from udevbackup.rule import Rule
+
+
+def test_archive():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = root / "source"
+        (source / "sub").mkdir(parents=True)
+        big = os.urandom(300 * 1024)
+        (source / "big.bin").write_bytes(big)
+        (source / "sub" / "text.txt").write_text("hello " * 10000)
+        (source / "link").symlink_to("big.bin")
+        stats = create_archive(
+            [str(source)],
+            root / "archive",
+            workers=3,
+            block_size=64 * 1024,
+            volume_size=128 * 1024,
+        )
+        assert stats.errors == []
+        assert stats.files == 2
+        volumes = sorted((root / "archive").glob("volume-*.tar.gz"))
+        assert stats.volumes == len(volumes) > 1
+        assert stats.bytes_in > len(big) > stats.bytes_out - 60000
+        assert stats.report()[0].startswith(f"2 files in {len(volumes)} volumes")
+
+        content = b"".join(x.read_bytes() for x in volumes)
+        with tarfile.open(fileobj=io.BytesIO(gzip.decompress(content))) as tar:
+            member = tar.getmember(str(source / "big.bin").lstrip("/"))
+            assert tar.extractfile(member).read() == big
+            assert tar.getmember(str(source / "link").lstrip("/")).issym()
+
+        reader = ArchiveReader(root / "archive")
+        assert b"".join(reader.read_file(str(source / "big.bin"))) == big
+        text = b"".join(reader.read_file(str(source / "sub" / "text.txt")))
+        assert text == b"hello " * 10000
+
+
+def test_archive_stopped():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        (root / "source").mkdir()
+        (root / "source" / "file").write_text("content")
+        stats = create_archive(
+            [str(root / "source")], root / "archive", should_stop=lambda: True
+        )
+        assert stats.interrupted
+        assert stats.files == 0
+        assert not (root / "archive").exists()
+        assert (root / ".archive.partial").is_dir()
+        # the next archive removes the partial one
+        stats = create_archive([str(root / "source")], root / "other")
+        assert stats.files == 1
+        assert not (root / ".archive.partial").exists()
+        assert (root / "other" / "index.json.gz").is_file()
+
+
+def test_archive_shrinking_file(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = root / "source"
+        source.mkdir()
+        (source / "live.log").write_bytes(b"x" * 10000)
+        (source / "other.txt").write_text("other")
+        gettarinfo = tarfile.TarFile.gettarinfo
+
+        def shrink(tar, name=None, *args, **kwargs):
+            tarinfo = gettarinfo(tar, name, *args, **kwargs)
+            if name.endswith("live.log"):
+                pathlib.Path(name).write_bytes(b"x" * 4000)
+            return tarinfo
+
+        monkeypatch.setattr(tarfile.TarFile, "gettarinfo", shrink)
+        stats = create_archive([str(source)], root / "archive")
+        assert stats.errors == []
+        assert stats.warnings == [
+            f"{source / 'live.log'} shrank while it was archived: "
+            "6000 bytes padded with zeros."
+        ]
+        reader = ArchiveReader(root / "archive")
+        content = b"".join(reader.read_file(str(source / "live.log")))
+        assert content == b"x" * 4000 + bytes(6000)
+        assert b"".join(reader.read_file(str(source / "other.txt"))) == b"other"
+
+
+def test_run_archive(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = pathlib.Path(tmpdir) / "source"
+        source.mkdir()
+        (source / "file.txt").write_text("content")
+        rule = Rule(
+            config,
+            "archive",
+            UUID_RAW_PARTITION,
+            engine="archive",
+            sources=str(source),
+            workers=2,
+        )
+        config.register(rule)
+        assert config.run(UUID_RAW_PARTITION)
+        assert "Archive: 1 files in 1 volumes" in config._log_content
+        archive = (
+            config.devices_root
+            / "storage"
+            / UUID_RAW_PARTITION
+            / "archive"
+            / config.run_date
+        )
+        reader = ArchiveReader(archive)
+        assert b"".join(reader.read_file(str(source / "file.txt"))) == b"content"
@@ -0,0 +1,193 @@
+import os
+import pathlib
+import random
+import tempfile
+
+import pytest
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup import chunkstore
+from udevbackup.checkpoint import Checkpoint
+from udevbackup.chunkstore import BackupStats, ChunkStore, chunk_file, cut_points
+from udevbackup.rule import Rule
+
+
+def test_cut_points():
+    data = random.Random(42).randbytes(64 * 1024)
+    cuts = cut_points(data, 256, 1024, 4096)
+    assert cuts[-1] == len(data)
+    sizes = [y - x for (x, y) in zip([0] + cuts, cuts)]
+    assert all(256 <= x <= 4096 for x in sizes[:-1])
+    # chunks after an insertion are unchanged
+    shifted = cut_points(b"inserted" + data, 256, 1024, 4096)
+    assert set(x - 8 for x in shifted[2:]) <= set(cuts)
+    assert len(set(x - 8 for x in shifted) & set(cuts)) > len(cuts) - 3
+
+
+def test_cut_points_python(monkeypatch):
+    pytest.importorskip("numpy")
+    data = random.Random(7).randbytes(256 * 1024)
+    expected = cut_points(data, 256, 1024, 4096)
+    monkeypatch.setattr(chunkstore, "numpy", None)
+    assert cut_points(data, 256, 1024, 4096) == expected
+
+
+def test_chunkstore_modified_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        path = root / "file.bin"
+        path.write_bytes(random.Random(2).randbytes(8 * 1024))
+        store = ChunkStore(root / "store", avg_size=1024)
+        result = chunk_file((str(path), 512, 1024, 4096))
+        # the file is modified after it has been chunked
+        path.write_bytes(random.Random(3).randbytes(8 * 1024))
+        stats = BackupStats()
+        entries = {str(path): {"path": str(path)}}
+        assert not store.store_file(result, entries, stats)
+        store.close_pack()
+        assert stats.errors == []
+        assert stats.warnings == [
+            f"{path} has been modified during the backup: it is not stored."
+        ]
+        assert store.index == {}
+        assert "chunks" not in entries[str(path)]
+
+
+def test_chunkstore_modified_file_previous(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = root / "source"
+        source.mkdir()
+        path = source / "file.bin"
+        content = random.Random(2).randbytes(8 * 1024)
+        path.write_bytes(content)
+        store = ChunkStore(root / "store", avg_size=1024)
+        assert store.backup([str(source)], "first").errors == []
+
+        def chunk_and_modify(args):
+            result = chunk_file(args)
+            path.write_bytes(random.Random(3).randbytes(8 * 1024))
+            return result
+
+        monkeypatch.setattr(chunkstore, "chunk_file", chunk_and_modify)
+        path.write_bytes(random.Random(4).randbytes(8 * 1024))
+        stats = store.backup([str(source)], "second")
+        assert stats.errors == []
+        assert stats.warnings == [
+            f"{path} has been modified during the backup: its previous version is kept."
+        ]
+        entries = {x["path"]: x for x in store.load_snapshot("second")}
+        assert b"".join(store.read_file(entries[str(path)])) == content
+
+
+def test_chunkstore():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = root / "source"
+        source.mkdir()
+        content = random.Random(1).randbytes(32 * 1024)
+        (source / "a.bin").write_bytes(content)
+        (source / "b.bin").write_bytes(content)
+        (source / "empty").write_bytes(b"")
+        (source / "link").symlink_to("a.bin")
+        store = ChunkStore(root / "store", avg_size=1024)
+        stats = store.backup([str(source)], "first", workers=2)
+        assert stats.errors == []
+        assert stats.files == 3
+        assert stats.bytes_read == 2 * len(content)
+        assert 1.9 < stats.dedup_ratio < 2.1
+
+        (source / "b.bin").write_bytes(b"prefix" + content)
+        stats = store.backup([str(source)], "second")
+        assert stats.unchanged_files == 2
+        assert stats.bytes_read == len(content) + 6
+        assert 0 < stats.new_bytes < 4096
+        assert store.snapshots() == ["first", "second"]
+
+        store = ChunkStore(root / "store", avg_size=1024)
+        store.load_index()
+        entries = {x["path"]: x for x in store.load_snapshot("second")}
+        restored = b"".join(store.read_file(entries[str(source / "b.bin")]))
+        assert restored == b"prefix" + content
+        assert entries[str(source / "link")]["link"] == "a.bin"
+        assert entries[str(source / "empty")]["chunks"] == []
+
+
+def test_chunkstore_stopped():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = root / "source"
+        source.mkdir()
+        for index in range(3):
+            (source / f"{index}.bin").write_bytes(os.urandom(4096))
+        calls = []
+
+        def should_stop() -> bool:
+            calls.append(1)
+            # stopped after the walk and the first stored file
+            return len(calls) > 6
+
+        store = ChunkStore(root / "store", avg_size=1024)
+        stats = store.backup([str(source)], "first", should_stop=should_stop)
+        assert stats.interrupted
+        assert store.snapshots() == []
+        assert not (root / "store" / "index.bin").exists()
+
+
+def test_chunkstore_resume(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = root / "source"
+        source.mkdir()
+        for name in ("a.bin", "b.bin"):
+            (source / name).write_bytes(os.urandom(8192))
+        checkpoint = Checkpoint(root / "state")
+        store = ChunkStore(root / "store", avg_size=1024, checkpoint_interval=0.0)
+
+        store_file = store.store_file
+        calls = []
+
+        def interrupt(result, *args):
+            calls.append(result[0])
+            if len(calls) == 2:
+                raise OSError("disconnected")
+            return store_file(result, *args)
+
+        monkeypatch.setattr(store, "store_file", interrupt)
+        with pytest.raises(OSError):
+            store.backup([str(source)], "first", checkpoint=checkpoint)
+        assert checkpoint.load()["done_bytes"] == 8192
+        assert checkpoint.describe().endswith(", 0.0 MB already done")
+
+        store = ChunkStore(root / "store", avg_size=1024)
+        stats = store.backup([str(source)], "first", checkpoint=checkpoint)
+        assert stats.resumed_files == 1
+        assert stats.new_bytes == 8192
+        assert stats.report()[0] == (
+            "1 files (0.0 MB) already stored by the interrupted run."
+        )
+        assert store.snapshots() == ["first"]
+
+
+def test_run_chunkstore(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = pathlib.Path(tmpdir) / "source"
+        source.mkdir()
+        (source / "file.txt").write_bytes(os.urandom(10000))
+        rule = Rule(
+            config,
+            "store",
+            UUID_RAW_PARTITION,
+            engine="chunkstore",
+            sources=str(source),
+            workers=1,
+            chunk_size=1,
+        )
+        config.register(rule)
+        assert config.run(UUID_RAW_PARTITION)
+        assert "Chunkstore: 1 files (0.0 MB), 0 unchanged." in config._log_content
+        store = ChunkStore(
+            config.devices_root / "storage" / UUID_RAW_PARTITION / "chunkstore"
+        )
+        assert store.snapshots() == [config.run_date]
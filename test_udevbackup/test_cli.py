@@ -1,3 +1,4 @@
+import pathlib
 import tempfile
 from importlib.resources import as_file, files
 
@@ -10,7 +11,7 @@ from test_udevbackup.utils import (
     UUID_RAW_PARTITION,
     prepare_config,
 )
-from udevbackup.cli import load_config, main
+from udevbackup.cli import check_config, load_config, main
 
 
 def test_load_config(monkeypatch):
@@ -83,6 +84,15 @@ def test_main_at_complete_env(monkeypatch):
         )
 
 
+def test_main_at_does_not_read_config(monkeypatch):
+    with monkeypatch.context() as m, tempfile.TemporaryDirectory() as tmpdir:
+        m.setenv("ID_FS_UUID", UUID_RAW_PARTITION)
+        config = prepare_config(tmpdir, m)
+        config_dir = str(pathlib.Path(tmpdir) / "missing")
+        assert main(["-C", config_dir, "at"]) == 0
+        assert config.popen_commands_full == [["at", "now"]]
+
+
 def test_main_at_complete(monkeypatch):
     with as_file(
         files("test_udevbackup") / "data/complete"
@@ -152,3 +162,61 @@ def test_main_run_example(monkeypatch):
         config = prepare_config(tmpdir, m)
         assert main(["-C", str(config_dir), "example"]) == 0
         assert config.popen_commands_full == []
+
+
+def test_load_config_drop_ins():
+    with as_file(files("test_udevbackup") / "data/dropins") as config_dir:
+        config = load_config(config_dir)
+        assert set(config.rules) == {UUID_RAW_PARTITION, UUID_LUKS_2_PARTITION}
+        assert config.use_stdout is True
+        config = load_config(config_dir, fs_uuid=UUID_RAW_PARTITION)
+        assert list(config.rules) == [UUID_RAW_PARTITION]
+        # a partition of the same disk processed by udev after the configuration
+        rule = config.rules[UUID_RAW_PARTITION]
+        config.load_drop_ins({UUID_RAW_PARTITION, UUID_LUKS_2_PARTITION})
+        assert list(config.rules) == [UUID_RAW_PARTITION, UUID_LUKS_2_PARTITION]
+        assert config.rules[UUID_RAW_PARTITION] is rule
+        assert config.use_stdout is True
+        assert check_config(config_dir) == []
+
+
+def test_main_check(monkeypatch):
+    with monkeypatch.context() as m, tempfile.TemporaryDirectory() as tmpdir:
+        prepare_config(tmpdir, m)
+        config_dir = pathlib.Path(tmpdir) / "config"
+        (config_dir / "devices.d").mkdir(parents=True)
+        (config_dir / "config.ini").write_text(
+            f"[main]\n[primary]\nfs_uuid = {UUID_RAW_PARTITION}\nscript = ls\n"
+        )
+        (config_dir / "devices.d" / f"{UUID_LUKS_3_PARTITION}.ini").write_text(
+            f"[primary]\nfs_uuid = {UUID_RAW_PARTITION}\nscript = ls\n"
+            f"[other]\nfs_uuid = {UUID_LUKSED_PARTITION}\nscript = ls\n"
+        )
+        errors = check_config(config_dir)
+        assert len(errors) == 4
+        assert errors[0].startswith("[primary] is defined in ")
+        assert errors[1] == (
+            f"[primary] and [primary] are both defined for {UUID_RAW_PARTITION}."
+        )
+        assert errors[3].endswith("it is ignored when the device is connected.")
+        assert main(["-C", str(config_dir), "check"]) == 7
+        (config_dir / "devices.d" / f"{UUID_LUKS_3_PARTITION}.ini").unlink()
+        assert main(["-C", str(config_dir), "check"]) == 0
+
+
+def test_check_fanout(monkeypatch):
+    with monkeypatch.context() as m, tempfile.TemporaryDirectory() as tmpdir:
+        prepare_config(tmpdir, m)
+        config_dir = pathlib.Path(tmpdir) / "config"
+        config_dir.mkdir()
+        (config_dir / "config.ini").write_text(
+            f"[main]\n[first]\nfs_uuid = {UUID_RAW_PARTITION}\nengine = mirror\n"
+            "sources = /data\nfanout = offsite\n"
+            f"[second]\nfs_uuid = {UUID_LUKSED_PARTITION}\nengine = mirror\n"
+            "sources = /other\nfanout = offsite\n"
+        )
+        assert check_config(config_dir) == [
+            "The rules of the fan-out group offsite (first, second) must all use the "
+            "mirror engine with the same sources: the sources are read once for all "
+            "disks."
+        ]
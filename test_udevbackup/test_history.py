@@ -0,0 +1,74 @@
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.history import RunHistory, format_duration, scan_size
+
+
+def test_format_duration():
+    assert format_duration(3725.2) == "1:02:05"
+
+
+def test_scan_size():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        (root / "a" / "b").mkdir(parents=True)
+        (root / "a" / "b" / "file").write_bytes(b"x" * 100)
+        (root / "a" / "file").write_bytes(b"x" * 10)
+        (root / "a" / "link").symlink_to(root / "a" / "b" / "file")
+        (root / "other").write_bytes(b"x")
+        assert scan_size([str(root / "a"), str(root / "other")]) == 111
+        assert scan_size([str(root / "missing")]) == 0
+
+
+def test_history():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        history = RunHistory(tmpdir, UUID_RAW_PARTITION)
+        assert history.load() == []
+        assert history.estimate("written") is None
+        history.append({"success": True, "written": 10})
+        history.append({"success": False, "written": 1000})
+        history.append({"success": True, "written": 20})
+        assert history.estimate("written") == 20
+        assert len(history.load()) == 3
+
+
+def test_run_preflight(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        rule = config.rules[UUID_RAW_PARTITION]
+        rule.preflight = "history"
+        assert config.run(UUID_RAW_PARTITION)
+        assert "No previous run" in config._log_content
+        entries = rule.get_history().load()
+        assert len(entries) == 1
+        assert entries[0]["success"] is True
+        assert entries[0]["written"] >= 0
+
+        rule.get_history().append({"success": True, "written": 10**18})
+        config.popen_commands_short.clear()
+        assert not config.run(UUID_RAW_PARTITION)
+        assert config.popen_commands_short == ["mount", "umount"]
+        assert "Not enough free space on" in rule.errors[0]
+
+
+def test_run_preflight_scan_incremental(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        rule = config.rules[UUID_RAW_PARTITION]
+        source = pathlib.Path(tmpdir) / "source"
+        source.mkdir()
+        (source / "file").write_bytes(b"x" * 1000)
+        rule.sources = [str(source)]
+        rule.engine = "mirror"
+        rule.preflight = "scan"
+        rule.preflight_margin = 10**15
+        # first run: all the sources are copied
+        assert not config.run(UUID_RAW_PARTITION)
+        assert "Not enough free space on" in rule.errors[0]
+        # the previous runs only wrote the changes
+        rule.errors.clear()
+        rule.get_history().append({"success": True, "written": 0})
+        assert config.run(UUID_RAW_PARTITION)
+        rule.engine = "archive"
+        assert not config.run(UUID_RAW_PARTITION)
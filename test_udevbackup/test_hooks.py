@@ -0,0 +1,106 @@
+import os
+import pathlib
+import sys
+import tempfile
+
+import pytest
+
+from test_udevbackup.utils import (
+    UUID_LUKSED_PARTITION,
+    UUID_RAW_PARTITION,
+    prepare_config,
+)
+from udevbackup.hooks import Reporter, call, load_callable, run_in_worker
+from udevbackup.rule import Rule
+
+
+def write_job(mount_dir: str, reporter: Reporter):
+    pathlib.Path(mount_dir, "job.txt").write_text(str(os.getpid()))
+    reporter.info("job done")
+
+
+def printing_job(mount_dir: str, reporter: Reporter):
+    print("to stdout")
+    print("to stderr", file=sys.stderr)
+    reporter.error("partial backup")
+    return True
+
+
+def failing_job(mount_dir: str, reporter: Reporter):
+    reporter.warning("about to fail")
+    raise RuntimeError("no space left")
+
+
+def test_load_callable():
+    assert load_callable("os.path:join") is os.path.join
+    with pytest.raises(ValueError):
+        load_callable("os.path.join")
+    messages = []
+    reporter = Reporter(lambda level, text: messages.append((level, text)))
+    assert not call("test_udevbackup.test_hooks:failing_job", "/", reporter)
+    assert messages[:2] == [
+        ("warning", "about to fail"),
+        ("error", "test_udevbackup.test_hooks:failing_job failed (no space left)."),
+    ]
+
+
+def test_run_in_worker():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        messages = []
+        pids = []
+        assert run_in_worker(
+            "test_udevbackup.test_hooks:write_job",
+            tmpdir,
+            None,
+            lambda level, text: messages.append((level, text)),
+            started=pids.append,
+        )
+        assert messages == [("info", "job done")]
+        assert pathlib.Path(tmpdir, "job.txt").read_text() == str(pids[0])
+        assert pids[0] != os.getpid()
+        assert not run_in_worker(
+            "test_udevbackup.test_hooks:failing_job", tmpdir, None, lambda *x: None
+        )
+
+
+def test_run_callable(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        with pytest.raises(ValueError):
+            Rule(config, "invalid", UUID_RAW_PARTITION, callable="invalid")
+        assert Rule.get_required({"callable": "a:b"}) == {"fs_uuid"}
+        rule = Rule(
+            config,
+            "python",
+            UUID_RAW_PARTITION,
+            callable="test_udevbackup.test_hooks:write_job",
+        )
+        config.register(rule)
+        assert config.run(UUID_RAW_PARTITION)
+        assert config.popen_commands_short == ["mount", "umount"]
+        assert "job done" in config._log_content
+        job = config.devices_root / "storage" / UUID_RAW_PARTITION / "job.txt"
+        assert job.read_text() == str(os.getpid())
+
+
+@pytest.mark.parametrize("in_worker", [False, True])
+def test_run_callable_reported_error(monkeypatch, in_worker):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        rule = Rule(
+            config,
+            "python",
+            UUID_RAW_PARTITION,
+            callable="test_udevbackup.test_hooks:printing_job",
+            stdout=f"{tmpdir}/python.out.txt",
+            stderr=f"{tmpdir}/python.err.txt",
+            # the limits are applied to a worker process
+            nice=0 if in_worker else None,
+        )
+        config.register(rule)
+        assert not config.run(UUID_RAW_PARTITION)
+        assert rule.errors == ["partial backup"]
+        # a failed job is not recorded as successful
+        assert not rule.get_history().load()[-1]["success"]
+        assert pathlib.Path(tmpdir, "python.out.txt").read_text() == "to stdout\n"
+        assert pathlib.Path(tmpdir, "python.err.txt").read_text() == "to stderr\n"
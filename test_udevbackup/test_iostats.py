@@ -0,0 +1,67 @@
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.devices import DeviceStat, read_device_stat, resolve_device
+from udevbackup.iostats import IOSample, IOSampler
+
+STAT_1 = "100 0 2000 50 10 0 4000 30 0 80 90 0 0 0 0 0 0"
+STAT_2 = "300 0 2000 80 1010 0 1957125 530 2 1080 2090 0 0 0 0 0 0"
+
+
+def test_read_device_stat():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        assert read_device_stat(root / "sys", root / "proc", "sda1") is None
+        (root / "proc").mkdir()
+        (root / "proc" / "diskstats").write_text(
+            f"   8       0 sda {STAT_2}\n   8       1 sda1 {STAT_1}\n"
+        )
+        expected = DeviceStat(100, 2000, 10, 4000, 0, 80, 90)
+        assert read_device_stat(root / "sys", root / "proc", "sda1") == expected
+        (root / "sys" / "class" / "block" / "sda1").mkdir(parents=True)
+        (root / "sys" / "class" / "block" / "sda1" / "stat").write_text(STAT_2)
+        expected = DeviceStat(300, 2000, 1010, 1957125, 2, 1080, 2090)
+        assert read_device_stat(root / "sys", root / "proc", "sda1") == expected
+
+
+def test_sampler():
+    sampler = IOSampler(lambda: None)
+    sampler.add(10.0, DeviceStat.parse(STAT_1.split()))
+    assert sampler.total() is None
+    sampler.add(12.0, DeviceStat.parse(STAT_2.split()))
+    assert sampler.samples == [
+        IOSample(
+            elapsed=2.0,
+            read_mbps=0.0,
+            write_mbps=500.0,
+            iops=600.0,
+            queue_depth=1.0,
+            utilisation=0.5,
+        )
+    ]
+    assert sampler.total() == sampler.samples[0]
+    assert sampler.summary() == [
+        "read: 0.0 MB/s (peak: 0.0 MB/s)",
+        "write: 500.0 MB/s (peak: 500.0 MB/s)",
+        "IOPS: 600, average queue depth: 1.00, utilisation: 50%",
+    ]
+
+
+def test_run_iostat(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        assert resolve_device(config.devices_root, UUID_RAW_PARTITION) == "sda1"
+        stat_path = config.sysfs_root / "class" / "block" / "sda1" / "stat"
+        stat_path.parent.mkdir(parents=True)
+        stat_path.write_text(STAT_1)
+        rule = config.rules[UUID_RAW_PARTITION]
+        rule.iostat_interval = 60.0
+        assert config.run(UUID_RAW_PARTITION)
+        assert "I/O statistics: write: " in config._log_content
+        assert rule.iostat_path in rule.get_attachments()
+        lines = pathlib.Path(rule.iostat_path).read_text().splitlines()
+        assert lines == [
+            IOSampler.csv_header.strip(),
+            "0.0,0.000,0.000,0.0,0.000,0.000",
+        ]
@@ -0,0 +1,56 @@
+import json
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.cli import show_queue
+from udevbackup.jobqueue import JobQueue
+
+
+def test_job_queue():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        queue = JobQueue(pathlib.Path(tmpdir) / "queue")
+        assert queue.jobs() == []
+        first = queue.add("first", "uuid-1")
+        second = queue.add("second", "uuid-2")
+        urgent = queue.add("urgent", "uuid-3", priority=10)
+        dead = queue.add("dead", "uuid-4", priority=20)
+        path = queue.directory / f"{dead}.json"
+        path.write_text(json.dumps({**json.loads(path.read_text()), "pid": 2**22 + 1}))
+        assert [x["id"] for x in queue.jobs()] == [urgent, first, second]
+        assert not path.exists()
+
+        assert queue.wait(urgent)
+        assert queue.jobs()[0]["state"] == "running"
+        assert not queue.cancel(urgent)
+        sleeps = []
+
+        def finish_urgent(delay):
+            sleeps.append(delay)
+            queue.remove(urgent)
+
+        assert queue.set_priority(second, 1)
+        assert queue.wait(second, sleep=finish_urgent)
+        assert sleeps == [1.0]
+        assert queue.cancel(first)
+        assert not queue.wait(first)
+        assert not queue.set_priority(first, 2)
+
+
+def test_run_queue(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        queue = config.job_queue
+        job_id = queue.add("other", "uuid-1")
+        assert queue.wait(job_id)
+        show_queue(config)
+        assert f"{job_id} [priority 0] other (uuid-1): running for 0:00:0" in (
+            config.stdout.getvalue()
+        )
+
+        monkeypatch.setattr(queue, "wait", lambda job_id: not queue.cancel(job_id))
+        monkeypatch.setattr(type(config), "job_queue", queue)
+        assert not config.run(UUID_RAW_PARTITION)
+        assert "has been cancelled." in config._log_content
+        assert config.popen_commands_short == []
+        assert [x["id"] for x in queue.jobs()] == [job_id]
@@ -0,0 +1,78 @@
+import os
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.journal import ChangeJournal, Watcher
+from udevbackup.rule import Rule
+
+
+def test_watcher():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = pathlib.Path(tmpdir) / "source"
+        (source / "old").mkdir(parents=True)
+        watcher = Watcher(pathlib.Path(tmpdir) / "state", [str(source)])
+        watcher.start()
+        journal = watcher.journals[0]
+        position = journal.position()
+        (source / "old" / "file.txt").write_text("content")
+        (source / "new").mkdir()
+        for __ in range(3):
+            watcher.process(0.1)
+        (source / "new" / "other.txt").write_text("content")
+        watcher.process(0.1)
+        watcher.flush()
+        changes, reason = journal.changes_since(position)
+        assert reason == ""
+        assert set(changes) >= {
+            os.fsencode(source / "old" / "file.txt"),
+            os.fsencode(source / "new"),
+            os.fsencode(source / "new" / "other.txt"),
+        }
+        journal.add_gap("lost events")
+        assert journal.changes_since(position) == (None, "lost events")
+        journal.start_epoch()
+        assert journal.changes_since(position)[0] is None
+
+
+def test_run_journal(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = pathlib.Path(tmpdir) / "source"
+        source.mkdir()
+        rule = Rule(
+            config,
+            "journal",
+            UUID_RAW_PARTITION,
+            "rsync",
+            sources=str(source),
+            journal=True,
+        )
+        config.register(rule)
+        files_from = []
+        execute_script = rule.execute_script
+
+        def read_files_from(name, cwd=None, env=None):
+            if name == "script":
+                path = env.get("UDEVBACKUP_FILES_FROM")
+                files_from.append(path and pathlib.Path(path).read_bytes())
+                assert not path or os.stat(path).st_mode & 0o777 == 0o600
+            return execute_script(name, cwd=cwd, env=env)
+
+        monkeypatch.setattr(rule, "execute_script", read_files_from)
+        assert config.run(UUID_RAW_PARTITION)
+        assert "Full scan: the watcher is not running." in config._log_content
+
+        journal = ChangeJournal(config.state_dir, str(source))
+        journal.start_epoch()
+        (journal.directory / "watcher.pid").write_text(str(os.getpid()))
+        assert config.run(UUID_RAW_PARTITION)
+        assert "Full scan: no previous run with the watcher." in config._log_content
+        (source / "a").write_text("a")
+        path_a, path_b = bytes(source / "a"), bytes(source / "b")
+        journal.append([path_a, path_b, path_a])
+        assert config.run(UUID_RAW_PARTITION)
+        assert "2 paths changed since the last run (1 deleted)." in config._log_content
+        # the deleted path is not given to the script
+        assert files_from == [None, None, path_a + b"\0"]
+        assert list(config.temp_directory.glob("*files-from*")) == []
@@ -0,0 +1,82 @@
+import datetime
+import json
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup import logs
+from udevbackup.cli import main
+from udevbackup.logs import parse_time, read_lines_backwards, read_records, rotate_log
+from udevbackup.rule import Config
+
+
+def test_read_lines_backwards(monkeypatch):
+    monkeypatch.setattr(logs, "READ_BLOCK_SIZE", 7)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir) / "log"
+        path.write_bytes(b"first line\n\nsecond\nthe third line\n")
+        assert list(read_lines_backwards(path)) == [
+            b"the third line",
+            b"second",
+            b"first line",
+        ]
+
+
+def test_rotate_log():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir) / "log"
+        for index in range(4):
+            path.write_text(f"{index}" * 10)
+            rotate_log(path, 10, 2)
+        assert not path.exists()
+        assert path.with_name("log.1").read_text() == "3" * 10
+        assert path.with_name("log.2").read_text() == "2" * 10
+        assert not path.with_name("log.3").exists()
+
+
+def test_log_max_size():
+    # plain text logs are not rotated unless configured
+    assert Config().log_max_size == 0
+    assert Config(log_format="json").log_max_size == 10
+    assert Config(log_max_size=2).log_max_size == 2
+
+
+def test_parse_time():
+    now = datetime.datetime(2024, 1, 31, 12, 0).astimezone()
+    assert parse_time("90m", now=now) == now - datetime.timedelta(hours=1.5)
+    expected = datetime.datetime(2024, 1, 31, 11, 0).astimezone()
+    assert parse_time("2024-01-31T11:00") == expected
+
+
+def test_main_logs(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.log_format = "json"
+        config.log_file = str(pathlib.Path(tmpdir) / "udevbackup.log")
+        config.popen_result["bash"] = 1
+        assert not config.run(UUID_RAW_PARTITION)
+        records = read_records(config.log_file, 5)
+        assert {x["run_id"] for x in records} == {config.run_id}
+        resources = [
+            x for x in records if x["message"].startswith("Resources of script")
+        ]
+        assert resources[0]["rule"] == "primary"
+        assert resources[0]["phase"] == "script"
+        assert resources[0]["duration"] >= 0
+        assert [x["message"] for x in read_records(config.log_file, 5, limit=2)] == [
+            "Unable to execute command script.",
+            f"Device {UUID_RAW_PARTITION} can be disconnected.",
+        ]
+        assert read_records(config.log_file, 5, since=parse_time("1h")) == records
+        assert read_records(config.log_file, 5, until=parse_time("1h")) == []
+
+        config_dir = pathlib.Path(tmpdir) / "config"
+        config_dir.mkdir()
+        (config_dir / "config.ini").write_text(
+            f"[main]\nlog_file = {config.log_file}\nlog_format = json\n"
+        )
+        args = ["-C", str(config_dir), "logs", "--level", "warning", "--json"]
+        assert main(args) == 0
+        output = config.stdout.getvalue().splitlines()
+        assert [json.loads(x)["level"] for x in output[-2:]] == ["ERROR", "ERROR"]
+        assert main(["-C", str(config_dir), "logs", "--since", "yesterday"]) == 10
@@ -0,0 +1,179 @@
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+import pytest
+
+from test_udevbackup.utils import (
+    UUID_LUKS_3_PARTITION,
+    UUID_RAW_PARTITION,
+    prepare_config,
+)
+from udevbackup.mirror import Mirror, MirrorTarget
+from udevbackup.rule import Rule
+
+
+def prepare_sources(root: pathlib.Path) -> pathlib.Path:
+    source = root / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "file.txt").write_text("content")
+    (source / "big.bin").write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    (source / "link").symlink_to("sub/file.txt")
+    return source
+
+
+def test_mirror():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = prepare_sources(root)
+        (root / "a").mkdir()
+        (root / "b").write_text("not a directory")
+        targets = [MirrorTarget("a", root / "a"), MirrorTarget("b", root / "b")]
+        mirror = Mirror([str(source)], targets)
+        mirror.run()
+        assert mirror.errors == []
+        assert mirror.bytes_read == 3 * 1024 * 1024 + 17 + 7
+        assert targets[0].error is None
+        assert targets[0].files == 2
+        assert targets[1].error is not None
+        copy = root / "a" / "source"
+        assert (copy / "sub" / "file.txt").read_text() == "content"
+        assert (copy / "big.bin").read_bytes() == (source / "big.bin").read_bytes()
+        assert os.readlink(copy / "link") == "sub/file.txt"
+        assert int((copy / "big.bin").stat().st_mtime) == int(
+            (source / "big.bin").stat().st_mtime
+        )
+
+        mirror = Mirror([str(source)], [MirrorTarget("a", root / "a")])
+        mirror.run()
+        assert mirror.bytes_read == 0
+        assert mirror.skipped_files == 2
+        assert mirror.report()[1] == "a: 0 files, 0.0 MB written (0.0 MB/s), OK."
+
+
+def test_mirror_stopped():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        source = prepare_sources(root)
+        (root / "a").mkdir()
+        (root / "b").mkdir()
+        targets = [
+            MirrorTarget("a", root / "a"),
+            MirrorTarget("b", root / "b", should_stop=lambda: True),
+        ]
+        mirror = Mirror([str(source)], targets)
+        mirror.run()
+        assert targets[0].files == 2
+        assert targets[1].error == "interrupted"
+        assert list((root / "b").iterdir()) == []
+
+        # no target left: the sources are not read anymore
+        (root / "c").mkdir()
+        mirror = Mirror([str(source)], [MirrorTarget("c", root / "c", lambda: True)])
+        mirror.run()
+        assert mirror.bytes_read == 0
+
+
+def test_rule_engine(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        with pytest.raises(ValueError):
+            Rule(config, "invalid", UUID_RAW_PARTITION, engine="invalid")
+        with pytest.raises(ValueError):
+            Rule(config, "invalid", UUID_RAW_PARTITION, engine="mirror")
+        assert Rule.get_required({"engine": "mirror"}) == {"fs_uuid"}
+        assert Rule.get_required({}) == {"fs_uuid", "script"}
+
+
+def test_run_fanout(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = prepare_sources(pathlib.Path(tmpdir))
+        config.rules.clear()
+        for name, fs_uuid in (
+            ("first", UUID_RAW_PARTITION),
+            ("second", UUID_LUKS_3_PARTITION),
+        ):
+            rule = Rule(
+                config,
+                name,
+                fs_uuid,
+                engine="mirror",
+                sources=str(source),
+                fanout="offsite",
+                fanout_window=60.0,
+            )
+            config.register(rule)
+        assert config.run(UUID_RAW_PARTITION)
+        assert config.popen_commands_short == ["mount", "mount", "umount", "umount"]
+        assert "Mirror: first: 2 files" in config._log_content
+        assert "Mirror: second: 2 files" in config._log_content
+        for fs_uuid in (UUID_RAW_PARTITION, UUID_LUKS_3_PARTITION):
+            copy = config.devices_root / "storage" / fs_uuid / "source"
+            assert (copy / "sub" / "file.txt").read_text() == "content"
+            assert f"Device {fs_uuid} can be disconnected." in config._log_content
+
+        config.popen_commands_short.clear()
+        assert config.run(UUID_LUKS_3_PARTITION)
+        assert "first has been backed up less than" in config._log_content
+        assert config.popen_commands_short == ["mount", "umount"]
+
+
+def prepare_fanout(config, sources: dict[str, str]):
+    config.rules.clear()
+    for name, fs_uuid in (
+        ("first", UUID_RAW_PARTITION),
+        ("second", UUID_LUKS_3_PARTITION),
+    ):
+        rule = Rule(
+            config,
+            name,
+            fs_uuid,
+            engine="mirror",
+            sources=sources[name],
+            fanout="offsite",
+            fanout_window=60.0,
+        )
+        config.register(rule)
+
+
+def test_run_fanout_own_sources(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = prepare_sources(pathlib.Path(tmpdir))
+        other = pathlib.Path(tmpdir) / "other"
+        other.mkdir()
+        (other / "file.txt").write_text("other")
+        prepare_fanout(config, {"first": str(source), "second": str(other)})
+        assert config.run(UUID_RAW_PARTITION)
+        # each disk receives its own sources
+        storage = config.devices_root / "storage"
+        assert (storage / UUID_RAW_PARTITION / "source" / "big.bin").is_file()
+        assert not (storage / UUID_RAW_PARTITION / "other").exists()
+        assert (storage / UUID_LUKS_3_PARTITION / "other" / "file.txt").is_file()
+        assert not (storage / UUID_LUKS_3_PARTITION / "source").exists()
+        for rule in config.rules.values():
+            assert rule.get_history().load()[-1]["success"]
+
+
+def test_run_fanout_late_disk(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = prepare_sources(pathlib.Path(tmpdir))
+        prepare_fanout(config, {"first": str(source), "second": str(source)})
+        # a session of another process, that has only backed up the first disk,
+        # ends while this process is waiting for its lock
+        record = config.temp_directory / "udevbackup-fan-out-offsite.json"
+        record.write_text(
+            json.dumps({"uuids": [UUID_RAW_PARTITION], "ended_at": time.time() + 60})
+        )
+        assert config.run(UUID_RAW_PARTITION)
+        assert config.popen_commands_short == []
+        assert "first has been backed up by the fan-out offsite" in config._log_content
+        # the late disk is backed up alone
+        assert config.run(UUID_LUKS_3_PARTITION)
+        assert config.popen_commands_short == ["mount", "umount"]
+        copy = config.devices_root / "storage" / UUID_LUKS_3_PARTITION / "source"
+        assert (copy / "sub" / "file.txt").read_text() == "content"
@@ -0,0 +1,129 @@
+import errno
+import gzip
+import os
+import pathlib
+import tempfile
+import threading
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup import outputs
+from udevbackup.outputs import OutputFile, numbered_path, rotate_outputs
+
+
+def test_numbered_path():
+    assert numbered_path("/tmp/a.txt", 2) == "/tmp/a.txt.2"
+    assert numbered_path("/tmp/a.txt.gz", 2) == "/tmp/a.txt.2.gz"
+
+
+def test_rotate_outputs_numbered():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = f"{tmpdir}/a.txt"
+        for content in ("1", "2", "3", "4"):
+            rotate_outputs(path, path, 3)
+            pathlib.Path(path).write_text(content)
+        assert pathlib.Path(path).read_text() == "4"
+        assert pathlib.Path(f"{path}.1").read_text() == "3"
+        assert pathlib.Path(f"{path}.2").read_text() == "2"
+        assert not os.path.exists(f"{path}.3")
+        rotate_outputs(path, path, 3, max_size=1)
+        assert not os.path.exists(path)
+        assert pathlib.Path(f"{path}.1").read_text() == "4"
+        assert not os.path.exists(f"{path}.2")
+
+
+def test_rotate_outputs_dated():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for index, date in enumerate(("20260101-000000", "20260102-000000")):
+            filename = f"{tmpdir}/a-{date}.txt"
+            pathlib.Path(filename).write_text(date)
+            os.utime(filename, (index, index))
+        pathlib.Path(f"{tmpdir}/a-other.txt").write_text("other")
+        removed = rotate_outputs(
+            f"{tmpdir}/a-20260103-000000.txt", f"{tmpdir}/a-[0-9]*.txt", 2
+        )
+        assert removed == [f"{tmpdir}/a-20260101-000000.txt"]
+        assert sorted(os.listdir(tmpdir)) == ["a-20260102-000000.txt", "a-other.txt"]
+
+
+def test_output_file_compressed():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = OutputFile(f"{tmpdir}/a.txt.gz", compress=True)
+        output.open()
+        os.write(output.fileno(), b"first line\n")
+        os.write(output.fileno(), b"second line\n")
+        output.close()
+        with gzip.open(f"{tmpdir}/a.txt.gz", "rb") as fd:
+            assert fd.read() == b"first line\nsecond line\n"
+
+
+def test_output_file_still_written(monkeypatch):
+    monkeypatch.setattr(outputs, "CLOSE_TIMEOUT", 0.1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = OutputFile(f"{tmpdir}/a.txt.gz", compress=True)
+        output.open()
+        # like a background process that inherited the pipe
+        write_fd = os.dup(output.fileno())
+        os.write(write_fd, b"first line\n")
+        thread = output._thread
+        output.close()
+        assert thread.is_alive()
+        # dropped: the file is closed
+        os.write(write_fd, b"second line\n")
+        os.close(write_fd)
+        thread.join(5)
+        with gzip.open(f"{tmpdir}/a.txt.gz", "rb") as fd:
+            assert fd.read() == b"first line\n"
+
+
+def test_output_file_write_error():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = OutputFile(f"{tmpdir}/a.txt.gz", compress=True)
+        output.open()
+        output._fd.close()
+        written = []
+
+        class FullDisk:
+            def write(self, data: bytes):
+                written.append(data)
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+            def close(self):
+                pass
+
+        output._fd = FullDisk()
+        # larger than the pipe buffer: blocked if the pipe is not drained
+        data = b"x" * (4 * outputs.BUFFER_SIZE)
+        writer = threading.Thread(target=os.write, args=(output.fileno(), data))
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        output.close()
+        assert len(written) == 1
+        assert output.error == (
+            f"Unable to write {tmpdir}/a.txt.gz ([Errno 28] No space left on device)."
+        )
+
+
+def test_rule_outputs(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.output_dir = f"{tmpdir}/outputs"
+        os.mkdir(config.output_dir)
+        rule = config.rules[UUID_RAW_PARTITION]
+        rule.output_compress = True
+        rule.output_history = 2
+        rule.stdout_template = "%(outputs)s/%(name)s-%(date)s.out.txt"
+        for date in ("20260101-000000", "20260102-000000", "20260103-000000"):
+            config.run_date = date
+            rule.stdout_path = rule.get_output_path(rule.stdout_template)
+            rule.stderr_path = rule.get_output_path(rule.stderr_template)
+            assert config.run(UUID_RAW_PARTITION)
+        assert (
+            rule.stdout_path == f"{tmpdir}/outputs/primary-20260103-000000.out.txt.gz"
+        )
+        assert sorted(os.listdir(config.output_dir)) == [
+            "primary-20260102-000000.out.txt.gz",
+            "primary-20260103-000000.out.txt.gz",
+            "primary.err.txt.1.gz",
+            "primary.err.txt.gz",
+        ]
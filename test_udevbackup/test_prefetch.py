@@ -0,0 +1,67 @@
+import os
+import pathlib
+import tempfile
+import time
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.prefetch import Prefetcher
+from udevbackup.rule import Rule
+
+
+def prepare_sources(root: pathlib.Path) -> pathlib.Path:
+    source = root / "source"
+    for index in range(3):
+        (source / f"dir{index}" / "sub").mkdir(parents=True)
+        (source / f"dir{index}" / "sub" / "old.txt").write_text("old")
+        os.utime(source / f"dir{index}" / "sub" / "old.txt", (1000, 1000))
+        (source / f"dir{index}" / "new.txt").write_text("new" * 100)
+    return source
+
+
+def test_prefetch_walk(monkeypatch):
+    advised = []
+    monkeypatch.setattr(
+        os, "posix_fadvise", lambda fd, offset, length, advice: advised.append(advice)
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = prepare_sources(pathlib.Path(tmpdir))
+        prefetcher = Prefetcher([str(source)], workers=3, since=2000, read_ahead=700)
+        prefetcher.run()
+        stats = prefetcher.stats
+        assert stats.completed
+        assert stats.directories == 6
+        assert stats.files == 6
+        # only two of the three new files fit in the read-ahead budget
+        assert stats.advised_files == 2
+        assert advised == [os.POSIX_FADV_WILLNEED] * 2
+        assert stats.report().startswith("6 directories and 6 files in ")
+
+
+def test_prefetch_paths(monkeypatch):
+    monkeypatch.setattr(os, "posix_fadvise", lambda *args: None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = prepare_sources(pathlib.Path(tmpdir))
+        paths = [os.fsencode(source / "dir0" / "new.txt"), b"/nonexistent"]
+        prefetcher = Prefetcher([str(source)], paths=paths, read_ahead=1 << 20)
+        prefetcher.run()
+        assert prefetcher.stats.files == 1
+        assert prefetcher.stats.advised_bytes == 300
+
+
+def test_run_prefetch(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = prepare_sources(pathlib.Path(tmpdir))
+        rule = Rule(
+            config,
+            "prefetch",
+            UUID_RAW_PARTITION,
+            "echo test",
+            sources=str(source),
+            prefetch=True,
+        )
+        config.register(rule)
+        rule.get_history().append({"success": True, "ended_at": time.time()})
+        assert config.run(UUID_RAW_PARTITION)
+        assert "Prefetch: " in config._log_content
+        assert rule._prefetcher is None
@@ -0,0 +1,56 @@
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.probe import (
+    PROBE_FILENAME,
+    ProbeResult,
+    compare_probes,
+    probe_throughput,
+)
+from udevbackup.rule import Rule
+
+
+def test_probe_throughput():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        result = probe_throughput(tmpdir, 4 * 1024 * 1024)
+        assert result.read > 0
+        assert result.write > 0
+        assert not (pathlib.Path(tmpdir) / PROBE_FILENAME).exists()
+
+
+def test_compare_probes():
+    current = ProbeResult(read=50.0, write=100.0, direct=True)
+    previous = [{"read": 100.0, "write": 100.0}] * 2
+    assert compare_probes(current, previous, 0.3) == []
+    previous += [{"read": 120.0, "write": 110.0}, {"read": 80.0, "write": 90.0}]
+    assert compare_probes(current, previous, 0.3) == [
+        "read throughput 50.0 MB/s is 50 % below the usual 100.0 MB/s"
+    ]
+    assert compare_probes(current, previous, 0.6) == []
+
+
+def test_run_probe(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.use_smtp = True
+        config.smtp_auth_user = "user"
+        config.smtp_auth_password = "pass"
+        config.smtp_to_email = "admin@example.org"
+        subjects = []
+        monkeypatch.setattr(
+            config,
+            "send_email",
+            lambda content, subject=None, attachments=None: subjects.append(subject),
+        )
+        rule = Rule(config, "probe", UUID_RAW_PARTITION, probe=True, probe_size=1)
+        config.register(rule)
+        history = rule.get_history()
+        for __ in range(3):
+            history.append({"success": True, "probe": {"read": 1e9, "write": 1e9}})
+        assert config.run(UUID_RAW_PARTITION)
+        assert rule.slow_disk
+        assert subjects[0].endswith(" [OK] [SLOW DISK]")
+        assert "Disk throughput: read " in config._log_content
+        assert "Slow disk: read throughput " in config._log_content
+        assert "probe" in history.load()[-1]
@@ -0,0 +1,78 @@
+import pathlib
+import signal
+import tempfile
+import time
+
+import fasteners
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.cli import main
+from udevbackup.removal import RemovalWatcher, removal_marker
+from udevbackup.rule import Config
+
+
+def test_removal_watcher():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        device = pathlib.Path(tmpdir) / "device"
+        device.touch()
+        marker = removal_marker(tmpdir, "uuid")
+        marker.parent.mkdir()
+        marker.touch()
+        removals = []
+        watcher = RemovalWatcher(device, marker, lambda: removals.append(1), 0.01)
+        watcher.start()
+        # the marker of a previous removal is ignored
+        assert not marker.exists()
+        assert main(["removed", "--run-dir", tmpdir, "--fs-uuid", "uuid"]) == 0
+        assert marker.exists()
+        timeout = time.monotonic() + 5
+        while not removals and time.monotonic() < timeout:
+            time.sleep(0.01)
+        watcher.stop()
+        assert removals == [1]
+
+
+def test_run_removed(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.removal_check_interval = 0.01
+        rule = config.rules[UUID_RAW_PARTITION]
+        rule.post_script = "echo post"
+
+        def run_engine():
+            rule._children.add(4242)
+            (config.devices_root / "disk" / "by-uuid" / UUID_RAW_PARTITION).unlink()
+            timeout = time.monotonic() + 5
+            while not rule.removed and time.monotonic() < timeout:
+                time.sleep(0.01)
+            return False
+
+        monkeypatch.setattr(rule, "run_engine", run_engine)
+        assert not config.run(UUID_RAW_PARTITION)
+        assert config.signals == [(4242, signal.SIGTERM)]
+        assert config.popen_commands_full[-1][:2] == ["umount", "-l"]
+        assert (
+            f"Device {UUID_RAW_PARTITION} has been removed: the run is aborted."
+            in config._log_content
+        )
+        assert config.popen_commands_short == ["mount", "umount"]
+        lock = fasteners.InterProcessLock(config.lock_file)
+        assert lock.acquire(blocking=False)
+        lock.release()
+
+
+def test_udev_rule_run_dir():
+    rule = Config.udev_rule("/run/other")
+    assert "removed --run-dir /run/other" in rule.splitlines()[1]
+
+
+def test_add_child_after_removal(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        rule = config.rules[UUID_RAW_PARTITION]
+        rule.abort()
+        # started before the removal, registered after it
+        rule.add_child(4242, removed=False)
+        # started by the tear down
+        rule.add_child(4243, removed=True)
+        assert config.signals == [(4242, signal.SIGTERM)]
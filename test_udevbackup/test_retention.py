@@ -0,0 +1,91 @@
+import datetime
+import os
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.retention import Pruner, parse_date, select_kept
+from udevbackup.rule import Rule
+
+
+def test_parse_date():
+    assert parse_date("20240131-120001") == datetime.datetime(2024, 1, 31, 12, 0, 1)
+    assert parse_date("backup-2024-01-31.tar") == datetime.datetime(2024, 1, 31)
+    assert parse_date("2024-01-31_12-30-00") == datetime.datetime(2024, 1, 31, 12, 30)
+    assert parse_date("20241399") is None
+    assert parse_date("latest") is None
+
+
+def test_select_kept():
+    start = datetime.datetime(2024, 1, 1, 12)
+    dates = {f"day{x:02d}": start + datetime.timedelta(days=x) for x in range(60)}
+    dates["day59-bis"] = start + datetime.timedelta(days=59, hours=-1)
+    assert select_kept(dates, 0, 0, 0) == {"day59"}
+    assert select_kept(dates, 3, 0, 0) == {"day59", "day58", "day57"}
+    # the last day of the previous weeks is a Sunday (days 55 and 48)
+    assert select_kept(dates, 0, 3, 0) == {"day59", "day55", "day48"}
+    assert select_kept(dates, 1, 0, 2) == {"day59", "day30"}
+
+
+def test_pruner():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        for name in ("old", "new"):
+            (root / name / "a" / "b").mkdir(parents=True)
+            (root / name / "a" / "b" / "file").write_bytes(b"x" * 8192)
+            (root / name / "link").symlink_to(root / name / "a")
+        for index in range(50):
+            (root / "old" / f"file{index}").write_text("content")
+        os.link(root / "new" / "a" / "b" / "file", root / "old" / "hardlink")
+        pruner = Pruner([root / "old"], workers=3)
+        pruner.start()
+        stats = pruner.wait()
+        assert not (root / "old").exists()
+        assert (root / "new" / "a" / "b" / "file").exists()
+        assert stats.errors == []
+        assert stats.snapshots == ["old"]
+        assert stats.files == 53
+        assert stats.reclaimed_bytes >= 8192
+        assert stats.report().startswith("1 snapshots deleted (old), 53 files, ")
+
+
+def test_pruner_stopped():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        (root / "old").mkdir()
+        (root / "old" / "file").write_text("content")
+        pruner = Pruner([root / "old"], should_stop=lambda: True)
+        pruner.start()
+        stats = pruner.wait()
+        assert (root / "old" / "file").exists()
+        assert stats.snapshots == []
+
+
+def test_run_retention(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        source = pathlib.Path(tmpdir) / "source"
+        source.mkdir()
+        (source / "file.txt").write_text("content")
+        archives = config.devices_root / "storage" / UUID_RAW_PARTITION / "archive"
+        for name in ("20200101-000000", "20200102-000000", "20200103-000000"):
+            (archives / name).mkdir(parents=True)
+            (archives / name / "volume-0000.tar.gz").write_text("old volume")
+        rule = Rule(
+            config,
+            "archive",
+            UUID_RAW_PARTITION,
+            engine="archive",
+            sources=str(source),
+            keep_daily=2,
+        )
+        config.register(rule)
+        assert config.run(UUID_RAW_PARTITION)
+        assert sorted(x.name for x in archives.iterdir()) == [
+            "20200103-000000",
+            config.run_date,
+        ]
+        assert (
+            "Retention: 2 snapshots deleted (20200101-000000, 20200102-000000), 2 files"
+            in config._log_content
+        )
@@ -14,7 +14,8 @@ from test_udevbackup.utils import (
     FakeSMTP,
     prepare_config,
 )
-from udevbackup.rule import Config
+from udevbackup.devices import partitions
+from udevbackup.rule import Config, Rule
 
 
 def test_log_text(monkeypatch):
@@ -130,12 +131,52 @@ def test_run_luks(monkeypatch):
         )
         assert "Successful." in config._log_content
         assert config.popen_commands_short == [
-            "cryptdisks_start",
+            "cryptsetup",
             "mount",
             "sudo",
             "umount",
             "cryptsetup",
         ]
+        assert config.popen_commands_full[0] == [
+            "cryptsetup",
+            "open",
+            "--type",
+            "luks",
+            "--key-file",
+            "/etc/luks-keys/7a404841.key",
+            f"{config.devices_root}/disk/by-uuid/{UUID_LUKS_2_PARTITION}",
+            "dm-1",
+        ]
+
+
+def test_run_luks_options(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.crypttab.write_text(
+            f"dm-1 UUID={UUID_LUKS_2_PARTITION} /etc/key luks,discard,no-read-workqueue\n"
+            f"dm-2 UUID={UUID_LUKS_3_PARTITION} /etc/key luks,keyscript=/bin/cat\n"
+        )
+        rule = Rule(
+            config,
+            "other",
+            UUID_LUKSED_PARTITION,
+            "echo test3",
+            luks_uuid=UUID_LUKS_3_PARTITION,
+        )
+        config.register(rule)
+        config.rules[UUID_LUKS_2_PARTITION].luks_options = ["--perf-no_write_workqueue"]
+        config.identify_cryptodevices()
+        assert config.rules[UUID_LUKS_2_PARTITION].get_luks_command()[2:-2] == [
+            "--type",
+            "luks",
+            "--allow-discards",
+            "--perf-no_read_workqueue",
+            "--key-file",
+            "/etc/key",
+            "--perf-no_write_workqueue",
+        ]
+        assert rule.get_luks_command() == ["cryptdisks_start", "dm-2"]
+        assert "(keyscript=/bin/cat): using cryptdisks_start." in config._log_content
 
 
 def test_send_email_no_email(monkeypatch):
@@ -193,3 +234,56 @@ def test_send_email_valid(monkeypatch):
             40,
             f"Unable to send mail to {config.smtp_to_email}: Authentication failed.",
         ) not in config.logger_content
+
+
+def test_run_disk(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        disk = config.sysfs_root / "devices" / "sdx"
+        (config.sysfs_root / "class" / "block").mkdir(parents=True)
+        (config.sysfs_root / "class" / "block" / "sdx").symlink_to(disk)
+        for name in ("sda1", "sdd1"):
+            (disk / name).mkdir(parents=True)
+            (disk / name / "partition").write_text(name[-1])
+            (config.sysfs_root / "class" / "block" / name).symlink_to(disk / name)
+        assert partitions(config.sysfs_root, "sdx") == ["sda1", "sdd1"]
+        config.partition_wait = 1.0
+        rule = Rule(config, "second", UUID_LUKS_3_PARTITION, "echo test3")
+        # the rule of the other partition is read after the wait for partitions
+        config.load_drop_ins = lambda uuids: config.register(rule)
+        assert config.get_disk(rule) == "sdx"
+        assert config.get_disk(config.rules[UUID_LUKS_2_PARTITION]) is None
+        assert config.run(UUID_RAW_PARTITION)
+        assert config.popen_commands_short == [
+            "mount",
+            "mount",
+            "bash",
+            "bash",
+            "umount",
+            "umount",
+        ]
+        for fs_uuid in (UUID_RAW_PARTITION, UUID_LUKS_3_PARTITION):
+            assert f"Device {fs_uuid} can be disconnected." in config._log_content
+
+        config.popen_commands_short.clear()
+        config.partition_wait = 0.0
+        assert config.run(UUID_LUKS_3_PARTITION)
+        assert config.popen_commands_short == ["mount", "bash", "umount"]
+
+
+def test_run_checkpoint(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        storage = config.devices_root / "storage" / UUID_LUKSED_PARTITION
+        storage.mkdir(parents=True)
+        (storage / f".udevbackup-{UUID_LUKSED_PARTITION}.state").write_text(
+            '{"done_bytes": 2000000}'
+        )
+        config.identify_cryptodevices()
+        assert config.run(UUID_LUKS_2_PARTITION)
+        assert ", 2.0 MB already done)." in config._log_content
+        command = config.popen_commands_full[2]
+        assert command[:4] == ["sudo", "-Hu", "backupuser", "env"]
+        assert command[4].startswith("UDEVBACKUP_STATE=/")
+        assert command[4].endswith(f"/.udevbackup-{UUID_LUKSED_PARTITION}.state")
+        assert not (storage / f".udevbackup-{UUID_LUKSED_PARTITION}.state").exists()
@@ -0,0 +1,147 @@
+import multiprocessing
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import (
+    UUID_LUKS_2_PARTITION,
+    UUID_LUKSED_PARTITION,
+    UUID_RAW_PARTITION,
+    prepare_config,
+)
+from udevbackup import rule as rule_module
+from udevbackup.rule import Rule
+from udevbackup.session import SessionCache
+
+
+def test_session_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sessions = SessionCache(pathlib.Path(tmpdir) / "sessions")
+        assert sessions.load(UUID_RAW_PARTITION) is None
+        sessions.save(UUID_RAW_PARTITION, "/mnt/a", None, UUID_RAW_PARTITION, 60)
+        session = sessions.load(UUID_RAW_PARTITION)
+        assert session["mount_dir"] == "/mnt/a"
+        assert session["expires_at"] == session["used_at"] + 60
+        sessions.save(UUID_RAW_PARTITION, "/mnt/a", None, UUID_RAW_PARTITION, 120)
+        assert sessions.load(UUID_RAW_PARTITION)["opened_at"] == session["opened_at"]
+        assert [x["fs_uuid"] for x in sessions.sessions()] == [UUID_RAW_PARTITION]
+        sessions.remove(UUID_RAW_PARTITION)
+        assert sessions.sessions() == []
+
+
+def get_luks_rule(config) -> Rule:
+    rule = Rule(
+        config,
+        "data",
+        UUID_LUKSED_PARTITION,
+        "echo test2",
+        luks_uuid=UUID_LUKS_2_PARTITION,
+        keep_open=600,
+    )
+    config.register(rule)
+    config.identify_cryptodevices()
+    return rule
+
+
+def test_run_keep_open(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        get_luks_rule(config)
+        assert config.run(UUID_LUKS_2_PARTITION)
+        assert config.popen_commands_short == [
+            "cryptsetup",
+            "mount",
+            "bash",
+            "sync",
+            "at",
+        ]
+        # the session is closed by `at` once expired
+        assert config.popen_commands_full[-1] == ["at", "now + 10 minutes"]
+        assert config.popen_inputs[-1].endswith(b" close -C /etc/udevbackup")
+        session = config.session_cache.load(UUID_LUKSED_PARTITION)
+        assert session["luks_name"] == "dm-1"
+        assert session["mount_dir"] in config.mounted
+        del config.popen_commands_short[:]
+
+        # the next run reuses the unlocked and mounted disk
+        get_luks_rule(config)
+        assert config.run(UUID_LUKS_2_PARTITION)
+        assert config.popen_commands_short == ["bash", "sync", "at"]
+        assert "Reusing the disk mounted on " in config._log_content
+        del config.popen_commands_short[:]
+
+        # a session is closed once expired
+        config.session_cache.save(
+            UUID_LUKSED_PARTITION,
+            session["mount_dir"],
+            "dm-1",
+            UUID_LUKS_2_PARTITION,
+            -1,
+        )
+        assert config.close_expired_sessions()
+        assert config.popen_commands_full[-2:] == [
+            ["umount", session["mount_dir"]],
+            ["cryptsetup", "close", "dm-1"],
+        ]
+        assert config.session_cache.sessions() == []
+        assert not pathlib.Path(session["mount_dir"]).exists()
+
+
+def test_run_keep_open_failed(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.popen_result["bash"] = 1
+        rule = Rule(config, "primary", UUID_RAW_PARTITION, "exit 1", keep_open=600)
+        config.register(rule)
+        assert not config.run(UUID_RAW_PARTITION)
+        # a failed run does not keep the disk mounted
+        assert config.popen_commands_short == ["mount", "bash", "umount"]
+        assert config.session_cache.sessions() == []
+
+
+def test_run_keep_open_stale(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        mount_dir = pathlib.Path(tmpdir) / "unmounted"
+        mount_dir.mkdir()
+        config.session_cache.save(
+            UUID_RAW_PARTITION, str(mount_dir), None, UUID_RAW_PARTITION, 600
+        )
+        rule = Rule(config, "primary", UUID_RAW_PARTITION, "echo", keep_open=600)
+        config.register(rule)
+        assert config.run(UUID_RAW_PARTITION)
+        assert f"The disk is no longer mounted on {mount_dir}." in config._log_content
+        assert config.popen_commands_short == ["mount", "bash", "sync", "at"]
+        session = config.session_cache.load(UUID_RAW_PARTITION)
+        assert session["mount_dir"] != str(mount_dir)
+        assert not mount_dir.exists()
+
+
+def hold_session_lock(cache: SessionCache, locked, release):
+    with cache.lock(UUID_RAW_PARTITION):
+        locked.set()
+        release.wait(10)
+
+
+def test_run_keep_open_locked(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        monkeypatch.setattr(rule_module, "SESSION_LOCK_TIMEOUT", 0.1)
+        rule = Rule(config, "primary", UUID_RAW_PARTITION, "echo", keep_open=600)
+        config.register(rule)
+        config.session_cache.directory.mkdir(parents=True)
+        context = multiprocessing.get_context("fork")
+        locked, release = context.Event(), context.Event()
+        process = context.Process(
+            target=hold_session_lock, args=(config.session_cache, locked, release)
+        )
+        process.start()
+        try:
+            assert locked.wait(10)
+            assert not config.run(UUID_RAW_PARTITION)
+        finally:
+            release.set()
+            process.join()
+        assert config.popen_commands_short == []
+        assert f"The session of {UUID_RAW_PARTITION} is used by another run" in (
+            rule.errors[0]
+        )
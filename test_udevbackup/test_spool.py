@@ -0,0 +1,141 @@
+import gzip
+import pathlib
+import smtplib
+import tempfile
+
+import fasteners
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, FakeSMTP, prepare_config
+from udevbackup.spool import MailSpool
+
+
+def test_spool_deliver():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        spool = MailSpool(tmpdir)
+        first = spool.enqueue(b"first message")
+        second = spool.enqueue(b"second message")
+        assert spool.pending() == [first, second]
+        with gzip.open(first) as fd:
+            assert fd.read() == b"first message"
+
+        connections: list[FakeSMTP] = []
+        delays: list[float] = []
+
+        def connect():
+            if len(delays) < 2:
+                raise ConnectionRefusedError("Connection refused")
+            smtp = FakeSMTP("localhost", 25)
+            smtp.login("user", "pass")
+            connections.append(smtp)
+            return smtp
+
+        assert spool.deliver(
+            connect,
+            "from@example.com",
+            ["to@example.com"],
+            max_attempts=3,
+            retry_delay=10.0,
+            sleep=delays.append,
+        )
+        assert delays == [10.0, 20.0]
+        assert len(connections) == 1
+        assert connections[0].sent_messages == [b"first message", b"second message"]
+        assert spool.pending() == []
+
+
+def test_spool_deliver_failure():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        spool = MailSpool(tmpdir)
+        spool.enqueue(b"message")
+        logs = []
+        locked = []
+
+        def connect():
+            raise ConnectionRefusedError("Connection refused")
+
+        def sleep(delay: float):
+            # the lock is released while waiting
+            lock = fasteners.InterProcessLock(pathlib.Path(tmpdir) / ".lock")
+            locked.append(lock.acquire(blocking=False))
+            lock.release()
+
+        assert not spool.deliver(
+            connect,
+            "from@example.com",
+            ["to@example.com"],
+            max_attempts=2,
+            log=lambda text, level: logs.append((level, text)),
+            sleep=sleep,
+        )
+        assert len(spool.pending()) == 1
+        assert locked == [True]
+        assert logs[-1] == (
+            40,
+            "Unable to send mail to to@example.com: Connection refused (attempt 2/2).",
+        )
+
+
+class RefusingSMTP(FakeSMTP):
+    def sendmail(self, from_addr: str, to_addrs: list[str], msg: str):
+        if msg == b"refused message":
+            raise smtplib.SMTPDataError(554, b"Message refused")
+        super().sendmail(from_addr, to_addrs, msg)
+
+
+def test_spool_deliver_quarantine():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        spool = MailSpool(tmpdir)
+        refused = spool.enqueue(b"refused message")
+        spool.enqueue(b"message")
+        connections: list[FakeSMTP] = []
+
+        def connect():
+            smtp = RefusingSMTP("localhost", 25)
+            smtp.login("user", "pass")
+            connections.append(smtp)
+            return smtp
+
+        logs = []
+        delays: list[float] = []
+        assert not spool.deliver(
+            connect,
+            "from@example.com",
+            ["to@example.com"],
+            max_attempts=3,
+            retry_delay=10.0,
+            log=lambda text, level: logs.append((level, text)),
+            sleep=delays.append,
+        )
+        # the refused message does not block the next one
+        assert connections[0].sent_messages == [b"message"]
+        assert delays == [10.0, 20.0]
+        assert len(connections) == 3
+        assert spool.pending() == []
+        assert (pathlib.Path(tmpdir) / "quarantine" / refused.name).is_file()
+        assert not spool.attempts_path(refused).exists()
+        assert logs[-2] == (
+            40,
+            f"The server refused the e-mail {refused.name}: (554, b'Message refused') "
+            "(attempt 3/3).",
+        )
+
+
+def test_run_spool(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.use_smtp = True
+        config.spool_dir = f"{tmpdir}/spool"
+        config.config_dir = f"{tmpdir}/config"
+        config.smtp_from_email = "from@example.com"
+        config.smtp_to_email = "to@example.com"
+        config.smtp_auth_password = "pass"
+        config.smtp_auth_user = "user"
+        assert config.run(UUID_RAW_PARTITION)
+        assert config.popen_commands_short[:3] == ["mount", "bash", "umount"]
+        assert config.popen_commands_full[3][-3:] == ["flush", "-C", config.config_dir]
+        spool = MailSpool(config.spool_dir)
+        assert len(spool.pending()) == 1
+        with gzip.open(spool.pending()[0]) as fd:
+            assert b"Subject: primary [OK]" in fd.read()
+        assert config.flush_spool()
+        assert spool.pending() == []
@@ -0,0 +1,61 @@
+import json
+import multiprocessing
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.cli import main
+from udevbackup.status import RunStatus, read_last_line, read_statuses
+
+
+def test_read_last_line():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir) / "out.txt"
+        assert read_last_line(path) is None
+        path.write_text("x" * 10000 + "\nsent 1,234 bytes\n\n")
+        assert read_last_line(path) == "sent 1,234 bytes"
+
+
+def test_run_status():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        status = RunStatus(tmpdir, "rule", "uuid", refresh=lambda: {"bytes_written": 4})
+        status.start()
+        status.set_phase("mount", child_pid=1234)
+        content = json.loads((pathlib.Path(tmpdir) / "uuid.json").read_text())
+        assert content["phase"] == "mount"
+        assert content["child_pid"] == 1234
+        assert content["bytes_written"] == 4
+        assert read_statuses(tmpdir) == [content]
+        status.stop()
+        assert read_statuses(tmpdir) == []
+
+
+def test_read_statuses_dead_pid():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        process = multiprocessing.get_context("fork").Process(target=lambda: None)
+        process.start()
+        process.join()
+        path = pathlib.Path(tmpdir) / "uuid.json"
+        path.write_text(json.dumps({"rule": "rule", "pid": process.pid}))
+        assert read_statuses(tmpdir) == []
+        assert not path.exists()
+
+
+def test_main_status(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        rule = config.rules[UUID_RAW_PARTITION]
+
+        def run_engine():
+            pathlib.Path(rule.stdout_path).write_text("copying file 42\n")
+            rule.status.update()
+            assert main(["status", "--run-dir", config.run_dir]) == 0
+            return True
+
+        monkeypatch.setattr(rule, "run_engine", run_engine)
+        assert config.run(UUID_RAW_PARTITION)
+        output = config.stdout.getvalue()
+        assert f"primary ({UUID_RAW_PARTITION}): mount for 0:00:00" in output
+        assert "  copying file 42" in output
+        assert main(["status", "--run-dir", config.run_dir, "--json"]) == 0
+        assert config.stdout.getvalue().endswith("[]\n")
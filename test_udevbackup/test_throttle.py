@@ -0,0 +1,125 @@
+import os
+import pathlib
+import subprocess
+import tempfile
+
+import pytest
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.devices import device_numbers, parent_device
+from udevbackup.throttle import IOPRIO_WHO_PROCESS, Throttle
+
+
+def test_throttle_ioprio():
+    with pytest.raises(ValueError):
+        Throttle(io_class="invalid")
+    with pytest.raises(ValueError):
+        Throttle(io_priority=8)
+    with pytest.raises(ValueError):
+        Throttle(nice=20)
+    assert Throttle(nice=10).ioprio is None
+    assert Throttle(io_class="idle", io_priority=2).ioprio == 3 << 13
+    assert Throttle(io_class="best-effort").ioprio == (2 << 13) | 4
+    assert Throttle(io_priority=7).ioprio == (2 << 13) | 7
+    assert not Throttle(io_class="idle", nice=19).uses_cgroup
+    assert Throttle(memory_high="2G").uses_cgroup
+
+
+def test_throttle_apply(monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, "setpriority", lambda *args: calls.append(args))
+    throttle = Throttle(io_class="idle", nice=19)
+    throttle._ioprio_set = lambda *args: calls.append(args)
+    throttle.apply(1234)
+    assert calls == [
+        (os.PRIO_PROCESS, 1234, 19),
+        (IOPRIO_WHO_PROCESS, 1234, 3 << 13),
+    ]
+
+
+def test_throttle_wrap():
+    assert Throttle().wrap(["ls"]) == ["ls"]
+    assert Throttle(io_class="idle", io_priority=2, nice=19).wrap(["ls"]) == [
+        "ionice",
+        "-t",
+        "-c",
+        "3",
+        "nice",
+        "-n",
+        "19",
+        "ls",
+    ]
+    throttle = Throttle(io_priority=7, cpu_weight=20)
+    throttle.cgroup = pathlib.Path("/sys/fs/cgroup/udevbackup/test")
+    command = throttle.wrap(["ls", "-l"])
+    assert command[:2] == ["sh", "-c"]
+    assert command[3:] == [
+        "/sys/fs/cgroup/udevbackup/test/cgroup.procs",
+        "ionice",
+        "-t",
+        "-c",
+        "2",
+        "-n",
+        "7",
+        "ls",
+        "-l",
+    ]
+
+
+def test_throttle_wrap_cgroup():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        throttle = Throttle(cpu_weight=20)
+        throttle.cgroup = pathlib.Path(tmpdir)
+        command = throttle.wrap(["sh", "-c", "echo $$"])
+        output = subprocess.run(command, capture_output=True, text=True, check=True)
+        # the command is executed by the process moved to the cgroup
+        assert (throttle.cgroup / "cgroup.procs").read_text() == output.stdout
+        throttle.cgroup = pathlib.Path(tmpdir) / "missing"
+        output = subprocess.run(
+            throttle.wrap(["echo", "ok"]), capture_output=True, text=True, check=True
+        )
+        assert (output.stdout, output.stderr) == ("ok\n", "")
+
+
+def test_throttle_cgroup():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        throttle = Throttle(io_max_bps=1000000, cpu_weight=20, memory_high="2G")
+        with pytest.raises(OSError):
+            throttle.create_cgroup(root, "test", "8:0")
+        (root / "cgroup.controllers").write_text("cpu io memory")
+        throttle.create_cgroup(root, "test", "8:0")
+        cgroup = root / "udevbackup" / "test"
+        assert throttle.cgroup == cgroup
+        assert (root / "cgroup.subtree_control").read_text() == "+io +cpu +memory"
+        assert (cgroup / "io.max").read_text() == "8:0 rbps=1000000 wbps=1000000"
+        assert (cgroup / "cpu.weight").read_text() == "20"
+        assert (cgroup / "memory.high").read_text() == "2G"
+        throttle.apply(1234)
+        assert (cgroup / "cgroup.procs").read_text() == "1234"
+
+
+def test_run_throttle(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        disk = config.sysfs_root / "devices" / "sda"
+        (disk / "sda1").mkdir(parents=True)
+        (disk / "sda1" / "partition").write_text("1")
+        (disk / "dev").write_text("8:0\n")
+        (config.sysfs_root / "class" / "block").mkdir(parents=True)
+        (config.sysfs_root / "class" / "block" / "sda").symlink_to(disk)
+        (config.sysfs_root / "class" / "block" / "sda1").symlink_to(disk / "sda1")
+        assert parent_device(config.sysfs_root, "sda1") == "sda"
+        assert parent_device(config.sysfs_root, "sda") == "sda"
+        assert device_numbers(config.sysfs_root, "sda") == "8:0"
+        config.cgroup_root.mkdir()
+        (config.cgroup_root / "cgroup.controllers").write_text("cpu io memory")
+        rule = config.rules[UUID_RAW_PARTITION]
+        rule.throttle = Throttle(io_max_bps=1000)
+        assert config.run(UUID_RAW_PARTITION)
+        cgroup = config.cgroup_root / "udevbackup" / UUID_RAW_PARTITION
+        assert (cgroup / "io.max").read_text() == "8:0 rbps=1000 wbps=1000"
+        # the commands of the rule enter the cgroup before they are executed
+        procs = str(cgroup / "cgroup.procs")
+        commands = [x for x in config.popen_commands_full if procs in x]
+        assert commands and all(x[:2] == ["sh", "-c"] for x in commands)
@@ -0,0 +1,59 @@
+import json
+import tempfile
+import threading
+
+from test_udevbackup.utils import UUID_LUKS_2_PARTITION, prepare_config
+from udevbackup.trace import Tracer
+
+
+def test_tracer():
+    tracer = Tracer("test")
+    with tracer.span("outer", value=1) as args:
+        args["result"] = 2
+        with tracer.span("inner"):
+            events = tracer.get_events()
+            assert [x["name"] for x in events[2:]] == ["outer", "inner"]
+            assert events[2]["args"]["unfinished"]
+        thread = threading.Thread(target=lambda: tracer.span("other").__enter__())
+        thread.start()
+        thread.join()
+    events = tracer.get_events()
+    assert events[0]["args"] == {"name": "test"}
+    assert len([x for x in events if x["ph"] == "M"]) == 3
+    outer = next(x for x in events if x["name"] == "outer")
+    inner = next(x for x in events if x["name"] == "inner")
+    assert outer["args"] == {"value": 1, "result": 2}
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+
+def test_run_trace(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.trace = True
+        config.identify_cryptodevices()
+        config.use_smtp = True
+        config.smtp_auth_user = "user"
+        config.smtp_auth_password = "pass"
+        config.smtp_to_email = "admin@example.org"
+        sent_attachments = []
+        send_email = config.send_email
+
+        def fake_send_email(content, subject=None, attachments=None):
+            sent_attachments.extend(attachments)
+            send_email(content, subject=subject, attachments=attachments)
+
+        monkeypatch.setattr(config, "send_email", fake_send_email)
+        assert config.run(UUID_LUKS_2_PARTITION)
+        assert str(config.trace_path) in sent_attachments
+        content = json.loads(config.trace_path.read_text())
+        spans = [x for x in content["traceEvents"] if x["ph"] == "X"]
+        names = [x["name"] for x in spans]
+        for name in ("run", "lock wait", "set_up", "mount", "job", "tear_down"):
+            assert name in names
+        assert names.index("cryptsetup") < names.index("wait for device")
+        assert names[-1] == "email"
+        assert not any(x["args"].get("unfinished") for x in spans)
+        mount = spans[names.index("mount")]
+        assert mount["args"]["rule"] == "data"
+        assert mount["args"]["returncode"] == 0
@@ -0,0 +1,96 @@
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.rule import Rule
+from udevbackup.tuning import BlockTuning, read_sysfs_value
+
+
+def test_run_tuning(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        disk = config.sysfs_root / "devices" / "sda"
+        (disk / "sda1").mkdir(parents=True)
+        (disk / "sda1" / "partition").write_text("1")
+        (disk / "queue").mkdir()
+        (disk / "queue" / "scheduler").write_text("[mq-deadline] kyber bfq none\n")
+        (disk / "queue" / "read_ahead_kb").write_text("128\n")
+        (disk / "queue" / "nr_requests").write_text("256\n")
+        for name in ("class/block", "block"):
+            (config.sysfs_root / name).mkdir(parents=True)
+            (config.sysfs_root / name / "sda").symlink_to(disk)
+        (config.sysfs_root / "class/block/sda1").symlink_to(disk / "sda1")
+        assert read_sysfs_value(disk / "queue" / "scheduler") == "mq-deadline"
+
+        rule = Rule(
+            config,
+            "tuned",
+            UUID_RAW_PARTITION,
+            "echo test",
+            io_scheduler="none",
+            read_ahead_kb=4096,
+            nr_requests=256,
+            max_ratio=20,
+        )
+        config.register(rule)
+        applied = []
+        monkeypatch.setattr(
+            rule,
+            "run_engine",
+            lambda: applied.append((disk / "queue" / "read_ahead_kb").read_text())
+            or True,
+        )
+        assert config.run(UUID_RAW_PARTITION)
+        assert applied == ["4096"]
+        assert (disk / "queue" / "scheduler").read_text() == "mq-deadline"
+        assert (disk / "queue" / "read_ahead_kb").read_text() == "128"
+        assert "Unable to set" in config._log_content
+        assert "bdi/max_ratio" in config._log_content
+
+
+def test_tuning_restore_order():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        (root / "block" / "sdb" / "queue").mkdir(parents=True)
+        path = root / "block" / "sdb" / "queue" / "read_ahead_kb"
+        path.write_text("128")
+        first = BlockTuning({"queue/read_ahead_kb": "1024"})
+        second = BlockTuning({"queue/read_ahead_kb": "4096"})
+        assert first.apply(root, "sdb") == []
+        assert second.apply(root, "sdb") == []
+        assert path.read_text() == "4096"
+        assert second.restore() == []
+        assert first.restore() == []
+        assert path.read_text() == "128"
+
+
+def test_tuning_restore_scheduler_first(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        queue = root / "block" / "sdb" / "queue"
+        queue.mkdir(parents=True)
+        (queue / "scheduler").write_text("[mq-deadline] none\n")
+        (queue / "nr_requests").write_text("64\n")
+        (queue / "read_ahead_kb").write_text("128\n")
+        tuning = BlockTuning(
+            {
+                "queue/nr_requests": "256",
+                "queue/scheduler": "none",
+                "queue/read_ahead_kb": "4096",
+            }
+        )
+        written = []
+        write_text = pathlib.Path.write_text
+
+        def record(path: pathlib.Path, value: str):
+            written.append(path.name)
+            return write_text(path, value)
+
+        monkeypatch.setattr(pathlib.Path, "write_text", record)
+        assert tuning.apply(root, "sdb") == []
+        # the scheduler resets nr_requests: it is written first
+        assert written == ["scheduler", "nr_requests", "read_ahead_kb"]
+        written.clear()
+        assert tuning.restore() == []
+        assert written == ["scheduler", "read_ahead_kb", "nr_requests"]
+        assert (queue / "nr_requests").read_text() == "64"
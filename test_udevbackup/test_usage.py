@@ -0,0 +1,52 @@
+import pathlib
+import tempfile
+
+from test_udevbackup.utils import UUID_RAW_PARTITION, prepare_config
+from udevbackup.usage import ResourceUsage, read_process_io
+
+PROC_IO = """rchar: 323934931
+wchar: 323929600
+syscr: 632687
+syscw: 632675
+read_bytes: 4096
+write_bytes: 323932160
+cancelled_write_bytes: 0
+"""
+
+
+def test_read_process_io():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = pathlib.Path(tmpdir)
+        assert read_process_io(root, 1234) == {}
+        (root / "1234").mkdir()
+        (root / "1234" / "io").write_text(PROC_IO)
+        io = read_process_io(root, 1234)
+        assert io["read_bytes"] == 4096
+        assert io["write_bytes"] == 323932160
+
+
+def test_resource_usage_sum():
+    first = ResourceUsage(user_time=1.0, max_rss=1024, block_out=8, read_bytes=10)
+    second = ResourceUsage(user_time=2.0, max_rss=512, block_out=2, read_bytes=5)
+    total = first + second
+    assert total.user_time == 3.0
+    assert total.max_rss == 1024
+    assert total.block_out == 10
+    assert total.read_bytes == 15
+    assert total.summary().startswith("CPU 3.0 s user, 0.0 s system, max RSS 1.0 MB")
+
+
+def test_run_usage(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = prepare_config(tmpdir, monkeypatch)
+        config.procfs_root.mkdir()
+        for pid in range(100000, 100003):
+            (config.procfs_root / str(pid)).mkdir()
+            (config.procfs_root / str(pid) / "io").write_text(PROC_IO)
+        assert config.run(UUID_RAW_PARTITION)
+        rule = config.rules[UUID_RAW_PARTITION]
+        assert rule.usage.user_time == 1.5
+        assert rule.usage.max_rss == 2048
+        assert rule.usage.write_bytes == 3 * 323932160
+        assert "Resources of script: CPU 0.5 s user" in config._log_content
+        assert "Resources used by primary: CPU 1.5 s user" in config._log_content
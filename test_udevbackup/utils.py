@@ -2,6 +2,9 @@ import io
 import os
 import pathlib
 import pwd
+import resource
+import shutil
+import signal
 import smtplib
 import subprocess
 import sys
@@ -70,6 +73,25 @@ class TestConfig(Config):
         self.stdout = io.StringIO()
         self.stderr = io.StringIO()
         self.luks_open_timeout = 0.2
+        self.mounted: dict[str, pathlib.Path] = {}
+        self.processes: dict[int, FakePopen] = {}
+        self.signals: list[tuple[int, int]] = []
+
+    def killpg(self, pgid: int, sig: int):
+        """Fake processes stop as soon as they receive a signal."""
+        if sig == 0 or (pgid, signal.SIGTERM) in self.signals:
+            raise ProcessLookupError(pgid)
+        self.signals.append((pgid, sig))
+
+    def is_mounted(self, path: str) -> bool:
+        return path in self.mounted
+
+    def wait4(self, pid: int, options: int):
+        """Finish a fake process, with a fake resource usage."""
+        process = self.processes.pop(pid)
+        process.finish()
+        rusage = resource.struct_rusage((0.5, 0.25, 2048) + (0,) * 13)
+        return pid, process.returncode << 8, rusage
 
     def prepare_device(self, name: str):
         part_data = PARTITIONS[name]
@@ -81,6 +103,24 @@ class TestConfig(Config):
             link_path.parent.mkdir(parents=True, exist_ok=True)
             link_path.symlink_to(os.path.relpath(device_path, link_parent))
 
+    def fake_mount(self, fs_uuid: str, mount_dir: str):
+        """Copy the content of the fake file system to the mount point."""
+        storage = self.devices_root / "storage" / fs_uuid
+        storage.mkdir(parents=True, exist_ok=True)
+        shutil.copytree(storage, mount_dir, symlinks=True, dirs_exist_ok=True)
+        self.mounted[mount_dir] = storage
+
+    def fake_umount(self, mount_dir: str):
+        """Move the content of the mount point to the fake file system."""
+        storage = self.mounted.pop(mount_dir)
+        shutil.rmtree(storage)
+        shutil.copytree(mount_dir, storage, symlinks=True)
+        for path in pathlib.Path(mount_dir).iterdir():
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
 
 def getpwnam(username: str):
     class FakePwNam:
@@ -104,6 +144,8 @@ def prepare_config(tmpdir: str, monkeypatch) -> TestConfig:
         use_log_file=True, use_stdout=True, lock_file=f"{tmpdir}/udevbackup.lock"
     )
     dev_root = pathlib.Path(tmpdir).resolve()
+    # Config.run changes the working directory: restored after the test
+    monkeypatch.chdir(tmpdir)
     monkeypatch.setattr(
         Logger,
         "log",
@@ -122,11 +164,19 @@ def prepare_config(tmpdir: str, monkeypatch) -> TestConfig:
     monkeypatch.setattr(sys, "stderr", config.stderr)
     monkeypatch.setattr(pwd, "getpwnam", getpwnam)
     monkeypatch.setattr(os, "chown", chown)
+    monkeypatch.setattr(os, "waitid", lambda *args: None)
+    monkeypatch.setattr(os, "wait4", config.wait4)
+    monkeypatch.setattr(os, "killpg", config.killpg)
     config.temp_directory = dev_root / "tmp"
     config.temp_directory.mkdir(parents=True)
     config.crypttab = dev_root / "crypttab"
     config.crypttab.write_text(CRYPTTAB_CONTENT_1, encoding="utf-8")
     config.devices_root = dev_root
+    config.sysfs_root = dev_root / "sys"
+    config.procfs_root = dev_root / "proc"
+    config.cgroup_root = dev_root / "cgroup"
+    config.state_dir = str(dev_root / "state")
+    config.run_dir = str(dev_root / "run")
     config.prepare_device("raw")
     config.prepare_device("luks_1")
     config.prepare_device("luks_2")
@@ -154,6 +204,7 @@ class FakePopen:
         stderr=None,
         stdout=None,
         stdin=None,
+        **kwargs,
     ):
         self.command = command
         self.config = config
@@ -161,20 +212,35 @@ class FakePopen:
         self.stderr = stderr
         self.stdout = stdout
         self.stdin = stdin
+        self.kwargs = kwargs
         self.returncode = 0
-
-    def communicate(self, data: bytes | None = None):
+        self.pid = 100000 + len(self.config.popen_commands_full)
+        self.config.processes[self.pid] = self
         self.config.popen_commands_full.append(self.command)
         self.config.popen_commands_short.append(self.command[0])
+
+    def communicate(self, data: bytes | None = None):
         self.config.popen_inputs.append(data)
+        self.finish()
+        return None, None
+
+    def finish(self):
         if self.command[0] in self.config.popen_result:
             result = self.config.popen_result[self.command[0]]
             if isinstance(result, Exception):
                 raise result
             self.returncode = result
-        if self.command[0] == "cryptdisks_start":
+        if self.returncode != 0:
+            return
+        if self.command[0] == "cryptdisks_start" or self.command[:2] == [
+            "cryptsetup",
+            "open",
+        ]:
             self.config.prepare_device("luksed")
-        return None, None
+        elif self.command[0] == "mount":
+            self.config.fake_mount(self.command[-2][5:], self.command[-1])
+        elif self.command[0] == "umount":
+            self.config.fake_umount(self.command[-1])
 
 
 class FakeSMTP:
@@ -0,0 +1,290 @@
+import gzip
+import io
+import json
+import os
+import pathlib
+import shutil
+import tarfile
+import time
+import zlib
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+
+from udevbackup.chunkstore import ChunkStore
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+BLOCK_SIZE = 1024 * 1024
+VOLUME_SIZE = 1024 * 1024 * 1024
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+# archives are written as .<name>.partial, then renamed when they are complete
+PARTIAL_SUFFIX = ".partial"
+
+
+def compress_block(data: bytes, compression: str) -> bytes:
+    """Compress a block as an independent gzip member or zstd frame.
+
+    zlib and zstandard release the GIL, so blocks are compressed in parallel by threads.
+    """
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_block(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class ArchiveStats:
+    def __init__(self):
+        self.files: int = 0
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self.volumes: int = 0
+        self.elapsed: float = 0.0
+        self.errors: list[str] = []
+        self.warnings: list[str] = []
+        # stopped by `should_stop`: the index is not written
+        self.interrupted: bool = False
+
+    def report(self) -> list[str]:
+        elapsed = max(self.elapsed, 1e-6)
+        return [
+            f"{self.files} files in {self.volumes} volumes, {self.elapsed:.1f} s.",
+            f"{self.bytes_in / 1e6:.1f} MB in ({self.bytes_in / elapsed / 1e6:.1f} MB/s), "
+            f"{self.bytes_out / 1e6:.1f} MB out ({self.bytes_out / elapsed / 1e6:.1f} MB/s), "
+            f"ratio {self.bytes_in / max(self.bytes_out, 1):.2f}.",
+        ]
+
+
+class SizedReader:
+    """Read exactly `size` bytes of a file that may change while it is archived.
+
+    The tar header already gives the size of the file: a file that shrinks (or that
+    cannot be read anymore) is padded with zeros, a file that grows is truncated.
+    """
+
+    def __init__(self, fd, size: int):
+        self.fd = fd
+        self.remaining: int = size
+        self.padded: int = 0
+        self.error: OSError | None = None
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = b""
+        if not self.padded:
+            try:
+                data = self.fd.read(size)
+            except OSError as e:
+                self.error = e
+        if len(data) < size:
+            self.padded += size - len(data)
+            data += bytes(size - len(data))
+        self.remaining -= size
+        return data
+
+
+class BlockWriter(io.RawIOBase):
+    """File object receiving the tar stream, compressed by blocks into volumes.
+
+    Blocks are compressed by a thread pool and written in order; the concatenation of
+    the volumes is a valid .tar.gz (or .tar.zst) stream.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        compression: str,
+        workers: int,
+        block_size: int = BLOCK_SIZE,
+        volume_size: int = VOLUME_SIZE,
+    ):
+        super().__init__()
+        self.directory: pathlib.Path = directory
+        self.compression: str = compression
+        self.block_size: int = block_size
+        self.volume_size: int = volume_size
+        # volume, offset in the volume, compressed size, offset in the tar stream, size
+        self.blocks: list[tuple[int, int, int, int, int]] = []
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._pending: deque[tuple[Future, int, int]] = deque()
+        self._max_pending: int = max(workers, 1) * 2
+        self._volume_number: int = -1
+        self._volume_fd = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self.submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def submit(self, data: bytes):
+        future = self._executor.submit(compress_block, data, self.compression)
+        self._pending.append((future, self.bytes_in, len(data)))
+        self.bytes_in += len(data)
+        while len(self._pending) > self._max_pending:
+            self.write_block()
+
+    def write_block(self):
+        future, offset, length = self._pending.popleft()
+        data = future.result()
+        if self._volume_fd is None or self._volume_fd.tell() >= self.volume_size:
+            self.close_volume()
+            self._volume_number += 1
+            self._volume_fd = open(self.volume_path(self._volume_number), "wb")
+        self.blocks.append(
+            (self._volume_number, self._volume_fd.tell(), len(data), offset, length)
+        )
+        self._volume_fd.write(data)
+        self.bytes_out += len(data)
+
+    def volume_path(self, number: int) -> pathlib.Path:
+        suffix = COMPRESSIONS[self.compression]
+        return self.directory / f"volume-{number:04d}.tar{suffix}"
+
+    def close_volume(self):
+        if self._volume_fd is not None:
+            self._volume_fd.flush()
+            os.fsync(self._volume_fd.fileno())
+            self._volume_fd.close()
+            self._volume_fd = None
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self.submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self.write_block()
+            self.close_volume()
+        finally:
+            self._executor.shutdown()
+            super().close()
+
+    @property
+    def volumes(self) -> int:
+        return self._volume_number + 1
+
+
+def create_archive(
+    sources: list[str],
+    directory: pathlib.Path,
+    compression: str = "gzip",
+    workers: int = 1,
+    block_size: int = BLOCK_SIZE,
+    volume_size: int = VOLUME_SIZE,
+    should_stop: Callable[[], bool] | None = None,
+) -> ArchiveStats:
+    """Write the sources as tar volumes in the directory, with an index.
+
+    The archive is written in a hidden directory, renamed once the index is written:
+    an interrupted archive is never taken for a complete one, and is removed by the
+    next call. The archive stops as soon as `should_stop` returns True.
+    """
+    should_stop = should_stop or (lambda: False)
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Invalid compression {compression}")
+    start_time = time.monotonic()
+    stats = ArchiveStats()
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    for path in directory.parent.glob(f".*{PARTIAL_SUFFIX}"):
+        shutil.rmtree(path)
+    partial = directory.with_name(f".{directory.name}{PARTIAL_SUFFIX}")
+    partial.mkdir()
+    writer = BlockWriter(partial, compression, workers, block_size, volume_size)
+    files = []
+    try:
+        with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for path, st in ChunkStore.walk(sources):
+                if should_stop():
+                    stats.interrupted = True
+                    break
+                try:
+                    tarinfo = tar.gettarinfo(path)
+                    is_file = tarinfo is not None and tarinfo.isreg()
+                    fd = open(path, "rb") if is_file else nullcontext()
+                except OSError as e:
+                    stats.errors.append(f"Unable to read {path} ({e}).")
+                    continue
+                if tarinfo is None:  # socket
+                    continue
+                reader = SizedReader(fd, tarinfo.size) if is_file else None
+                with fd:
+                    tar.addfile(tarinfo, reader)
+                if is_file:
+                    stats.files += 1
+                    padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    entry = {
+                        "path": tarinfo.name,
+                        "size": tarinfo.size,
+                        "mtime": tarinfo.mtime,
+                        "offset": tar.offset - padded,
+                    }
+                    if reader.padded:
+                        entry["padded"] = reader.padded
+                        reason = f" ({reader.error})" if reader.error else ""
+                        stats.warnings.append(
+                            f"{path} shrank while it was archived{reason}: "
+                            f"{reader.padded} bytes padded with zeros."
+                        )
+                    files.append(entry)
+    finally:
+        writer.close()
+    stats.elapsed = time.monotonic() - start_time
+    if stats.interrupted:
+        return stats
+    index = {"compression": compression, "blocks": writer.blocks, "files": files}
+    with gzip.open(partial / "index.json.gz", "wt", encoding="utf-8") as fd:
+        json.dump(index, fd)
+    partial.rename(directory)
+    stats.bytes_in = writer.bytes_in
+    stats.bytes_out = writer.bytes_out
+    stats.volumes = writer.volumes
+    return stats
+
+
+class ArchiveReader:
+    """Restore single files of an archive, reading only the blocks containing them."""
+
+    def __init__(self, directory: str | pathlib.Path):
+        self.directory: pathlib.Path = pathlib.Path(directory)
+        with gzip.open(self.directory / "index.json.gz", "rt", encoding="utf-8") as fd:
+            index = json.load(fd)
+        self.compression: str = index["compression"]
+        self.blocks: list[list[int]] = index["blocks"]
+        self.files: dict[str, dict] = {x["path"]: x for x in index["files"]}
+
+    def volume_path(self, number: int) -> pathlib.Path:
+        suffix = COMPRESSIONS[self.compression]
+        return self.directory / f"volume-{number:04d}.tar{suffix}"
+
+    def read_file(self, path: str) -> Iterator[bytes]:
+        entry = self.files[path.lstrip("/")]
+        start, end = entry["offset"], entry["offset"] + entry["size"]
+        for volume, offset, length, data_offset, data_length in self.blocks:
+            if data_offset + data_length <= start or data_offset >= end:
+                continue
+            with open(self.volume_path(volume), "rb") as fd:
+                data = decompress_block(
+                    os.pread(fd.fileno(), length, offset), self.compression
+                )
+            yield data[max(start - data_offset, 0) : end - data_offset]
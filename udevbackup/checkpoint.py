@@ -0,0 +1,51 @@
+import datetime
+import json
+import os
+import pathlib
+
+
+class Checkpoint:
+    """Progress of an interrupted run, stored at the root of the target file system.
+
+    Native engines store a JSON dict; scripts can write anything in this file (its path
+    is given by the UDEVBACKUP_STATE environment variable).
+    When it is a JSON dict, its "done_bytes" key is the amount of work already done.
+    The file is removed at the end of a successful run.
+    """
+
+    def __init__(self, path: str | pathlib.Path):
+        self.path: pathlib.Path = pathlib.Path(path)
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def load(self) -> dict | None:
+        """Return the content of the checkpoint, if it is a JSON dict."""
+        try:
+            with self.path.open("r", encoding="utf-8") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    def save(self, data: dict):
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as fd:
+            json.dump(data, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def describe(self) -> str:
+        mtime = datetime.datetime.fromtimestamp(self.path.stat().st_mtime)
+        text = f"checkpoint of {mtime:%Y-%m-%d %H:%M:%S}"
+        data = self.load()
+        if data and isinstance(data.get("done_bytes"), int):
+            text += f", {data['done_bytes'] / 1e6:.1f} MB already done"
+        return text
@@ -0,0 +1,419 @@
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import pathlib
+import stat
+import struct
+import time
+from collections.abc import Callable, Iterator
+from contextlib import nullcontext
+
+from udevbackup.checkpoint import Checkpoint
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+MASK64 = (1 << 64) - 1
+# random values of the gear hash, derived from a fixed seed to be stable between runs
+GEAR = [
+    int.from_bytes(hashlib.sha256(b"udevbackup-gear-%d" % i).digest()[:8], "little")
+    for i in range(256)
+]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+# index record: sha256 digest, pack number, offset, length
+INDEX_RECORD = struct.Struct("<32sIQI")
+PACK_SIZE = 256 * 1024 * 1024
+# minimum time (in seconds) between two checkpoints of an interrupted backup
+CHECKPOINT_INTERVAL = 60.0
+
+
+def window_hashes(data, begin: int, end: int):
+    """Return the gear hashes of the positions `begin` to `end` of `data` (numpy).
+
+    The hash of position i only depends on the 64 bytes ending at i:
+    H64(i) = sum(GEAR[data[i - k]] << k for k < 64), computed in 6 vectorized steps
+    with H2m(i) = Hm(i) + (Hm(i - m) << m).
+    """
+    offset = min(begin, 63)
+    values = numpy.frombuffer(
+        data, dtype=numpy.uint8, count=end - begin + offset, offset=begin - offset
+    )
+    hashes = GEAR_ARRAY[values]
+    width = 1
+    while width < 64:
+        hashes[width:] += hashes[:-width] << numpy.uint64(width)
+        width *= 2
+    return hashes[offset:]
+
+
+def cut_points(data, min_size: int, avg_size: int, max_size: int) -> list[int]:
+    """Return the end offsets of the content-defined chunks of `data`.
+
+    A chunk ends after a position whose gear hash (of the last 64 bytes) has its highest
+    bits set to 0 (so after `avg_size` bytes on average), at least `min_size` bytes
+    after its start. Since the hash only depends on the last 64 bytes, inserting data in
+    a file only changes the chunks around the insertion.
+    The hashes are computed by numpy when it is installed (much faster), by a pure
+    Python loop otherwise; both give the same chunks.
+    """
+    bits = max(avg_size.bit_length() - 1, 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+    find_cut = find_cut_python if numpy is None else find_cut_numpy
+    cuts = []
+    start = 0
+    length = len(data)
+    while start < length:
+        end = min(start + max_size, length)
+        cut = find_cut(data, start + min_size, end, mask)
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+
+def find_cut_python(data, begin: int, end: int, mask: int) -> int:
+    gear = GEAR
+    h = 0
+    for i in range(max(begin - 63, 0), end):
+        h = ((h << 1) + gear[data[i]]) & MASK64
+        if i >= begin and not h & mask:
+            return i + 1
+    return end
+
+
+def find_cut_numpy(data, begin: int, end: int, mask: int) -> int:
+    # candidates are searched by blocks: most chunks end long before max_size
+    step = 64 * 1024
+    while begin < end:
+        stop = min(begin + step, end)
+        hashes = window_hashes(data, begin, stop)
+        positions = numpy.flatnonzero((hashes & numpy.uint64(mask)) == 0)
+        if positions.size:
+            return begin + int(positions[0]) + 1
+        begin = stop
+        step *= 2
+    return end
+
+
+def chunk_file(args: tuple[str, int, int, int]) -> tuple[str, list | str]:
+    """Split a file into chunks, return their digests, offsets and lengths.
+
+    Run in worker processes; return an error message if the file cannot be read.
+    """
+    path, min_size, avg_size, max_size = args
+    chunks = []
+    try:
+        with open(path, "rb") as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                return path, chunks
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                start = 0
+                for cut in cut_points(data, min_size, avg_size, max_size):
+                    digest = hashlib.sha256(data[start:cut]).hexdigest()
+                    chunks.append((digest, start, cut - start))
+                    start = cut
+    except (OSError, ValueError) as e:
+        return path, str(e)
+    return path, chunks
+
+
+class BackupStats:
+    def __init__(self):
+        self.files: int = 0
+        self.unchanged_files: int = 0
+        self.resumed_files: int = 0
+        self.resumed_bytes: int = 0
+        self.bytes_read: int = 0
+        self.bytes_total: int = 0
+        self.new_chunks: int = 0
+        self.new_bytes: int = 0
+        self.elapsed: float = 0.0
+        self.errors: list[str] = []
+        self.warnings: list[str] = []
+        # stopped by `should_stop`: no snapshot is written
+        self.interrupted: bool = False
+
+    @property
+    def dedup_ratio(self) -> float:
+        return self.bytes_read / max(self.new_bytes, 1)
+
+    def report(self) -> list[str]:
+        mbps = self.bytes_read / max(self.elapsed, 1e-6) / 1e6
+        lines = []
+        if self.resumed_files:
+            lines.append(
+                f"{self.resumed_files} files ({self.resumed_bytes / 1e6:.1f} MB) "
+                "already stored by the interrupted run."
+            )
+        return lines + [
+            f"{self.files} files ({self.bytes_total / 1e6:.1f} MB), "
+            f"{self.unchanged_files} unchanged.",
+            f"{self.bytes_read / 1e6:.1f} MB chunked in {self.elapsed:.1f} s "
+            f"({mbps:.1f} MB/s).",
+            f"{self.new_chunks} new chunks ({self.new_bytes / 1e6:.1f} MB stored), "
+            f"dedup ratio: {self.dedup_ratio:.2f}.",
+        ]
+
+
+class ChunkStore:
+    """Deduplicating store: each unique chunk is stored once, in pack files.
+
+    Layout of the store directory:
+      * packs/<n>.pack: concatenated chunks,
+      * index.bin: location of each chunk (fixed-size records, appended after packs
+        are synced, so a chunk in the index is always in its pack),
+      * snapshots/<date>.json.gz: files of each run, with their list of chunks.
+    """
+
+    def __init__(
+        self,
+        root: str | pathlib.Path,
+        avg_size: int = 1024 * 1024,
+        pack_size: int = PACK_SIZE,
+        checkpoint_interval: float = CHECKPOINT_INTERVAL,
+    ):
+        self.root: pathlib.Path = pathlib.Path(root)
+        self.avg_size: int = avg_size
+        self.min_size: int = avg_size // 2
+        self.max_size: int = avg_size * 4
+        self.pack_size: int = pack_size
+        self.checkpoint_interval: float = checkpoint_interval
+        self.index: dict[str, tuple[int, int, int]] = {}
+        self._new_records: list[bytes] = []
+        self._pack_number: int = 0
+        self._pack_fd = None
+
+    def load_index(self):
+        self.index = {}
+        try:
+            content = (self.root / "index.bin").read_bytes()
+        except FileNotFoundError:
+            return
+        end = len(content) - len(content) % INDEX_RECORD.size
+        for digest, pack, offset, length in INDEX_RECORD.iter_unpack(content[:end]):
+            self.index[digest.hex()] = (pack, offset, length)
+
+    def snapshots(self) -> list[str]:
+        directory = self.root / "snapshots"
+        if not directory.is_dir():
+            return []
+        return sorted(x.name[:-8] for x in directory.glob("*.json.gz"))
+
+    def load_snapshot(self, name: str) -> list[dict]:
+        with gzip.open(self.root / "snapshots" / f"{name}.json.gz", "rt") as fd:
+            return json.load(fd)
+
+    def backup(
+        self,
+        sources: list[str],
+        name: str,
+        workers: int = 0,
+        checkpoint: Checkpoint | None = None,
+        should_stop: Callable[[], bool] | None = None,
+    ) -> BackupStats:
+        """Store the sources and write the snapshot `name`.
+
+        Files are chunked by `workers` processes (in this process if 0), while this
+        process writes the new chunks to the packs.
+        The stored files are regularly committed and saved to `checkpoint`, so an
+        interrupted backup does not store them again.
+        The backup stops as soon as `should_stop` returns True (like when the disk is
+        removed), without writing the snapshot.
+        """
+        should_stop = should_stop or (lambda: False)
+        start_time = time.monotonic()
+        stats = BackupStats()
+        for directory in ("packs", "snapshots"):
+            (self.root / directory).mkdir(parents=True, exist_ok=True)
+        self.load_index()
+        previous = {}
+        if snapshots := self.snapshots():
+            previous = {x["path"]: x for x in self.load_snapshot(snapshots[-1])}
+        resumed = set()
+        if checkpoint and (data := checkpoint.load()):
+            for entry in data.get("files", []):
+                previous[entry["path"]] = entry
+                resumed.add(entry["path"])
+        entries = []
+        done = []
+        to_chunk = {}
+        for path, st in self.walk(sources):
+            if should_stop():
+                stats.interrupted = True
+                return stats
+            entry = {"path": path, "mode": st.st_mode, "mtime_ns": st.st_mtime_ns}
+            entries.append(entry)
+            if stat.S_ISLNK(st.st_mode):
+                entry["link"] = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                stats.files += 1
+                stats.bytes_total += st.st_size
+                entry["size"] = st.st_size
+                old = previous.get(path)
+                if (
+                    old
+                    and old.get("size") == st.st_size
+                    and old["mtime_ns"] == st.st_mtime_ns
+                    and all(x in self.index for x in old["chunks"])
+                ):
+                    entry["chunks"] = old["chunks"]
+                    if path in resumed:
+                        stats.resumed_files += 1
+                        stats.resumed_bytes += st.st_size
+                        done.append(entry)
+                    else:
+                        stats.unchanged_files += 1
+                else:
+                    to_chunk[path] = entry
+        args = [(x, self.min_size, self.avg_size, self.max_size) for x in to_chunk]
+        last_checkpoint = time.monotonic()
+        try:
+            # not forked: this process has several threads (status, outputs…)
+            context = multiprocessing.get_context("forkserver")
+            with context.Pool(workers) if workers > 0 else nullcontext() as pool:
+                results = pool.imap(chunk_file, args) if pool else map(chunk_file, args)
+                for result in results:
+                    if should_stop():
+                        stats.interrupted = True
+                        break
+                    if self.store_file(result, to_chunk, stats, previous):
+                        done.append(to_chunk[result[0]])
+                    now = time.monotonic()
+                    if checkpoint and now - last_checkpoint >= self.checkpoint_interval:
+                        self.save_checkpoint(checkpoint, name, done)
+                        last_checkpoint = now
+            if not stats.interrupted:
+                self.commit()
+        finally:
+            self.close_pack()
+        stats.elapsed = time.monotonic() - start_time
+        if stats.interrupted:
+            return stats
+        entries = [x for x in entries if "chunks" in x or "size" not in x]
+        self.write_snapshot(name, entries)
+        return stats
+
+    @staticmethod
+    def walk(sources: list[str]) -> Iterator[tuple[str, os.stat_result]]:
+        for source in sources:
+            source = os.path.abspath(source)
+            yield source, os.lstat(source)
+            if os.path.islink(source):
+                continue
+            for dirpath, dirnames, filenames in os.walk(source):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        yield path, os.lstat(path)
+                    except OSError:
+                        continue
+
+    def save_checkpoint(self, checkpoint: Checkpoint, name: str, done: list[dict]):
+        """Commit the new chunks, then save the files that are completely stored."""
+        self.commit()
+        done_bytes = sum(x["size"] for x in done)
+        checkpoint.save({"snapshot": name, "done_bytes": done_bytes, "files": done})
+
+    def store_file(
+        self,
+        result: tuple[str, list | str],
+        entries: dict,
+        stats,
+        previous: dict | None = None,
+    ) -> bool:
+        """Write the new chunks of a file; return False if it is not completely stored.
+
+        A file modified since it has been chunked keeps its version of the `previous`
+        snapshot (if any), like rsync and tar do.
+        """
+        path, chunks = result
+        if isinstance(chunks, str):
+            stats.errors.append(f"Unable to read {path} ({chunks}).")
+            return False
+        try:
+            with open(path, "rb") as fd:
+                for digest, offset, length in chunks:
+                    stats.bytes_read += length
+                    if digest in self.index:
+                        continue
+                    data = os.pread(fd.fileno(), length, offset)
+                    # the file may have been modified since it has been chunked
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        old = (previous or {}).get(path)
+                        if self.keep_previous(entries[path], old):
+                            kept = "its previous version is kept"
+                        else:
+                            kept = "it is not stored"
+                        stats.warnings.append(
+                            f"{path} has been modified during the backup: {kept}."
+                        )
+                        return False
+                    self.write_chunk(digest, data)
+                    stats.new_chunks += 1
+                    stats.new_bytes += length
+        except OSError as e:
+            stats.errors.append(f"Unable to read {path} ({e}).")
+            return False
+        entries[path]["chunks"] = [x[0] for x in chunks]
+        return True
+
+    def keep_previous(self, entry: dict, old: dict | None) -> bool:
+        """Record the previous version of the file in `entry`, if it is still stored."""
+        if not old or "chunks" not in old:
+            return False
+        if not all(x in self.index for x in old["chunks"]):
+            return False
+        entry.update(size=old["size"], mtime_ns=old["mtime_ns"], chunks=old["chunks"])
+        return True
+
+    def write_chunk(self, digest: str, data: bytes):
+        if self._pack_fd is None or self._pack_fd.tell() >= self.pack_size:
+            self.close_pack()
+            existing = sorted((self.root / "packs").glob("*.pack"))
+            self._pack_number = int(existing[-1].stem) + 1 if existing else 0
+            path = self.root / "packs" / f"{self._pack_number:08d}.pack"
+            self._pack_fd = open(path, "ab")
+        offset = self._pack_fd.tell()
+        self._pack_fd.write(data)
+        self.index[digest] = (self._pack_number, offset, len(data))
+        self._new_records.append(
+            INDEX_RECORD.pack(
+                bytes.fromhex(digest), self._pack_number, offset, len(data)
+            )
+        )
+
+    def close_pack(self):
+        if self._pack_fd is not None:
+            self._pack_fd.flush()
+            os.fsync(self._pack_fd.fileno())
+            self._pack_fd.close()
+            self._pack_fd = None
+
+    def commit(self):
+        """Make the new chunks visible once they are safely written to the packs."""
+        self.close_pack()
+        if not self._new_records:
+            return
+        with open(self.root / "index.bin", "ab") as fd:
+            fd.write(b"".join(self._new_records))
+            fd.flush()
+            os.fsync(fd.fileno())
+        self._new_records = []
+
+    def write_snapshot(self, name: str, entries: list[dict]):
+        path = self.root / "snapshots" / f"{name}.json.gz"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as fd:
+            json.dump(entries, fd)
+        os.replace(tmp_path, path)
+
+    def read_file(self, entry: dict) -> Iterator[bytes]:
+        """Yield the content of a file of a snapshot."""
+        for digest in entry.get("chunks", []):
+            pack, offset, length = self.index[digest]
+            with open(self.root / "packs" / f"{pack:08d}.pack", "rb") as fd:
+                yield os.pread(fd.fileno(), length, offset)
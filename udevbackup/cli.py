@@ -1,38 +1,298 @@
 import argparse
 import glob
+import json
 import os
+import pathlib
 import shlex
+import signal
 import subprocess  # nosec B404
 import sys
+import threading
+import time
 from configparser import ConfigParser
-from logging import ERROR, INFO
+from logging import ERROR, INFO, NOTSET, getLevelName
 
 from systemlogger import getLogger
 from termcolor import cprint
 
+from udevbackup.history import format_duration
+from udevbackup.journal import Watcher
+from udevbackup.logs import parse_time, read_lines_backwards, read_records
+from udevbackup.removal import mark_removed
 from udevbackup.rule import Config, Rule, get_command
+from udevbackup.status import read_statuses
 
 logger = getLogger(name="udevbackup", extra_tags={"application_fqdn": "system"})
 
 
-def load_config(config_dir):
-    """Load the configuration."""
-    config_filenames = glob.glob(f"{config_dir}/*.ini")
+# drop-in files of the devices, named by the UUID of their rules
+DEVICES_DIR = "devices.d"
+
+
+def read_config(filenames: list[str]) -> ConfigParser:
     parser = ConfigParser(interpolation=None)
-    parser.read(config_filenames, encoding="utf-8")
-    ini_config_section = Config.ini_section_name
-    kwargs = Config.load(parser, ini_config_section)
-    config = Config(**kwargs)
+    parser.read(filenames, encoding="utf-8")
+    return parser
+
+
+def get_device_filenames(config_dir, uuids: set[str] | None = None) -> list[str]:
+    """Return the drop-in files of the given UUIDs (all of them if `uuids` is None)."""
+    if uuids is None:
+        return sorted(glob.glob(f"{config_dir}/{DEVICES_DIR}/*.ini"))
+    filenames = [os.path.join(config_dir, DEVICES_DIR, f"{x}.ini") for x in uuids]
+    return sorted(x for x in filenames if os.path.isfile(x))
+
+
+def load_rules(config: Config, parser: ConfigParser, sections: set[str] | None = None):
     for section in parser.sections():
-        if section == ini_config_section:
+        if section == Config.ini_section_name:
+            continue
+        if sections is not None and section not in sections:
             continue
         kwargs = Rule.load(parser, section)
         rule = Rule(config, section, **kwargs)
         config.register(rule)
+
+
+def load_config(config_dir, fs_uuid: str | None = None):
+    """Load the configuration.
+
+    When `fs_uuid` is given, only the drop-in files of the connected devices are read,
+    so the time to handle an event does not depend on the number of devices. All files
+    are read if one of these rules belongs to a fan-out group. The drop-in files of
+    devices connected later can be read with `config.load_drop_ins(uuids)`.
+    """
+    main_filenames = sorted(glob.glob(f"{config_dir}/*.ini"))
+    parser = read_config(main_filenames)
+    kwargs = Config.load(parser, Config.ini_section_name)
+    config = Config(**kwargs)
+    config.config_dir = str(config_dir)
+    uuids = None
+    if fs_uuid:
+        uuids = {fs_uuid} | set(config.get_connected_uuids())
+    device_filenames = get_device_filenames(config_dir, uuids)
+    load_rules(config, read_config(main_filenames + device_filenames))
+    if uuids is not None and any(x.fanout for x in config.rules.values()):
+        config.rules.clear()
+        device_filenames = get_device_filenames(config_dir)
+        load_rules(config, read_config(main_filenames + device_filenames))
+    elif uuids is not None:
+
+        def load_drop_ins(new_uuids: set[str]):
+            filenames = get_device_filenames(config_dir, new_uuids - uuids)
+            uuids.update(new_uuids)
+            if not filenames:
+                return
+            # sections of the main files are already loaded
+            sections = set(read_config(filenames).sections())
+            load_rules(config, read_config(main_filenames + filenames), sections)
+            config.identify_cryptodevices()
+
+        config.load_drop_ins = load_drop_ins
     config.identify_cryptodevices()
     return config
 
 
+def check_config(config_dir) -> list[str]:
+    """Check that the rules of all files can be found when a device is connected."""
+    try:
+        load_config(config_dir)
+    except ValueError as e:
+        return [str(e)]
+    errors = []
+    sections: dict[str, str] = {}
+    uuids: dict[str, str] = {}
+    fanouts: dict[str, list[tuple[str, str, str]]] = {}
+    main_filenames = sorted(glob.glob(f"{config_dir}/*.ini"))
+    for filename in main_filenames + get_device_filenames(config_dir):
+        parser = read_config([filename])
+        drop_in_uuid = None
+        if os.path.dirname(filename).endswith(DEVICES_DIR):
+            drop_in_uuid = os.path.basename(filename)[:-4]
+        for section in parser.sections():
+            if section in sections:
+                errors.append(
+                    f"[{section}] is defined in {sections[section]} and {filename}."
+                )
+            sections[section] = filename
+            if section == Config.ini_section_name:
+                if drop_in_uuid:
+                    errors.append(f"[{section}] is ignored in {filename}.")
+                continue
+            kwargs = Rule.load(parser, section)
+            uuid = kwargs.get("luks_uuid") or kwargs["fs_uuid"]
+            if uuid in uuids:
+                errors.append(
+                    f"[{section}] and [{uuids[uuid]}] are both defined for {uuid}."
+                )
+            uuids[uuid] = section
+            if kwargs.get("fanout"):
+                fanouts.setdefault(kwargs["fanout"], []).append(
+                    (section, kwargs.get("engine", "script"), kwargs.get("sources", ""))
+                )
+            if drop_in_uuid and uuid != drop_in_uuid:
+                errors.append(
+                    f"[{section}] is defined for {uuid} but in {filename}: "
+                    "it is ignored when the device is connected."
+                )
+    for fanout, members in fanouts.items():
+        engines = {x[1] for x in members}
+        if "mirror" in engines and (
+            len(engines) > 1 or len({x[2] for x in members}) > 1
+        ):
+            errors.append(
+                f"The rules of the fan-out group {fanout} "
+                f"({', '.join(x[0] for x in members)}) must all use the mirror engine "
+                "with the same sources: the sources are read once for all disks."
+            )
+    return errors
+
+
+def show_queue(config: Config):
+    """Display the running and waiting jobs."""
+    jobs = config.job_queue.jobs()
+    if not jobs:
+        cprint("No queued job.", "green", file=sys.stdout)
+    now = time.time()
+    for job in jobs:
+        if job["state"] == "running":
+            waited = format_duration(job["started_at"] - job["enqueued_at"])
+            text = f"running for {format_duration(now - job['started_at'])}"
+            text += f" (waited {waited})"
+            color = "yellow"
+        else:
+            text = f"waiting for {format_duration(now - job['enqueued_at'])}"
+            color = "green"
+        cprint(
+            f"{job['id']} [priority {job['priority']}] {job['name']} "
+            f"({job['uuid']}): {text}",
+            color,
+            file=sys.stdout,
+        )
+
+
+def show_status(run_dir: str, as_json: bool = False):
+    """Display the status of the running rules, without loading the configuration."""
+    statuses = read_statuses(pathlib.Path(run_dir) / "status")
+    if as_json:
+        print(json.dumps(statuses), file=sys.stdout)
+        return
+    if not statuses:
+        cprint("No running backup.", "green", file=sys.stdout)
+    now = time.time()
+    for status in statuses:
+        text = (
+            f"{status['rule']} ({status['uuid']}): {status['phase']} for "
+            f"{format_duration(now - status['phase_started_at'])} "
+            f"(started {format_duration(now - status['started_at'])} ago)"
+        )
+        if status.get("child_pid"):
+            text += f", pid {status['child_pid']}"
+        text += f", {status.get('bytes_written', 0) / 1e6:.1f} MB written"
+        cprint(text, "green", file=sys.stdout)
+        if status.get("last_line"):
+            cprint(f"  {status['last_line']}", file=sys.stdout)
+
+
+def show_logs(config: Config, args: argparse.Namespace) -> int:
+    """Display the last messages of the log file, filtered by rule, level and time."""
+    if config.log_format != "json":
+        if args.rule or args.level or args.since or args.until:
+            cprint("Filters require log_format = json.", "red", file=sys.stderr)
+            return 10
+        try:
+            lines = read_lines_backwards(config.log_path)
+            lines = [x for __, x in zip(range(args.lines), lines)]
+        except OSError:
+            lines = []
+        for line in reversed(lines):
+            print(line.decode(errors="replace"), file=sys.stdout)
+        return 0
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+    except ValueError as e:
+        cprint(str(e), "red", file=sys.stderr)
+        return 10
+    records = read_records(
+        config.log_path,
+        config.log_backups,
+        rule=args.rule,
+        level=getLevelName(args.level.upper()) if args.level else NOTSET,
+        since=since,
+        until=until,
+        limit=args.lines,
+    )
+    colors = {"ERROR": "red", "CRITICAL": "red", "WARNING": "yellow"}
+    for record in records:
+        if args.json:
+            print(json.dumps(record), file=sys.stdout)
+            continue
+        text = f"{record['time']} {record['run_id']} {record['level']}"
+        if record.get("rule"):
+            text += f" [{record['rule']}"
+            text += f"/{record['phase']}]" if record.get("phase") else "]"
+        text += f" {record['message']}"
+        if record.get("duration") is not None:
+            text += f" ({format_duration(record['duration'])})"
+        cprint(text, colors.get(record["level"], "green"), file=sys.stdout)
+    return 0
+
+
+def watch(config: Config) -> int:
+    """Record the changes of the sources until SIGTERM or SIGINT is received."""
+    sources = sorted(
+        {x for rule in config.rules.values() if rule.journal for x in rule.sources}
+    )
+    if not sources:
+        cprint("No rule with journal = 1.", "red", file=sys.stderr)
+        return 9
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    logger.log(INFO, f"Watching {', '.join(sources)}.")
+    Watcher(config.state_dir, sources).run(should_stop=stop.is_set)
+    return 0
+
+
+def schedule_run(args: argparse.Namespace) -> int:
+    """Launch the run through `at`, so the udev event is handled immediately."""
+    return_code = 0
+    if not args.fs_uuid:
+        cprint(
+            "No filesystem uuid provided: use --fs-uuid or set the ID_FS_UUID environment variable",
+            "red",
+            file=sys.stderr,
+        )
+
+        logger.log(
+            ERROR,
+            "No filesystem uuid provided: use --fs-uuid or set the ID_FS_UUID environment variable",
+        )
+        return_code = 1
+    else:
+        cmd = get_command() + [
+            "run",
+            "--fs-uuid",
+            args.fs_uuid,
+            "-C",
+            args.config_dir,
+        ]
+        at_cmd = shlex.join(cmd)
+        logger.log(INFO, at_cmd)
+        cmd = ["at", "now"]
+        try:
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE)  # nosec B603 B607
+            p.communicate(at_cmd.encode())
+            if p.returncode != 0:
+                logger.log(ERROR, f"Failed to run `{' '.join(cmd)}` command)")
+                return_code = 2
+        except FileNotFoundError:
+            logger.log(ERROR, "Command not found: 'at'")
+            return_code = 3
+    return return_code
+
+
 def main(args: list[str] | None = None):
     """Run the scripts, should be launched by an udev rule."""
     parser = argparse.ArgumentParser(
@@ -40,13 +300,35 @@ def main(args: list[str] | None = None):
     )
     parser.add_argument(
         "command",
-        choices=("show", "run", "example", "at", "install"),
+        choices=(
+            "show",
+            "check",
+            "run",
+            "example",
+            "at",
+            "install",
+            "flush",
+            "queue",
+            "status",
+            "watch",
+            "logs",
+            "removed",
+            "close",
+        ),
         help="""command to run.
                         show: show the loaded configuration.
+                        check: check the configuration (all files, including devices.d/*.ini).
                         run: run the script for the given filesystem uuid (/dev/disk/by-uuid/XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX).
                         example: show a example of config file.
                         at: launch this script through `at` and immediately exits.
                         install: install the udev rule.
+                        flush: send the e-mails waiting in the spool directory.
+                        queue: show the jobs waiting for the lock file (see --cancel and --priority).
+                        status: show the progress of the running backups (see --run-dir).
+                        watch: record the changes of the sources of the rules with journal = 1 (runs until stopped).
+                        removed: stop the run of a removed device (called by the udev rule).
+                        close: unmount the disks left open by keep_open once expired (all of them with --all).
+                        logs: show the last messages of the log file (see --rule, --level, --since, --until and --lines).
                         """,
     )
     parser.add_argument(
@@ -61,10 +343,70 @@ def main(args: list[str] | None = None):
         default=os.environ.get("ID_FS_UUID"),
         help="If not specified, use the ID_FS_UUID environment variable.",
     )
+    parser.add_argument(
+        "--cancel",
+        metavar="JOB",
+        help="queue: remove this waiting job from the queue.",
+    )
+    parser.add_argument(
+        "--priority",
+        nargs=2,
+        metavar=("JOB", "PRIORITY"),
+        help="queue: change the priority of this job (higher ones run first).",
+    )
+    parser.add_argument(
+        "--run-dir",
+        default="/run/udevbackup",
+        help="status, removed: run_dir of the configuration (default: /run/udevbackup).",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="status, logs: display the status or the messages as JSON.",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="close: also close the sessions that are not expired.",
+    )
+    parser.add_argument("--rule", help="logs: only show the messages of this rule.")
+    parser.add_argument(
+        "--level",
+        choices=("debug", "info", "warning", "error"),
+        help="logs: only show the messages of this level or above.",
+    )
+    parser.add_argument(
+        "--since",
+        help="logs: only show the messages after this time (like 2024-01-31T12:00 or 2h).",
+    )
+    parser.add_argument(
+        "--until",
+        help="logs: only show the messages before this time (same format as --since).",
+    )
+    parser.add_argument(
+        "--lines",
+        "-n",
+        type=int,
+        default=50,
+        help="logs: number of messages to show (default: 50).",
+    )
     args = parser.parse_args(args=args)
+    if args.command == "status":
+        # must stay fast: the configuration is not loaded
+        show_status(args.run_dir, as_json=args.json)
+        return 0
+    if args.command == "removed":
+        # called by udev: must stay fast, the configuration is not loaded
+        if args.fs_uuid:
+            mark_removed(args.run_dir, args.fs_uuid)
+        return 0
+    if args.command == "at":
+        # called by udev: must stay fast, the configuration is not loaded
+        return schedule_run(args)
     return_code = 0  # 0 = success, != 0 = error
     try:
-        config = load_config(args.config_dir)
+        fs_uuid = args.fs_uuid if args.command == "run" else None
+        config = load_config(args.config_dir, fs_uuid=fs_uuid)
     except ValueError as e:
         logger.log(
             ERROR,
@@ -75,39 +417,14 @@ def main(args: list[str] | None = None):
         return_code = 1
     elif args.command == "show":
         config.show()
-    elif args.command == "at":
-        if not args.fs_uuid:
-            cprint(
-                "No filesystem uuid provided: use --fs-uuid or set the ID_FS_UUID environment variable",
-                "red",
-                file=sys.stderr,
-            )
-
-            logger.log(
-                ERROR,
-                "No filesystem uuid provided: use --fs-uuid or set the ID_FS_UUID environment variable",
-            )
-            return_code = 1
+    elif args.command == "check":
+        errors = check_config(args.config_dir)
+        for error in errors:
+            cprint(error, "red", file=sys.stderr)
+        if errors:
+            return_code = 7
         else:
-            cmd = get_command() + [
-                "run",
-                "--fs-uuid",
-                args.fs_uuid,
-                "-C",
-                args.config_dir,
-            ]
-            at_cmd = shlex.join(cmd)
-            logger.log(INFO, at_cmd)
-            cmd = ["at", "now"]
-            try:
-                p = subprocess.Popen(cmd, stdin=subprocess.PIPE)  # nosec B603 B607
-                p.communicate(at_cmd.encode())
-                if p.returncode != 0:
-                    logger.log(ERROR, f"Failed to run `{' '.join(cmd)}` command)")
-                    return_code = 2
-            except FileNotFoundError:
-                logger.log(ERROR, "Command not found: 'at'")
-                return_code = 3
+            cprint("The configuration is valid.", "green", file=sys.stdout)
     elif args.command == "run":
         if not args.fs_uuid:
             cprint(
@@ -123,10 +440,29 @@ def main(args: list[str] | None = None):
         else:
             logger.log(INFO, f"{args.fs_uuid} detected")
             return_code = 0 if config.run(args.fs_uuid) else 4
+    elif args.command == "queue":
+        queue = config.job_queue
+        if args.cancel and not queue.cancel(args.cancel):
+            cprint(f"Unable to cancel job {args.cancel}.", "red", file=sys.stderr)
+            return_code = 8
+        if args.priority and not queue.set_priority(
+            args.priority[0], int(args.priority[1])
+        ):
+            cprint(f"Unknown job {args.priority[0]}.", "red", file=sys.stderr)
+            return_code = 8
+        show_queue(config)
+    elif args.command == "watch":
+        return_code = watch(config)
+    elif args.command == "logs":
+        return_code = show_logs(config, args)
+    elif args.command == "close":
+        return_code = 0 if config.close_expired_sessions(close_all=args.all) else 11
+    elif args.command == "flush":
+        return_code = 0 if config.flush_spool() else 6
     elif args.command == "install":
         try:
             with open(Config.udev_rule_path, "w", encoding="utf-8") as f:
-                f.write(Config.udev_rule() + "\n")
+                f.write(Config.udev_rule(config.run_dir) + "\n")
             p = subprocess.Popen(["udevadm", "control", "--reload-rules"])
             p.communicate()
             cprint(
@@ -138,7 +474,9 @@ def main(args: list[str] | None = None):
             cprint(f"Unable to install udev rule: {e}.", "red", file=sys.stderr)
             return_code = 5
     elif args.command == "example":
-        Config.show_rule_file(stdout=sys.stdout, stderr=sys.stderr)
+        Config.show_rule_file(
+            stdout=sys.stdout, stderr=sys.stderr, run_dir=args.run_dir
+        )
         cprint(
             f"Create one or more .ini files in {args.config_dir}.",
             force_color=True,
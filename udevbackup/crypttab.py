@@ -0,0 +1,63 @@
+from typing import NamedTuple
+
+# crypttab options with an equivalent flag of `cryptsetup open`
+FLAGS = {
+    "discard": "--allow-discards",
+    "readonly": "--readonly",
+    "read-only": "--readonly",
+    "same-cpu-crypt": "--perf-same_cpu_crypt",
+    "submit-from-crypt-cpus": "--perf-submit_from_crypt_cpus",
+    "no-read-workqueue": "--perf-no_read_workqueue",
+    "no-write-workqueue": "--perf-no_write_workqueue",
+}
+VALUE_FLAGS = {
+    "keyfile-offset": "--keyfile-offset",
+    "keyfile-size": "--keyfile-size",
+    "header": "--header",
+    "tries": "--tries",
+    "key-slot": "--key-slot",
+    "cipher": "--cipher",
+    "size": "--key-size",
+    "hash": "--hash",
+    "offset": "--offset",
+    "skip": "--skip",
+}
+TYPES = {"luks", "plain", "bitlk", "tcrypt"}
+# options only used at boot, or by systemd
+IGNORED = {"noauto", "auto", "nofail", "_netdev", "initramfs", "timeout", "noearly"}
+
+
+class CrypttabEntry(NamedTuple):
+    name: str
+    device: str
+    key_file: str
+    options: list[str]
+
+    def cryptsetup_args(self) -> tuple[list[str], list[str]]:
+        """Return the arguments of `cryptsetup open` and the unsupported options."""
+        args = ["--type", "luks"]
+        unsupported = []
+        for option in self.options:
+            key, sep, value = option.partition("=")
+            if key in TYPES and not sep:
+                args[1] = key
+            elif key in FLAGS and not sep:
+                args.append(FLAGS[key])
+            elif key in VALUE_FLAGS and sep:
+                args += [VALUE_FLAGS[key], value]
+            elif key in IGNORED or key.startswith("x-"):
+                continue
+            else:
+                unsupported.append(option)
+        return args, unsupported
+
+
+def parse_entry(line: str) -> CrypttabEntry | None:
+    """Parse a line of /etc/crypttab (None for comments and incomplete lines)."""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    parts = line.split()
+    if len(parts) < 4:
+        return None
+    return CrypttabEntry(parts[0], parts[1], parts[2], parts[3].split(","))
@@ -0,0 +1,84 @@
+import pathlib
+from typing import NamedTuple
+
+# size of a sector in /sys/block/<dev>/stat, whatever the real sector size
+SECTOR_SIZE = 512
+
+
+class DeviceStat(NamedTuple):
+    """Cumulative I/O counters of a block device (see Documentation/block/stat.rst)."""
+
+    reads: int
+    read_sectors: int
+    writes: int
+    write_sectors: int
+    in_flight: int
+    io_ticks: int  # milliseconds
+    time_in_queue: int  # milliseconds
+
+    @classmethod
+    def parse(cls, fields: list[str]) -> "DeviceStat":
+        values = [int(x) for x in fields[:11]]
+        return cls(
+            reads=values[0],
+            read_sectors=values[2],
+            writes=values[4],
+            write_sectors=values[6],
+            in_flight=values[8],
+            io_ticks=values[9],
+            time_in_queue=values[10],
+        )
+
+
+def resolve_device(devices_root: pathlib.Path, fs_uuid: str) -> str | None:
+    """Return the kernel name of the device (like "sdc1" or "dm-0") of a file system."""
+    path = devices_root / "disk" / "by-uuid" / fs_uuid
+    if not path.exists():
+        return None
+    return path.resolve().name
+
+
+def read_device_stat(
+    sysfs_root: pathlib.Path, procfs_root: pathlib.Path, name: str
+) -> DeviceStat | None:
+    """Read the I/O counters of a device from sysfs, or from /proc/diskstats."""
+    try:
+        content = (sysfs_root / "class" / "block" / name / "stat").read_text()
+        return DeviceStat.parse(content.split())
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        content = (procfs_root / "diskstats").read_text()
+    except OSError:
+        return None
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) >= 14 and fields[2] == name:
+            return DeviceStat.parse(fields[3:])
+    return None
+
+
+def parent_device(sysfs_root: pathlib.Path, name: str) -> str:
+    """Return the name of the disk of a partition (like "sdc" for "sdc1")."""
+    path = sysfs_root / "class" / "block" / name
+    if (path / "partition").exists():
+        return path.resolve().parent.name
+    return name
+
+
+def device_numbers(sysfs_root: pathlib.Path, name: str) -> str | None:
+    """Return the "major:minor" numbers of a device."""
+    try:
+        return (sysfs_root / "class" / "block" / name / "dev").read_text().strip()
+    except OSError:
+        return None
+
+
+def partitions(sysfs_root: pathlib.Path, disk: str) -> list[str]:
+    """Return the names of the partitions of a disk."""
+    path = sysfs_root / "class" / "block" / disk
+    if not path.is_dir():
+        return []
+    return sorted(
+        x.name for x in path.resolve().iterdir() if (x / "partition").exists()
+    )
@@ -0,0 +1,65 @@
+import json
+import os
+import pathlib
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def scan_size(paths: list[str]) -> int:
+    """Return the total size of the regular files in the given directories."""
+    total_size = 0
+    stack = list(paths)
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total_size += entry.stat(follow_symlinks=False).st_size
+        except NotADirectoryError:
+            total_size += os.stat(path).st_size
+        except OSError:
+            continue
+    return total_size
+
+
+class RunHistory:
+    """History of the runs on a file system, stored in a JSON file of the state dir.
+
+    Each entry is a dict, with at least "date", "success", "duration" (in seconds) and
+    "written" (bytes written on the file system by the script).
+    """
+
+    max_entries = 100
+
+    def __init__(self, state_dir: str | pathlib.Path, fs_uuid: str):
+        self.path: pathlib.Path = pathlib.Path(state_dir) / f"{fs_uuid}.json"
+
+    def load(self) -> list[dict]:
+        try:
+            with self.path.open("r", encoding="utf-8") as fd:
+                entries = json.load(fd)
+        except (OSError, ValueError):
+            return []
+        return entries if isinstance(entries, list) else []
+
+    def append(self, entry: dict):
+        entries = self.load()[-(self.max_entries - 1) :] + [entry]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as fd:
+            json.dump(entries, fd, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def estimate(self, key: str, count: int = 5) -> float | None:
+        """Return the maximum value of `key` among the last successful runs."""
+        values = [x[key] for x in self.load() if x.get("success") and key in x]
+        if not values:
+            return None
+        return max(values[-count:])
@@ -0,0 +1,169 @@
+import importlib
+import multiprocessing
+import os
+import pwd
+import queue
+import sys
+import traceback
+from collections.abc import Callable
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import reduction
+
+
+def check_callable_path(path: str):
+    module_name, sep, attr_name = path.partition(":")
+    if not sep or not module_name or not attr_name:
+        raise ValueError(f"Invalid callable {path} (expected package.module:function)")
+
+
+def load_callable(path: str) -> Callable:
+    """Import a function given as "package.module:function"."""
+    check_callable_path(path)
+    module_name, __, attr_name = path.partition(":")
+    function = importlib.import_module(module_name)
+    for name in attr_name.split("."):
+        function = getattr(function, name)
+    return function
+
+
+class Reporter:
+    """Handle given to Python jobs to write in the report of the run."""
+
+    def __init__(self, send: Callable[[str, str], None]):
+        self._send = send
+
+    def info(self, text: str):
+        self._send("info", text)
+
+    def warning(self, text: str):
+        self._send("warning", text)
+
+    def error(self, text: str):
+        """Add an error to the report: the run is failed."""
+        self._send("error", text)
+
+
+class InheritedFd:
+    """File descriptor sent to a worker process when it is started.
+
+    Workers are not forked from the multi-threaded udevbackup process, so they do not
+    inherit its file descriptors: they are passed by the forkserver.
+    """
+
+    def __init__(self, fd: int):
+        self.fd: int = fd
+
+    def __reduce__(self):
+        return detach_fd, (reduction.DupFd(self.fd),)
+
+
+def detach_fd(dup_fd) -> int:
+    return dup_fd.detach()
+
+
+def drop_privileges(user: str):
+    """Switch the current process to the given user (and its groups)."""
+    pw = pwd.getpwnam(user)
+    os.initgroups(user, pw.pw_gid)
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+    os.environ["HOME"] = pw.pw_dir
+    os.environ["USER"] = os.environ["LOGNAME"] = user
+
+
+def call(path: str, mount_dir: str, reporter: Reporter) -> bool:
+    """Call the function; it fails if it raises an exception or returns False."""
+    try:
+        return load_callable(path)(mount_dir, reporter) is not False
+    except Exception as e:
+        reporter.error(f"{path} failed ({e}).")
+        reporter.info(traceback.format_exc())
+        return False
+
+
+def call_redirected(
+    path: str, mount_dir: str, reporter: Reporter, outputs: tuple[int, int]
+) -> bool:
+    """Call the function in this process, with sys.stdout and sys.stderr redirected to
+    the given file descriptors (only Python writes are redirected).
+    """
+    with (
+        open(outputs[0], "w", closefd=False, errors="replace") as stdout,
+        open(outputs[1], "w", closefd=False, errors="replace") as stderr,
+        redirect_stdout(stdout),
+        redirect_stderr(stderr),
+    ):
+        return call(path, mount_dir, reporter)
+
+
+def run_worker(
+    path: str,
+    mount_dir: str,
+    user: str | None,
+    messages: multiprocessing.Queue,
+    outputs: tuple[int, int] | None = None,
+):
+    """Target of the worker process."""
+    reporter = Reporter(lambda level, text: messages.put((level, text)))
+    success = False
+    try:
+        # its own process group, to be killed if the device is removed
+        os.setsid()
+        if outputs:
+            os.dup2(outputs[0], 1)
+            os.dup2(outputs[1], 2)
+        if user:
+            drop_privileges(user)
+        os.chdir(mount_dir)
+        if outputs:
+            success = call_redirected(path, mount_dir, reporter, (1, 2))
+        else:
+            success = call(path, mount_dir, reporter)
+    except Exception as e:
+        reporter.error(f"Unable to start {path} ({e}).")
+    finally:
+        # os._exit does not flush the buffers
+        sys.stdout.flush()
+        sys.stderr.flush()
+        messages.put(None)
+        messages.close()
+        messages.join_thread()
+    os._exit(0 if success else 1)
+
+
+def run_in_worker(
+    path: str,
+    mount_dir: str,
+    user: str | None,
+    handle: Callable[[str, str], None],
+    started: Callable[[int], None] | None = None,
+    outputs: tuple[int, int] | None = None,
+) -> bool:
+    """Run the function in a child process, with the privileges of `user`.
+
+    Its stdout and stderr are redirected to the `outputs` file descriptors.
+    The child is started by a forkserver: forking the current process could deadlock
+    on a lock held by one of its threads (status, removal watcher, outputs…).
+    """
+    context = multiprocessing.get_context("forkserver")
+    messages = context.Queue()
+    if outputs:
+        outputs = tuple(InheritedFd(x) for x in outputs)
+    process = context.Process(
+        target=run_worker, args=(path, mount_dir, user, messages, outputs)
+    )
+    process.start()
+    if started:
+        started(process.pid)
+    while True:
+        try:
+            message = messages.get(timeout=1.0)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+            continue
+        if message is None:
+            break
+        handle(*message)
+    process.join()
+    return process.exitcode == 0
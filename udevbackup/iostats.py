@@ -0,0 +1,114 @@
+import gzip
+import threading
+import time
+from collections.abc import Callable
+from typing import NamedTuple
+
+from udevbackup.devices import SECTOR_SIZE, DeviceStat
+
+
+class IOSample(NamedTuple):
+    """I/O activity of a device between two consecutive reads of its counters."""
+
+    elapsed: float  # seconds since the first read
+    read_mbps: float
+    write_mbps: float
+    iops: float
+    queue_depth: float  # average number of requests in the queue
+    utilisation: float  # fraction of the time the device was busy
+
+    @classmethod
+    def compute(
+        cls, elapsed: float, duration: float, before: DeviceStat, after: DeviceStat
+    ) -> "IOSample":
+        duration = max(duration, 1e-6)
+        duration_ms = duration * 1000.0
+        read_bytes = (after.read_sectors - before.read_sectors) * SECTOR_SIZE
+        write_bytes = (after.write_sectors - before.write_sectors) * SECTOR_SIZE
+        requests = after.reads + after.writes - before.reads - before.writes
+        return cls(
+            elapsed=elapsed,
+            read_mbps=read_bytes / duration / 1e6,
+            write_mbps=write_bytes / duration / 1e6,
+            iops=requests / duration,
+            queue_depth=(after.time_in_queue - before.time_in_queue) / duration_ms,
+            utilisation=min((after.io_ticks - before.io_ticks) / duration_ms, 1.0),
+        )
+
+
+class IOSampler:
+    """Periodically read the I/O counters of a device in a background thread."""
+
+    csv_header = "elapsed_s,read_mbps,write_mbps,iops,queue_depth,utilisation\n"
+
+    def __init__(
+        self, read_stat: Callable[[], DeviceStat | None], interval: float = 5.0
+    ):
+        self.read_stat = read_stat
+        self.interval: float = interval
+        self.samples: list[IOSample] = []
+        self._first: tuple[float, DeviceStat] | None = None
+        self._last: tuple[float, DeviceStat] | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, timestamp: float, stat: DeviceStat | None):
+        if stat is None:
+            return
+        if self._last is not None:
+            start, before = self._last
+            self.samples.append(
+                IOSample.compute(
+                    timestamp - self._first[0], timestamp - start, before, stat
+                )
+            )
+        else:
+            self._first = (timestamp, stat)
+        self._last = (timestamp, stat)
+
+    def start(self):
+        self.add(time.monotonic(), self.read_stat())
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.add(time.monotonic(), self.read_stat())
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.add(time.monotonic(), self.read_stat())
+
+    def total(self) -> IOSample | None:
+        """Return the average activity over the whole sampling period."""
+        if not self.samples:
+            return None
+        (start, before), (end, after) = self._first, self._last
+        return IOSample.compute(end - start, end - start, before, after)
+
+    def summary(self) -> list[str]:
+        total = self.total()
+        if total is None:
+            return []
+        peak_read = max(x.read_mbps for x in self.samples)
+        peak_write = max(x.write_mbps for x in self.samples)
+        return [
+            f"read: {total.read_mbps:.1f} MB/s (peak: {peak_read:.1f} MB/s)",
+            f"write: {total.write_mbps:.1f} MB/s (peak: {peak_write:.1f} MB/s)",
+            f"IOPS: {total.iops:.0f}, average queue depth: {total.queue_depth:.2f}, "
+            f"utilisation: {total.utilisation:.0%}",
+        ]
+
+    def write_csv(self, path: str):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as fd:
+            fd.write(self.csv_header)
+            for x in self.samples:
+                fd.write(
+                    f"{x.elapsed:.1f},{x.read_mbps:.3f},{x.write_mbps:.3f},"
+                    f"{x.iops:.1f},{x.queue_depth:.3f},{x.utilisation:.3f}\n"
+                )
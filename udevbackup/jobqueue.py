@@ -0,0 +1,111 @@
+import json
+import os
+import pathlib
+import time
+from collections.abc import Callable
+
+import fasteners
+
+from udevbackup.removal import is_alive
+
+
+class JobQueue:
+    """Persistent queue of the runs waiting for the global lock.
+
+    Each job is a JSON file of the queue directory. Jobs are started by decreasing
+    priority, then in the order of arrival; only one job is running at a time.
+    Jobs of dead processes are removed.
+    """
+
+    def __init__(self, directory: str | pathlib.Path):
+        self.directory: pathlib.Path = pathlib.Path(directory)
+
+    def lock(self) -> fasteners.InterProcessLock:
+        return fasteners.InterProcessLock(self.directory / ".lock")
+
+    def jobs(self) -> list[dict]:
+        """Return the running job, then the waiting ones in their order of execution."""
+        jobs = []
+        if not self.directory.is_dir():
+            return jobs
+        for path in self.directory.glob("*.json"):
+            try:
+                job = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            if is_alive(job["pid"]):
+                jobs.append(job)
+            else:
+                path.unlink(missing_ok=True)
+        jobs.sort(
+            key=lambda x: (x["state"] != "running", -x["priority"], x["enqueued_at"])
+        )
+        return jobs
+
+    def write(self, job: dict):
+        path = self.directory / f"{job['id']}.json"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(job), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def get(self, job_id: str) -> dict | None:
+        for job in self.jobs():
+            if job["id"] == job_id:
+                return job
+        return None
+
+    def add(self, name: str, uuid: str, priority: int = 0) -> str:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        job = {
+            "id": f"{time.time_ns()}-{os.getpid()}",
+            "name": name,
+            "uuid": uuid,
+            "priority": priority,
+            "pid": os.getpid(),
+            "state": "waiting",
+            "enqueued_at": now,
+            "started_at": None,
+        }
+        with self.lock():
+            self.write(job)
+        return job["id"]
+
+    def wait(
+        self, job_id: str, poll_interval: float = 1.0, sleep: Callable = time.sleep
+    ) -> bool:
+        """Wait until the job is the first one; return False if it has been cancelled."""
+        while True:
+            with self.lock():
+                jobs = self.jobs()
+                job = next((x for x in jobs if x["id"] == job_id), None)
+                if job is None:
+                    return False
+                if jobs[0] is job:
+                    job["state"] = "running"
+                    job["started_at"] = time.time()
+                    self.write(job)
+                    return True
+            sleep(poll_interval)
+
+    def remove(self, job_id: str):
+        with self.lock():
+            (self.directory / f"{job_id}.json").unlink(missing_ok=True)
+
+    def cancel(self, job_id: str) -> bool:
+        """Remove a waiting job; running jobs cannot be cancelled."""
+        with self.lock():
+            job = self.get(job_id)
+            if job is None or job["state"] == "running":
+                return False
+            (self.directory / f"{job_id}.json").unlink(missing_ok=True)
+        return True
+
+    def set_priority(self, job_id: str, priority: int) -> bool:
+        with self.lock():
+            job = self.get(job_id)
+            if job is None:
+                return False
+            job["priority"] = priority
+            self.write(job)
+        return True
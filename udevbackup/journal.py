@@ -0,0 +1,233 @@
+import ctypes
+import hashlib
+import os
+import pathlib
+import select
+import struct
+import time
+from collections.abc import Callable, Iterable
+
+from udevbackup.removal import is_alive
+
+# records of a journal are NUL-terminated (like `rsync --from0 --files-from`)
+SEPARATOR = b"\0"
+EPOCH_PREFIX = b"epoch "
+GAP_PREFIX = b"!gap "
+# a new epoch is started (so the next runs do a full scan) above this size
+JOURNAL_MAX_SIZE = 64 * 1024 * 1024
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class ChangeJournal:
+    """Paths changed in a source directory, recorded by the watcher.
+
+    The journal starts with an epoch record (written when the watcher starts); a gap
+    record is written when events are lost. A run stores its position (epoch and
+    offset), and the next run gets the paths changed since this position, unless the
+    epoch changed or a gap was recorded.
+    """
+
+    def __init__(self, state_dir: str | pathlib.Path, source: str):
+        self.source: str = os.path.abspath(source)
+        name = hashlib.sha256(self.source.encode()).hexdigest()[:16]
+        self.directory: pathlib.Path = pathlib.Path(state_dir) / "journal"
+        self.path: pathlib.Path = self.directory / f"{name}.journal"
+
+    def start_epoch(self) -> str:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        epoch = str(time.time_ns())
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        tmp_path.write_bytes(EPOCH_PREFIX + epoch.encode() + SEPARATOR)
+        os.replace(tmp_path, self.path)
+        return epoch
+
+    def append(self, records: Iterable[bytes]):
+        content = b"".join(x + SEPARATOR for x in records)
+        if not content:
+            return
+        with self.path.open("ab") as fd:
+            fd.write(content)
+            size = fd.tell()
+        if size > JOURNAL_MAX_SIZE:
+            self.start_epoch()
+
+    def add_gap(self, reason: str):
+        self.append([GAP_PREFIX + reason.encode()])
+
+    def position(self) -> tuple[str, int] | None:
+        """Return the current epoch and offset of the journal."""
+        try:
+            with self.path.open("rb") as fd:
+                header = fd.read(64).partition(SEPARATOR)[0]
+                size = os.fstat(fd.fileno()).st_size
+        except OSError:
+            return None
+        if not header.startswith(EPOCH_PREFIX):
+            return None
+        return header[len(EPOCH_PREFIX) :].decode(), size
+
+    def changes_since(
+        self, position: tuple[str, int]
+    ) -> tuple[list[bytes] | None, str]:
+        """Return the paths changed since the position (None and the reason if unknown)."""
+        epoch, offset = position
+        current = self.position()
+        if current is None:
+            return None, "no journal"
+        if current[0] != epoch or current[1] < offset:
+            return None, "the watcher has been restarted since the last run"
+        with self.path.open("rb") as fd:
+            fd.seek(offset)
+            content = fd.read(current[1] - offset)
+        paths = {}
+        for record in content.split(SEPARATOR)[:-1]:
+            if record.startswith(GAP_PREFIX):
+                return None, record[len(GAP_PREFIX) :].decode(errors="replace")
+            paths[record] = None
+        return list(paths), ""
+
+
+def get_watcher_pid(state_dir: str | pathlib.Path) -> int | None:
+    """Return the PID of the running watcher, if any."""
+    try:
+        pid = int((pathlib.Path(state_dir) / "journal" / "watcher.pid").read_text())
+    except (OSError, ValueError):
+        return None
+    return pid if is_alive(pid) else None
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd: int = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read_events(self, timeout: float) -> list[tuple[int, int, bytes]]:
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 1024 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, __, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """Record the changes of the sources in their journals (run by `udevbackup watch`)."""
+
+    def __init__(
+        self,
+        state_dir: str | pathlib.Path,
+        sources: list[str],
+        flush_interval: float = 1.0,
+    ):
+        self.state_dir: pathlib.Path = pathlib.Path(state_dir)
+        self.journals: list[ChangeJournal] = [
+            ChangeJournal(state_dir, x) for x in sources
+        ]
+        self.flush_interval: float = flush_interval
+        self.watches: dict[int, tuple[ChangeJournal, bytes]] = {}
+        self.pending: dict[ChangeJournal, dict[bytes, None]] = {}
+        self.inotify: Inotify | None = None
+
+    def start(self):
+        self.inotify = Inotify()
+        for journal in self.journals:
+            journal.start_epoch()
+            self.watch_tree(journal, os.fsencode(journal.source))
+        self.pid_path.write_text(str(os.getpid()))
+
+    @property
+    def pid_path(self) -> pathlib.Path:
+        return self.state_dir / "journal" / "watcher.pid"
+
+    def watch_tree(self, journal: ChangeJournal, root: bytes, record: bool = False):
+        """Watch a directory and its subdirectories."""
+        for dirpath, dirnames, filenames in os.walk(root):
+            try:
+                wd = self.inotify.add_watch(dirpath)
+            except OSError as e:
+                journal.add_gap(f"unable to watch {os.fsdecode(dirpath)} ({e})")
+                continue
+            self.watches[wd] = (journal, dirpath)
+            if record:
+                names = [dirpath] + [os.path.join(dirpath, x) for x in filenames]
+                self.pending.setdefault(journal, {}).update(dict.fromkeys(names))
+
+    def process(self, timeout: float):
+        for wd, mask, name in self.inotify.read_events(timeout):
+            if mask & IN_Q_OVERFLOW:
+                for journal in self.journals:
+                    journal.add_gap("too many events (inotify queue overflow)")
+                continue
+            if wd not in self.watches:
+                continue
+            journal, directory = self.watches[wd]
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(directory, name) if name else directory
+            self.pending.setdefault(journal, {})[path] = None
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(journal, path, record=True)
+
+    def flush(self):
+        for journal, paths in self.pending.items():
+            journal.append(paths)
+        self.pending = {}
+
+    def run(self, should_stop: Callable[[], bool] = lambda: False):
+        self.start()
+        try:
+            while not should_stop():
+                self.process(self.flush_interval)
+                self.flush()
+        finally:
+            self.flush()
+            self.inotify.close()
+            self.pid_path.unlink(missing_ok=True)
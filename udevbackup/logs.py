@@ -0,0 +1,127 @@
+import datetime
+import json
+import logging
+import os
+import pathlib
+import re
+from collections.abc import Iterator
+
+LOG_FORMATS = ("text", "json")
+# lines are read backwards by blocks of this size
+READ_BLOCK_SIZE = 64 * 1024
+RELATIVE_TIME = re.compile(r"^(\d+(?:\.\d+)?)([smhdw])$")
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def rotate_log(path: str | pathlib.Path, max_size: int, backups: int):
+    """Rename the log file to `path`.1 (and so on) when it is larger than max_size."""
+    path = pathlib.Path(path)
+    try:
+        if max_size <= 0 or path.stat().st_size < max_size:
+            return
+    except OSError:
+        return
+    for index in range(backups - 1, 0, -1):
+        old_path = path.with_name(f"{path.name}.{index}")
+        if old_path.exists():
+            os.replace(old_path, path.with_name(f"{path.name}.{index + 1}"))
+    if backups > 0:
+        os.replace(path, path.with_name(f"{path.name}.1"))
+    else:
+        path.unlink(missing_ok=True)
+
+
+def make_record(
+    text: str,
+    level: int,
+    run_id: str,
+    rule: str | None = None,
+    phase: str | None = None,
+    duration: float | None = None,
+) -> str:
+    record = {
+        "time": datetime.datetime.now().astimezone().isoformat(timespec="milliseconds"),
+        "run_id": run_id,
+        "rule": rule,
+        "phase": phase,
+        "level": logging.getLevelName(level),
+        "duration": duration,
+        "message": text,
+    }
+    return json.dumps(record)
+
+
+def read_lines_backwards(path: str | pathlib.Path) -> Iterator[bytes]:
+    """Yield the lines of a file from the last one, without reading the whole file."""
+    with open(path, "rb") as fd:
+        position = os.fstat(fd.fileno()).st_size
+        remainder = b""
+        while position > 0:
+            size = min(READ_BLOCK_SIZE, position)
+            position -= size
+            fd.seek(position)
+            lines = (fd.read(size) + remainder).split(b"\n")
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line
+        if remainder:
+            yield remainder
+
+
+def parse_time(value: str, now: datetime.datetime | None = None) -> datetime.datetime:
+    """Parse an ISO date (like 2024-01-31T12:00) or a relative time (like 30m or 2d)."""
+    now = now or datetime.datetime.now().astimezone()
+    if matcher := RELATIVE_TIME.match(value):
+        seconds = float(matcher.group(1)) * TIME_UNITS[matcher.group(2)]
+        return now - datetime.timedelta(seconds=seconds)
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(
+            f"Invalid time {value} (expected 2024-01-31T12:00 or 2h)"
+        ) from None
+    return moment if moment.tzinfo else moment.astimezone()
+
+
+def read_records(
+    path: str | pathlib.Path,
+    backups: int,
+    rule: str | None = None,
+    level: int = logging.NOTSET,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    limit: int | None = None,
+) -> list[dict]:
+    """Return the matching JSON records of the log file and its rotated copies.
+
+    Files are read from their end, and reading stops as soon as `limit` records are
+    found or a record is older than `since`. Records are returned in chronological
+    order; plain text lines are ignored.
+    """
+    path = pathlib.Path(path)
+    paths = [path] + [path.with_name(f"{path.name}.{x}") for x in range(1, backups + 1)]
+    records = []
+    for log_path in paths:
+        try:
+            for line in read_lines_backwards(log_path):
+                try:
+                    record = json.loads(line)
+                    moment = datetime.datetime.fromisoformat(record["time"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if since and moment < since:
+                    return records[::-1]
+                if until and moment > until:
+                    continue
+                if rule and record.get("rule") != rule:
+                    continue
+                record_level = logging.getLevelName(record.get("level"))
+                if not isinstance(record_level, int) or record_level < level:
+                    continue
+                records.append(record)
+                if limit and len(records) >= limit:
+                    return records[::-1]
+        except FileNotFoundError:
+            continue
+    return records[::-1]
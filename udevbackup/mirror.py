@@ -0,0 +1,279 @@
+import os
+import pathlib
+import queue
+import stat
+import threading
+import time
+from collections.abc import Callable
+
+# files are read by chunks of this size, and sent to each target
+CHUNK_SIZE = 1024 * 1024
+# maximum number of chunks waiting for a slow target (this bounds the memory usage)
+QUEUE_SIZE = 32
+
+
+class MirrorTarget:
+    """Directory receiving a copy of the sources, written by its own thread.
+
+    The target is dropped as soon as `should_stop` returns True (like when its disk is
+    removed).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        root: str | pathlib.Path,
+        should_stop: Callable[[], bool] | None = None,
+    ):
+        self.name: str = name
+        self.root: pathlib.Path = pathlib.Path(root)
+        self.should_stop: Callable[[], bool] = should_stop or (lambda: False)
+        self.files: int = 0
+        self.bytes_written: int = 0
+        self.elapsed: float = 0.0
+        self.error: str | None = None
+        self.queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._fd = None
+        self._tmp_path: pathlib.Path | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def active(self) -> bool:
+        if not self.error and self.should_stop():
+            self.error = "interrupted"
+        return not self.error
+
+    def needs(self, relpath: str, st: os.stat_result) -> bool:
+        """Return True if the file is missing or different in this target."""
+        if not self.active:
+            return False
+        try:
+            dst_st = os.lstat(self.root / relpath)
+        except OSError:
+            return True
+        return dst_st.st_size != st.st_size or int(dst_st.st_mtime) != int(st.st_mtime)
+
+    def start(self, start_time: float):
+        self._thread = threading.Thread(
+            target=self._run, args=(start_time,), daemon=True
+        )
+        self._thread.start()
+
+    def join(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self, start_time: float):
+        while (item := self.queue.get()) is not None:
+            if not self.active:
+                self._abort()
+                continue  # drain the queue to never block the reader
+            try:
+                getattr(self, f"_{item[0]}")(*item[1:])
+            except Exception as e:
+                self.error = str(e)
+                self._abort()
+        self.elapsed = time.monotonic() - start_time
+
+    def _dir(self, relpath: str, st: os.stat_result):
+        path = self.root / relpath
+        path.mkdir(exist_ok=True)
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+
+    def _symlink(self, relpath: str, link_target: str):
+        path = self.root / relpath
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(link_target, path)
+
+    def _open(self, relpath: str):
+        path = self.root / relpath
+        self._tmp_path = path.with_name(f".{path.name}.udevbackup")
+        self._fd = open(self._tmp_path, "wb")
+
+    def _data(self, data: bytes):
+        self._fd.write(data)
+        self.bytes_written += len(data)
+
+    def _close(self, relpath: str, st: os.stat_result):
+        self._fd.close()
+        self._fd = None
+        os.chmod(self._tmp_path, stat.S_IMODE(st.st_mode))
+        try:
+            os.chown(self._tmp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+        os.utime(self._tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(self._tmp_path, self.root / relpath)
+        self._tmp_path = None
+        self.files += 1
+
+    def _abort(self):
+        # the disk may have been removed: nothing can be cleaned
+        if self._fd:
+            try:
+                self._fd.close()
+            except OSError:  # nosec B110
+                pass
+            self._fd = None
+        if self._tmp_path:
+            try:
+                self._tmp_path.unlink(missing_ok=True)
+            except OSError:  # nosec B110
+                pass
+        self._tmp_path = None
+
+    @property
+    def mbps(self) -> float:
+        return self.bytes_written / max(self.elapsed, 1e-6) / 1e6
+
+
+class Mirror:
+    """Copy the sources to several targets, reading each file only once.
+
+    Each source is copied in a directory of the same name at the root of the targets.
+    Unchanged files (same size and mtime) are skipped and extra files are kept, like
+    `rsync -a` without `--delete`.
+    A slow target slows down the others, but never makes them read the source again.
+    """
+
+    def __init__(self, sources: list[str], targets: list[MirrorTarget]):
+        self.sources: list[str] = sources
+        self.targets: list[MirrorTarget] = targets
+        self.bytes_read: int = 0
+        self.skipped_files: int = 0
+        self.elapsed: float = 0.0
+        self.errors: list[str] = []
+
+    def run(self):
+        start_time = time.monotonic()
+        for target in self.targets:
+            target.start(start_time)
+        try:
+            for source in self.sources:
+                if not any(x.active for x in self.targets):
+                    break
+                self.copy_tree(pathlib.Path(source))
+        finally:
+            for target in self.targets:
+                target.join()
+        self.elapsed = time.monotonic() - start_time
+
+    def send(self, targets: list[MirrorTarget], *item):
+        for target in targets:
+            target.queue.put(item)
+
+    def copy_tree(self, source: pathlib.Path):
+        if not source.is_dir() or source.is_symlink():
+            self.copy_file(source, source.name)
+            return
+        for dirpath, dirnames, filenames in os.walk(source):
+            if not any(x.active for x in self.targets):
+                return
+            relpath = os.path.join(source.name, os.path.relpath(dirpath, source))
+            relpath = os.path.normpath(relpath)
+            self.send(self.targets, "dir", relpath, os.stat(dirpath))
+            for name in dirnames:
+                if os.path.islink(os.path.join(dirpath, name)):
+                    self.copy_file(pathlib.Path(dirpath, name), f"{relpath}/{name}")
+            for name in filenames:
+                self.copy_file(pathlib.Path(dirpath, name), f"{relpath}/{name}")
+
+    def copy_file(self, path: pathlib.Path, relpath: str):
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                link_target = os.readlink(path)
+                targets = [
+                    x
+                    for x in self.targets
+                    if x.active
+                    and not (
+                        os.path.islink(x.root / relpath)
+                        and os.readlink(x.root / relpath) == link_target
+                    )
+                ]
+                self.send(targets, "symlink", relpath, link_target)
+                return
+            if not stat.S_ISREG(st.st_mode):
+                return
+            targets = [x for x in self.targets if x.needs(relpath, st)]
+            if not targets:
+                self.skipped_files += 1
+                return
+            with open(path, "rb") as fd:
+                self.send(targets, "open", relpath)
+                try:
+                    while data := fd.read(CHUNK_SIZE):
+                        if not any(x.active for x in targets):
+                            self.send(targets, "abort")
+                            return
+                        self.bytes_read += len(data)
+                        self.send(targets, "data", data)
+                except OSError:
+                    self.send(targets, "abort")
+                    raise
+            self.send(targets, "close", relpath, st)
+        except OSError as e:
+            self.errors.append(f"Unable to read {path} ({e}).")
+
+    def report(self) -> list[str]:
+        mbps = self.bytes_read / max(self.elapsed, 1e-6) / 1e6
+        lines = [
+            f"{self.bytes_read / 1e6:.1f} MB read in {self.elapsed:.1f} s "
+            f"({mbps:.1f} MB/s), {self.skipped_files} unchanged files."
+        ]
+        for target in self.targets:
+            status = f"KO ({target.error})" if target.error else "OK"
+            lines.append(
+                f"{target.name}: {target.files} files, "
+                f"{target.bytes_written / 1e6:.1f} MB written ({target.mbps:.1f} MB/s), "
+                f"{status}."
+            )
+        return lines
+
+
+class SharedMirror:
+    """Single Mirror shared by the jobs of a fan-out session, each in its own thread.
+
+    Each job calls `join` as its engine: the mirror starts once all the jobs have
+    joined (or have ended without joining, like the jobs of removed devices), and
+    `join` returns the result of the target of the job.
+    """
+
+    def __init__(self, mirror: Callable[[list], list[bool]], jobs: list):
+        self.mirror: Callable[[list], list[bool]] = mirror
+        self._pending: set = set(jobs)
+        self._joined: list = []
+        self._results: dict = {}
+        self._started: bool = False
+        self._condition = threading.Condition()
+
+    def join(self, job) -> bool:
+        with self._condition:
+            self._pending.discard(job)
+            self._joined.append(job)
+        self._start_if_ready()
+        with self._condition:
+            self._condition.wait_for(lambda: job in self._results)
+            return self._results[job]
+
+    def leave(self, job):
+        """Must be called when the job has ended, even if it has not joined."""
+        with self._condition:
+            self._pending.discard(job)
+        self._start_if_ready()
+
+    def _start_if_ready(self):
+        with self._condition:
+            if self._started or self._pending or not self._joined:
+                return
+            self._started = True
+            jobs = list(self._joined)
+        results = [False] * len(jobs)
+        try:
+            results = self.mirror(jobs)
+        finally:
+            with self._condition:
+                self._results.update(zip(jobs, results))
+                self._condition.notify_all()
@@ -0,0 +1,125 @@
+import glob
+import gzip
+import os
+import threading
+
+# stdout/stderr files are compressed while they are written, by chunks of this size
+BUFFER_SIZE = 64 * 1024
+# maximum time to wait for the end of the compression when the file is closed
+CLOSE_TIMEOUT = 30.0
+# the date of the run, as used in the %(date)s placeholder of output filenames
+DATE_FORMAT = "%Y%m%d-%H%M%S"
+DATE_GLOB = "[0-9]" * 8 + "-" + "[0-9]" * 6
+
+
+def numbered_path(path: str, index: int) -> str:
+    """Return the name of the `index`-th previous generation of `path`."""
+    if path.endswith(".gz"):
+        return f"{path[:-3]}.{index}.gz"
+    return f"{path}.{index}"
+
+
+def rotate_outputs(
+    path: str, pattern: str, generations: int, max_size: int = 0
+) -> list[str]:
+    """Make room for a new output file at `path`, keeping `generations - 1` older files.
+
+    If the filename does not depend on the run date (`pattern == path`), previous files
+    are renamed `path.1`, `path.2`, … like logrotate does.
+    Otherwise, previous files are all files matching the glob `pattern`.
+    The oldest files are removed until their total size is below `max_size` bytes
+    (if not 0).
+    Return the list of removed files.
+    """
+    removed = []
+    if pattern == path:
+        for index in range(generations, 0, -1):
+            src = numbered_path(path, index - 1) if index > 1 else path
+            if not os.path.isfile(src):
+                continue
+            if index == generations:
+                os.remove(src)
+                removed.append(src)
+            else:
+                os.replace(src, numbered_path(path, index))
+        previous = [numbered_path(path, index) for index in range(1, generations)]
+        previous = [x for x in previous if os.path.isfile(x)]
+    else:
+        previous = [x for x in glob.glob(pattern) if x != path and os.path.isfile(x)]
+        previous.sort(key=lambda x: (os.path.getmtime(x), x), reverse=True)
+        while len(previous) >= max(generations, 1):
+            filename = previous.pop()
+            os.remove(filename)
+            removed.append(filename)
+    if max_size:
+        total_size = sum(os.path.getsize(x) for x in previous)
+        while previous and total_size > max_size:
+            filename = previous.pop()
+            total_size -= os.path.getsize(filename)
+            os.remove(filename)
+            removed.append(filename)
+    return removed
+
+
+class OutputFile:
+    """File receiving the stdout (or stderr) of all commands executed for a rule.
+
+    Can be directly given as `stdout` or `stderr` to `subprocess.Popen`.
+    When compressed, commands write to a pipe and a thread compresses its content
+    while it is written, so the whole output is never stored uncompressed.
+    If a process still holds the pipe when the file is closed (after CLOSE_TIMEOUT),
+    the thread drops its next writes.
+    If the file cannot be written (ENOSPC, EIO…), the pipe is still drained until EOF,
+    so commands are not blocked, and the error is kept in `error`.
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        self.path: str = path
+        self.compress: bool = compress
+        self._fd = None
+        self._write_fd: int | None = None
+        self._thread: threading.Thread | None = None
+        # held by the thread while it writes, and when the file is closed
+        self._lock = threading.Lock()
+        self.error: str | None = None
+
+    def open(self):
+        if not self.compress:
+            self._fd = open(self.path, "wb")
+            return
+        self._fd = gzip.open(self.path, "wb")
+        read_fd, self._write_fd = os.pipe()
+        self._thread = threading.Thread(
+            target=self._compress, args=(read_fd,), daemon=True
+        )
+        self._thread.start()
+
+    def _compress(self, read_fd: int):
+        with os.fdopen(read_fd, "rb", buffering=0) as pipe:
+            while data := pipe.read(BUFFER_SIZE):
+                with self._lock:
+                    if self._fd is None or self.error:
+                        continue
+                    try:
+                        self._fd.write(data)
+                    except OSError as e:
+                        self.error = f"Unable to write {self.path} ({e})."
+
+    def fileno(self) -> int:
+        if self._write_fd is not None:
+            return self._write_fd
+        return self._fd.fileno()
+
+    def close(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+            self._thread.join(timeout=CLOSE_TIMEOUT)
+            self._thread = None
+        with self._lock:
+            if self._fd:
+                try:
+                    self._fd.close()
+                except OSError as e:
+                    self.error = self.error or f"Unable to write {self.path} ({e})."
+                self._fd = None
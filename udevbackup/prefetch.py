@@ -0,0 +1,153 @@
+import os
+import stat
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class PrefetchStats:
+    def __init__(self):
+        self.directories: int = 0
+        self.files: int = 0
+        self.advised_files: int = 0
+        self.advised_bytes: int = 0
+        self.elapsed: float = 0.0
+        self.completed: bool = False
+
+    def report(self) -> str:
+        text = (
+            f"{self.directories} directories and {self.files} files in "
+            f"{self.elapsed:.1f} s"
+        )
+        if self.advised_files:
+            text += (
+                f", {self.advised_bytes / 1e6:.1f} MB of {self.advised_files} "
+                "files read ahead"
+            )
+        return text + ("." if self.completed else " (stopped before the end).")
+
+
+class Prefetcher:
+    """Warm the caches of the sources in a background thread.
+
+    Without `paths`, all directories of the sources are listed and their entries
+    stat-ed by a thread pool, to load the dentry and inode caches. With `paths` (the
+    changes recorded by the watcher), only these paths are stat-ed. Regular files
+    modified after `since` (and all given paths) are read ahead with
+    posix_fadvise(WILLNEED), up to `read_ahead` bytes.
+    """
+
+    def __init__(
+        self,
+        sources: list[str],
+        workers: int = 4,
+        paths: list[bytes] | None = None,
+        since: float | None = None,
+        read_ahead: int = 0,
+    ):
+        self.sources: list[str] = [os.path.abspath(x) for x in sources]
+        self.workers: int = max(workers, 1)
+        self.paths: list[bytes] | None = paths
+        self.since: float | None = since
+        self.read_ahead: int = read_ahead
+        self.stats = PrefetchStats()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> PrefetchStats:
+        """Stop the prefetch (the backup is starting) and return its statistics."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        return self.stats
+
+    def run(self):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if self.paths is not None:
+                self.warm_paths(executor)
+            else:
+                self.walk(executor)
+        self.stats.completed = not self._stop.is_set()
+        self.stats.elapsed = time.monotonic() - start
+
+    def warm_paths(self, executor: ThreadPoolExecutor):
+        def warm(path: bytes):
+            if self._stop.is_set():
+                return
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return
+            self.count(st)
+            if stat.S_ISREG(st.st_mode):
+                self.advise(path, st.st_size)
+
+        for __ in executor.map(warm, self.paths):
+            pass
+
+    def walk(self, executor: ThreadPoolExecutor):
+        pending = {executor.submit(self.scan_directory, x) for x in self.sources}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if self._stop.is_set():
+                for future in pending:
+                    future.cancel()
+                return
+            for future in done:
+                for directory in future.result():
+                    pending.add(executor.submit(self.scan_directory, directory))
+
+    def scan_directory(self, directory: str) -> list[str]:
+        """Stat the entries of a directory and return its subdirectories."""
+        directories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if self._stop.is_set():
+                        break
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    self.count(st)
+                    if stat.S_ISDIR(st.st_mode):
+                        directories.append(entry.path)
+                    elif stat.S_ISREG(st.st_mode) and self.is_expected_to_change(st):
+                        self.advise(entry.path, st.st_size)
+        except OSError:
+            pass
+        return directories
+
+    def count(self, st: os.stat_result):
+        with self._lock:
+            if stat.S_ISDIR(st.st_mode):
+                self.stats.directories += 1
+            else:
+                self.stats.files += 1
+
+    def is_expected_to_change(self, st: os.stat_result) -> bool:
+        return self.since is not None and st.st_mtime > self.since
+
+    def advise(self, path: str | bytes, size: int):
+        with self._lock:
+            if self.stats.advised_bytes + size > self.read_ahead:
+                return
+            self.stats.advised_bytes += size
+            self.stats.advised_files += 1
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,93 @@
+import mmap
+import os
+import pathlib
+import statistics
+import time
+from typing import NamedTuple
+
+PROBE_BLOCK_SIZE = 1024 * 1024
+PROBE_FILENAME = ".udevbackup-probe"
+# number of previous probes of the disk used as reference
+PROBE_HISTORY = 10
+
+
+class ProbeResult(NamedTuple):
+    read: float  # MB/s
+    write: float  # MB/s
+    direct: bool  # O_DIRECT was used (the page cache was bypassed)
+
+    def summary(self) -> str:
+        text = f"read {self.read:.1f} MB/s, write {self.write:.1f} MB/s"
+        return text if self.direct else f"{text} (without O_DIRECT)"
+
+
+def open_direct(path: pathlib.Path, flags: int) -> tuple[int, bool]:
+    """Open the file with O_DIRECT if the file system supports it."""
+    try:
+        return os.open(path, flags | os.O_DIRECT, 0o600), True
+    except OSError:
+        return os.open(path, flags, 0o600), False
+
+
+def probe_throughput(
+    directory: str | pathlib.Path,
+    size: int,
+    block_size: int = PROBE_BLOCK_SIZE,
+) -> ProbeResult:
+    """Measure the sequential write then read throughput with a scratch file.
+
+    O_DIRECT requires aligned buffers: an anonymous mmap is page-aligned.
+    """
+    path = pathlib.Path(directory) / PROBE_FILENAME
+    count = max(size // block_size, 1)
+    buffer = mmap.mmap(-1, block_size)
+    buffer.write(os.urandom(block_size))
+    try:
+        fd, direct = open_direct(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            start = time.monotonic()
+            for __ in range(count):
+                os.write(fd, buffer)
+            os.fsync(fd)
+            write_time = time.monotonic() - start
+        finally:
+            os.close(fd)
+        fd, direct_read = open_direct(path, os.O_RDONLY)
+        try:
+            if not direct_read:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            start = time.monotonic()
+            while os.readv(fd, [buffer]) > 0:
+                pass
+            read_time = time.monotonic() - start
+        finally:
+            os.close(fd)
+    finally:
+        buffer.close()
+        path.unlink(missing_ok=True)
+    total = count * block_size / 1e6
+    return ProbeResult(
+        read=total / max(read_time, 1e-6),
+        write=total / max(write_time, 1e-6),
+        direct=direct and direct_read,
+    )
+
+
+def compare_probes(
+    current: ProbeResult, previous: list[dict], drop: float
+) -> list[str]:
+    """Return the throughputs that are `drop` (like 0.3) below the usual ones."""
+    messages = []
+    for key in ("read", "write"):
+        values = [x[key] for x in previous[-PROBE_HISTORY:] if key in x]
+        if len(values) < 3:
+            continue
+        median = statistics.median(values)
+        value = getattr(current, key)
+        if value < median * (1.0 - drop):
+            percent = 100 * (1 - value / median)
+            messages.append(
+                f"{key} throughput {value:.1f} MB/s is {percent:.0f} % below "
+                f"the usual {median:.1f} MB/s"
+            )
+    return messages
@@ -0,0 +1,103 @@
+import os
+import pathlib
+import signal
+import threading
+import time
+from collections.abc import Callable
+
+# delay between SIGTERM and SIGKILL when the device is removed
+KILL_DELAY = 5.0
+
+
+def removal_marker(run_dir: str | pathlib.Path, uuid: str) -> pathlib.Path:
+    """File written by `udevbackup removed` (from the udev remove event)."""
+    return pathlib.Path(run_dir) / "removed" / uuid
+
+
+def mark_removed(run_dir: str | pathlib.Path, uuid: str):
+    path = removal_marker(run_dir, uuid)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+
+
+def kill_process_groups(
+    pids: list[int],
+    delay: float = KILL_DELAY,
+    sleep: Callable[[float], None] = time.sleep,
+):
+    """Terminate the process groups (started with start_new_session), then kill them."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        alive = []
+        for pid in pids:
+            try:
+                os.killpg(pid, sig)
+                alive.append(pid)
+            except (ProcessLookupError, PermissionError):
+                continue
+        pids = alive
+        if sig == signal.SIGTERM and pids:
+            timeout = time.monotonic() + delay
+            while pids and time.monotonic() < timeout:
+                sleep(0.1)
+                pids = [x for x in pids if is_group_alive(x)]
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # owned by another user
+        return True
+    return True
+
+
+def is_group_alive(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+    except (ProcessLookupError, PermissionError):
+        return False
+    return True
+
+
+class RemovalWatcher:
+    """Call `on_removal` once if the device disappears during the run.
+
+    The device is removed when its link in /dev/disk/by-uuid disappears or when the
+    marker of the udev remove event is written.
+    """
+
+    def __init__(
+        self,
+        device_path: pathlib.Path,
+        marker_path: pathlib.Path,
+        on_removal: Callable[[], None],
+        interval: float = 1.0,
+    ):
+        self.device_path: pathlib.Path = device_path
+        self.marker_path: pathlib.Path = marker_path
+        self.on_removal: Callable[[], None] = on_removal
+        self.interval: float = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        # marker of a previous removal of the same device
+        self.marker_path.unlink(missing_ok=True)
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def is_removed(self) -> bool:
+        return self.marker_path.exists() or not os.path.lexists(self.device_path)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            if self.is_removed():
+                self.on_removal()
+                return
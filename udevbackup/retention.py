@@ -0,0 +1,161 @@
+import datetime
+import os
+import pathlib
+import re
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# dates like 20240131-120000 (the run date), 2024-01-31, 2024-01-31_12-00-00…
+DATE_PATTERN = re.compile(
+    r"(\d{4})-?(\d{2})-?(\d{2})(?:[-_T ]?(\d{2})[-:]?(\d{2})[-:]?(\d{2}))?"
+)
+
+
+def parse_date(name: str) -> datetime.datetime | None:
+    """Return the date in the name of a snapshot, if any."""
+    matcher = DATE_PATTERN.search(name)
+    if not matcher:
+        return None
+    values = [int(x) for x in matcher.groups(default="0")]
+    try:
+        return datetime.datetime(*values)
+    except ValueError:
+        return None
+
+
+def select_kept(
+    dates: dict[str, datetime.datetime], daily: int, weekly: int, monthly: int
+) -> set[str]:
+    """Return the snapshots to keep: the last one of each of the `daily` last days
+    (and `weekly` last weeks, `monthly` last months). The last snapshot is always kept.
+    """
+    ordered = sorted(dates, key=lambda x: (dates[x], x), reverse=True)
+    kept = set(ordered[:1])
+    for count, period in (
+        (daily, lambda x: x.date()),
+        (weekly, lambda x: x.isocalendar()[:2]),
+        (monthly, lambda x: (x.year, x.month)),
+    ):
+        periods = set()
+        for name in ordered:
+            if len(periods) >= count:
+                break
+            if period(dates[name]) not in periods:
+                periods.add(period(dates[name]))
+                kept.add(name)
+    return kept
+
+
+class PruneStats:
+    def __init__(self):
+        self.snapshots: list[str] = []
+        self.files: int = 0
+        self.reclaimed_bytes: int = 0
+        self.elapsed: float = 0.0
+        self.errors: list[str] = []
+
+    def report(self) -> str:
+        return (
+            f"{len(self.snapshots)} snapshots deleted ({', '.join(self.snapshots)}), "
+            f"{self.files} files, {self.reclaimed_bytes / 1e6:.1f} MB reclaimed "
+            f"in {self.elapsed:.1f} s."
+        )
+
+
+class Pruner:
+    """Delete snapshots in a background thread.
+
+    Files are unlinked by a thread pool (with a bounded number of pending unlinks),
+    then directories are removed from the deepest ones. Only the files without other
+    hard links count as reclaimed space.
+    The deletion stops as soon as `should_stop` returns True (like when the disk is
+    removed).
+    """
+
+    def __init__(
+        self,
+        paths: list[pathlib.Path],
+        workers: int = 4,
+        should_stop: Callable[[], bool] | None = None,
+    ):
+        self.paths: list[pathlib.Path] = paths
+        self.workers: int = max(workers, 1)
+        self.should_stop: Callable[[], bool] = should_stop or (lambda: False)
+        self.stats = PruneStats()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def wait(self) -> PruneStats:
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        return self.stats
+
+    def run(self):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for path in self.paths:
+                if self.should_stop():
+                    break
+                if self.remove_tree(executor, path):
+                    self.stats.snapshots.append(path.name)
+        self.stats.elapsed = time.monotonic() - start
+
+    def remove_tree(self, executor: ThreadPoolExecutor, path: pathlib.Path) -> bool:
+        pending: deque[Future] = deque()
+        max_pending = self.workers * 4
+        directories = []
+        if path.is_dir() and not path.is_symlink():
+            for dirpath, dirnames, filenames in os.walk(path, onerror=self.add_error):
+                if self.should_stop():
+                    break
+                directories.append(dirpath)
+                links = [
+                    x for x in dirnames if os.path.islink(os.path.join(dirpath, x))
+                ]
+                # unlinked in parallel: os.walk must not check them again
+                dirnames[:] = [x for x in dirnames if x not in links]
+                for name in filenames + links:
+                    pending.append(
+                        executor.submit(self.unlink, os.path.join(dirpath, name))
+                    )
+                    while len(pending) > max_pending:
+                        pending.popleft().result()
+        else:
+            pending.append(executor.submit(self.unlink, str(path)))
+        for future in pending:
+            future.result()
+        if self.should_stop():
+            return False
+        for directory in reversed(directories):
+            try:
+                os.rmdir(directory)
+            except OSError as e:
+                self.add_error(e)
+        return not path.exists() and not path.is_symlink()
+
+    def unlink(self, path: str):
+        try:
+            st = os.lstat(path)
+            os.unlink(path)
+        except OSError as e:
+            self.add_error(e)
+            return
+        with self._lock:
+            self.stats.files += 1
+            if st.st_nlink == 1:
+                self.stats.reclaimed_bytes += st.st_blocks * 512
+
+    def add_error(self, error: OSError):
+        with self._lock:
+            if len(self.stats.errors) < 10:
+                self.stats.errors.append(
+                    f"Unable to delete {error.filename} ({error})."
+                )
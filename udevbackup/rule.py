@@ -1,3 +1,7 @@
+import functools
+import glob
+import json
+import math
 import os
 import pathlib
 import platform
@@ -7,8 +11,12 @@ import smtplib
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import uuid
+from collections.abc import Callable
 from configparser import ConfigParser
+from contextlib import nullcontext
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
@@ -19,6 +27,47 @@ import fasteners
 from systemlogger import getLogger
 from termcolor import cprint
 
+from udevbackup.archive import COMPRESSIONS, create_archive, zstandard
+from udevbackup.checkpoint import Checkpoint
+from udevbackup.chunkstore import ChunkStore
+from udevbackup.crypttab import CrypttabEntry, parse_entry
+from udevbackup.devices import (
+    SECTOR_SIZE,
+    device_numbers,
+    parent_device,
+    partitions,
+    read_device_stat,
+    resolve_device,
+)
+from udevbackup.history import RunHistory, format_duration, scan_size
+from udevbackup.hooks import (
+    Reporter,
+    call_redirected,
+    check_callable_path,
+    run_in_worker,
+)
+from udevbackup.iostats import IOSampler
+from udevbackup.jobqueue import JobQueue
+from udevbackup.journal import ChangeJournal, get_watcher_pid
+from udevbackup.logs import LOG_FORMATS, make_record, rotate_log
+from udevbackup.mirror import Mirror, MirrorTarget, SharedMirror
+from udevbackup.outputs import DATE_FORMAT, DATE_GLOB, OutputFile, rotate_outputs
+from udevbackup.prefetch import Prefetcher
+from udevbackup.probe import ProbeResult, compare_probes, probe_throughput
+from udevbackup.removal import (
+    RemovalWatcher,
+    kill_process_groups,
+    removal_marker,
+)
+from udevbackup.retention import Pruner, parse_date, select_kept
+from udevbackup.session import SESSION_LOCK_TIMEOUT, SessionCache
+from udevbackup.spool import MailSpool
+from udevbackup.status import RunStatus, read_last_line
+from udevbackup.throttle import IOPRIO_CLASSES, Throttle
+from udevbackup.trace import TRACE_HISTORY, Tracer
+from udevbackup.tuning import BlockTuning
+from udevbackup.usage import ResourceUsage, wait_process
+
 logger = getLogger(name="udevbackup", extra_tags={"application_fqdn": "system"})
 
 
@@ -65,7 +114,7 @@ class ConfigSection:
                     kwargs[option] = parser.getfloat(section, option)
                 else:
                     raise ValueError(f"Unrecognized option [{section}] {option}")
-        for required_option in cls.required:
+        for required_option in cls.get_required(kwargs):
             if required_option in kwargs:
                 continue
             raise ValueError(
@@ -73,6 +122,10 @@ class ConfigSection:
             )
         return kwargs
 
+    @classmethod
+    def get_required(cls, kwargs: dict) -> set[str]:
+        return cls.required
+
 
 class Rule(ConfigSection):
     text_options = {
@@ -82,94 +135,852 @@ class Rule(ConfigSection):
         "script": "Content of the script to execute when the disk is mounted. "
         "Working dir is the mounted directory."
         "This script will be copied in a temporary file, whose name is passed to the command.",
-        "stdout": "Write stdout to this filename.",
-        "stderr": "Write stderr to this filename.",
+        "callable": 'Python function, like "package.module:function", called instead of '
+        "the script with the path of the mounted disk and a reporter (with info, warning "
+        "and error methods). It is run in a child process when user or limits are set, "
+        'in the udevbackup process otherwise. Default to "".',
+        "stdout": "Write stdout to this filename. %(name)s, %(tmp)s, %(outputs)s and %(date)s "
+        "are replaced by the rule name, the temporary dir, the output dir and the run date. "
+        'Default to "%(outputs)s/%(name)s.out.txt".',
+        "stderr": "Write stderr to this filename (same placeholders as stdout). "
+        'Default to "%(outputs)s/%(name)s.err.txt".',
+        "iostat": "Write the I/O statistics of the target device to this CSV filename "
+        '(same placeholders as stdout). Default to "%(outputs)s/%(name)s.iostat.csv".',
         "mount_options": 'Extra mount options. Default to "".',
+        "retention_dir": "Directory of the disk with a dated entry per run (like "
+        "20240131-120000 or 2024-01-31), pruned after each successful run according to "
+        "keep_daily, keep_weekly and keep_monthly, while the next jobs are running. "
+        'Default to "archive" with the archive engine, "" otherwise.',
+        "luks_options": "Extra options of `cryptsetup open`, like "
+        '"--perf-no_read_workqueue --perf-no_write_workqueue --allow-discards". The key '
+        "file and the options of /etc/crypttab are also used; cryptdisks_start is used "
+        'instead when crypttab has unsupported options (like keyscript). Default to "".',
         "user": "User used for running the script and mounting the disk.",
         "pre_script": "Script to run before mounting the disk. The disk will not be mounted if this script "
         'does not returns 0. Default to "".',
         "post_script": "Script to run after the disk umount. Only run if the disk was mounted. "
+        "With keep_open, it is also run when the disk stays mounted. "
         'Default to "".',
+        "io_class": f"I/O scheduling class of all commands ({', '.join(IOPRIO_CLASSES)}). "
+        'Default to "" (unchanged).',
+        "sources": "Paths (separated by spaces) backed up by the script or by the engine. "
+        'Default to "".',
+        "engine": '"script" to run the script, "mirror" to copy the sources to the disk '
+        '(like `rsync -a`) without any script, "chunkstore" to store the sources in a '
+        "deduplicated store (the chunkstore directory of the disk, with a snapshot per "
+        'run, much faster with the numpy package), "archive" to write them as '
+        "compressed tar volumes with an index (in archive/<date> on the disk). "
+        'Default to "script".',
+        "compression": 'Compression of the archive engine: "gzip" or "zstd" (requires the '
+        'zstandard package). Default to "gzip".',
+        "fanout": "Name of a fan-out group: when a disk of the group is connected, "
+        "udevbackup waits for all the other disks of the group and backs them up "
+        "together. With the mirror engine, the sources are read only once. "
+        'Default to "".',
+        "preflight": "Check that the mounted disk has enough free space before running the "
+        'script: "history" estimates the size from the previous runs, "scan" from the '
+        "size of the sources (with the mirror and chunkstore engines, only for the first "
+        'run: then from the previous runs). Default to "" (no check).',
+        "memory_high": 'Memory limit of all commands, like "2G" (requires cgroup v2). '
+        'Default to "" (no limit).',
+        "io_scheduler": 'I/O scheduler of the disk during the run, like "none" or '
+        '"mq-deadline". Default to "" (unchanged).',
+    }
+    bool_options = {
+        "journal": "Give the script the list of the paths of the sources changed since the "
+        "last successful run (recorded by `udevbackup watch`) in the file "
+        "UDEVBACKUP_FILES_FROM. This variable is not set when a full scan is required. "
+        "Default to 0.",
+        "parallel": "When several configured partitions of a disk are backed up in the "
+        "same session, run this rule at the same time as the other ones. Default to 0.",
+        "output_compress": "Compress stdout/stderr with gzip while they are written "
+        '(".gz" is added to their names). Default to 0.',
+        "probe": "After mounting the disk, measure its sequential read and write "
+        "throughput with a scratch file (with O_DIRECT). The disk is flagged as slow in "
+        "the e-mail subject when it is probe_drop % slower than usual. Default to 0.",
+        "prefetch": "While the disk is unlocked and mounted, list the sources in parallel "
+        "(or only the paths changed since the last run, with journal = 1) to warm the "
+        "caches of the file system. Default to 0.",
+    }
+    int_options = {
+        "output_history": "Number of stdout/stderr files to keep (including the current one). "
+        "Use %(date)s in their names to keep them addressable, otherwise previous files are "
+        "renamed with a .1, .2, … suffix. Default to 1.",
+        "output_max_size": "Maximum total size (in MB) of the previous stdout (and stderr) "
+        "files. Default to 0 (no limit).",
+        "io_priority": "I/O priority (from 0 to 7, 7 being the lowest) of all commands. "
+        'Default to "" (unchanged).',
+        "nice": 'Niceness (from -20 to 19) of all commands. Default to "" (unchanged).',
+        "io_max_bps": "Maximum read and write bandwidth (in bytes/s) of all commands on the "
+        "target disk (requires cgroup v2). Default to 0 (no limit).",
+        "keep_daily": "Number of days for which the last entry of retention_dir is kept "
+        "(the last entry is always kept). Default to 0.",
+        "keep_weekly": "Number of weeks for which the last entry of retention_dir is kept. "
+        "Default to 0.",
+        "keep_monthly": "Number of months for which the last entry of retention_dir is "
+        "kept. Default to 0.",
+        "probe_size": "Size (in MB) of the scratch file of the probe. Default to 64.",
+        "probe_drop": "Flag the disk when its throughput is N % below the median of its "
+        "previous probes. Default to 30.",
+        "prefetch_read": "With prefetch, also ask the kernel to read ahead (up to N MB) the "
+        "files modified since the last successful run. Default to 0.",
+        "workers": "Number of processes (or threads) used by the engine. "
+        "Default to the number of CPUs.",
+        "chunk_size": "Average size (in KB) of the chunks of the chunkstore engine, or size "
+        "of the compressed blocks of the archive engine. "
+        "Default to 1024.",
+        "cpu_weight": "CPU weight (from 1 to 10000, 100 being the default of other processes) "
+        "of all commands (requires cgroup v2). Default to 0 (unchanged).",
+        "volume_size": "Maximum size (in MB) of each volume of the archive engine. "
+        "Default to 1024.",
+        "priority": "When several devices wait for lock_file, rules with a higher priority "
+        "run first (in the order of connection for the same priority). Default to 0.",
+        "read_ahead_kb": "Read-ahead (in KB) of the disk during the run. "
+        "Default to 0 (unchanged).",
+        "nr_requests": "Size of the request queue of the disk during the run. "
+        "Default to 0 (unchanged).",
+        "max_ratio": "Maximum share (in %) of the dirty page cache used by the disk during "
+        "the run. Default to 0 (unchanged).",
+    }
+    float_options = {
+        "keep_open": "Leave the disk unlocked and mounted for N seconds after a successful "
+        "run, so the next runs of the rule skip the unlocking and the mount (for disks that "
+        "stay connected). Sessions are closed by an `at` job once expired (or by the "
+        "next run, or by `udevbackup close`). Default to 0 (the disk is always unmounted).",
+        "fanout_window": "Maximum time (in seconds) to wait for the other disks of the "
+        "fan-out group. Default to 60.",
+        "preflight_margin": "Required free space, relative to the estimated size of the "
+        "backup. Default to 1.1.",
+        "iostat_interval": "Sample the I/O statistics (MB/s, IOPS, queue depth, utilisation) "
+        "of the target device every N seconds while the script runs. "
+        "Default to 0 (disabled).",
     }
     required = {"fs_uuid", "script"}
+    engines = ("script", "mirror", "chunkstore", "archive")
+    # engines that only write the changes since the previous run
+    incremental_engines = ("mirror", "chunkstore")
+
+    @classmethod
+    def get_required(cls, kwargs: dict) -> set[str]:
+        if kwargs.get("engine", "script") != "script" or kwargs.get("callable"):
+            return cls.required - {"script"}
+        return cls.required
 
     def __init__(
         self,
         config,
         name: str,
         fs_uuid: str,
-        script: str,
+        script: str = "",
         luks_uuid: str | None = None,
         command: str = "bash",
         user: str | None = None,
-        stdout: str = "%(tmp)s/%(name)s.out.txt",
-        stderr: str = "%(tmp)s/%(name)s.err.txt",
+        stdout: str = "%(outputs)s/%(name)s.out.txt",
+        stderr: str = "%(outputs)s/%(name)s.err.txt",
         mount_options: str = "",
+        luks_options: str = "",
         pre_script: str | None = None,
         post_script: str | None = None,
+        output_compress: bool = False,
+        output_history: int = 1,
+        output_max_size: int = 0,
+        iostat: str = "%(outputs)s/%(name)s.iostat.csv",
+        iostat_interval: float = 0.0,
+        io_class: str | None = None,
+        io_priority: int | None = None,
+        nice: int | None = None,
+        io_max_bps: int = 0,
+        cpu_weight: int = 0,
+        memory_high: str | None = None,
+        sources: str = "",
+        preflight: str | None = None,
+        preflight_margin: float = 1.1,
+        engine: str = "script",
+        fanout: str | None = None,
+        fanout_window: float = 60.0,
+        workers: int | None = None,
+        chunk_size: int = 1024,
+        compression: str = "gzip",
+        volume_size: int = 1024,
+        priority: int = 0,
+        parallel: bool = False,
+        callable: str | None = None,
+        journal: bool = False,
+        prefetch: bool = False,
+        prefetch_read: int = 0,
+        probe: bool = False,
+        probe_size: int = 64,
+        probe_drop: int = 30,
+        keep_open: float = 0.0,
+        retention_dir: str | None = None,
+        keep_daily: int = 0,
+        keep_weekly: int = 0,
+        keep_monthly: int = 0,
+        io_scheduler: str | None = None,
+        read_ahead_kb: int = 0,
+        nr_requests: int = 0,
+        max_ratio: int = 0,
     ):
         self.config: Config = config
         self.name: str = name
         self.errors: list[str] = []
+        self.usage: ResourceUsage = ResourceUsage()
         self.fs_uuid: str = fs_uuid
         self.luks_uuid: str | None = luks_uuid
         self.luks_name: str | None = None
+        self.luks_entry: CrypttabEntry | None = None
+        self.luks_options: list[str] = shlex.split(luks_options or "")
         self.script: str = script
         self.pre_script: str | None = pre_script
         self.post_script: str | None = post_script
         self.command: list[str] = shlex.split(command)
         self.user: str | None = user
         self.mount_options: list[str] = shlex.split(mount_options)
-        self.stdout_path: str = stdout % {
-            "name": self.name,
-            "tmp": config.temp_directory,
-        }
-        self.stderr_path: str = stderr % {
-            "name": self.name,
-            "tmp": config.temp_directory,
+        self.sources: list[str] = shlex.split(sources)
+        if preflight not in (None, "", "history", "scan"):
+            raise ValueError(f"Invalid preflight {preflight} (valid: history, scan)")
+        self.preflight: str | None = preflight
+        self.preflight_margin: float = preflight_margin
+        if engine not in self.engines:
+            raise ValueError(
+                f"Invalid engine {engine} (valid: {', '.join(self.engines)})"
+            )
+        if callable:
+            check_callable_path(callable)
+            if engine != "script":
+                raise ValueError(
+                    f"option callable cannot be used with engine {engine} in [{name}]"
+                )
+        self.callable: str | None = callable
+        if journal and not self.sources:
+            raise ValueError(
+                f"option sources is required in section [{name}] with journal"
+            )
+        self.journal: bool = journal
+        self._journal_positions: dict[str, tuple[str, int]] | None = None
+        if prefetch and not self.sources:
+            raise ValueError(
+                f"option sources is required in section [{name}] with prefetch"
+            )
+        self.prefetch: bool = prefetch
+        self.prefetch_read: int = prefetch_read
+        self._prefetcher: Prefetcher | None = None
+        self.probe: bool = probe
+        self.probe_size: int = probe_size
+        self.probe_drop: int = probe_drop
+        self._probe: ProbeResult | None = None
+        self.keep_open: float = keep_open
+        self._session_lock: fasteners.InterProcessLock | None = None
+        self.slow_disk: bool = False
+        if engine != "script" and not self.sources:
+            raise ValueError(
+                f"option sources is required in section [{name}] with engine {engine}"
+            )
+        self.engine: str = engine
+        if not retention_dir and engine == "archive":
+            retention_dir = "archive"
+        if retention_dir and (
+            os.path.isabs(retention_dir)
+            or ".." in pathlib.PurePath(retention_dir).parts
+        ):
+            raise ValueError(
+                f"option retention_dir must be relative to the disk in [{name}]"
+            )
+        if (keep_daily or keep_weekly or keep_monthly) and not retention_dir:
+            raise ValueError(
+                f"option retention_dir is required in section [{name}] with keep_*"
+            )
+        self.retention_dir: str | None = retention_dir
+        self.keep_daily: int = keep_daily
+        self.keep_weekly: int = keep_weekly
+        self.keep_monthly: int = keep_monthly
+        self._pruner: Pruner | None = None
+        self.fanout: str | None = fanout
+        self.fanout_window: float = fanout_window
+        self.workers: int = workers or os.cpu_count() or 1
+        self.chunk_size: int = chunk_size
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Invalid compression {compression} (valid: {', '.join(COMPRESSIONS)})"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("compression zstd requires the zstandard package")
+        self.compression: str = compression
+        self.volume_size: int = volume_size
+        self.parallel: bool = parallel
+        self.priority: int = priority
+        self.output_compress: bool = output_compress
+        self.output_history: int = output_history
+        self.output_max_size: int = output_max_size
+        self.stdout_template: str = stdout
+        self.stderr_template: str = stderr
+        self.stdout_path: str = self.get_output_path(stdout)
+        self.stderr_path: str = self.get_output_path(stderr)
+        self.iostat_template: str = iostat
+        self.iostat_path: str = self.get_output_path(iostat)
+        self.iostat_interval: float = iostat_interval
+        self.iostat_sampler: IOSampler | None = None
+        self.throttle: Throttle | None = None
+        if (
+            io_class
+            or io_priority is not None
+            or nice is not None
+            or io_max_bps
+            or cpu_weight
+            or memory_high
+        ):
+            self.throttle = Throttle(
+                io_class,
+                io_priority,
+                nice,
+                io_max_bps=io_max_bps,
+                cpu_weight=cpu_weight,
+                memory_high=memory_high,
+            )
+        settings = {
+            "queue/scheduler": io_scheduler,
+            "queue/read_ahead_kb": read_ahead_kb,
+            "queue/nr_requests": nr_requests,
+            "bdi/max_ratio": max_ratio,
         }
+        settings = {k: str(v) for (k, v) in settings.items() if v}
+        self.tuning: BlockTuning | None = BlockTuning(settings) if settings else None
+        self.status: RunStatus | None = None
+        self.phase: str | None = None
+        self._status_device: tuple[str, int] | None = None
+        self._used_space: int | None = None
         self._is_mounted: bool = False
         self._is_luks_opened: bool = False
+        self.removed: bool = False
+        self._children: set[int] = set()
+        self._children_lock = threading.Lock()
+        self._removal_watcher: RemovalWatcher | None = None
         self._mount_dir: str | None = None
-        self._stdout_fd = None
-        self._stderr_fd = None
+        self._stdout_fd: OutputFile | None = None
+        self._stderr_fd: OutputFile | None = None
+
+    def get_output_path(self, template: str, pattern: bool = False) -> str:
+        """Return the stdout/stderr filename of the current run.
+
+        If `pattern` is True, return a glob pattern matching the files of all runs.
+        """
+        values = {
+            "name": self.name,
+            "tmp": self.config.temp_directory,
+            "outputs": self.config.output_directory,
+            "date": self.config.run_date,
+        }
+        if pattern:
+            values = {k: glob.escape(str(v)) for (k, v) in values.items()}
+            values["date"] = DATE_GLOB
+        path = template % values
+        if self.output_compress and not path.endswith(".gz"):
+            path += ".gz"
+        return path
+
+    def open_output(self, template: str, path: str) -> OutputFile | None:
+        try:
+            rotate_outputs(
+                path,
+                self.get_output_path(template, pattern=True),
+                self.output_history,
+                max_size=self.output_max_size * 1_000_000,
+            )
+            output = OutputFile(path, compress=self.output_compress)
+            output.open()
+        except Exception as e:
+            self.errors.append(f"Unable to open {path} ({e}).")
+            return None
+        return output
+
+    def get_attachments(self) -> list[str]:
+        """Return the files to attach to the report."""
+        attachments = [self.stdout_path, self.stderr_path]
+        if self.iostat_sampler:
+            attachments.append(self.iostat_path)
+        return attachments
 
     def execute(self):
-        self.set_up()
+        with self.span("set_up"):
+            self.set_up()
         if not self.errors:
-            self.execute_script("script", cwd=self._mount_dir)
-        self.tear_down()
+            self.run_job()
+        with self.span("tear_down"):
+            self.tear_down()
 
-    def set_up(self):
+    def span(self, name: str, category: str = "rule", **args):
+        return self.config.span(name, category=category, rule=self.name, **args)
+
+    def run_job(self, engine: Callable[[], bool] | None = None):
+        """Run the backup itself (with `engine` instead of the engine of the rule, if
+        given), once the disk is mounted.
+        """
+        self.stop_prefetch()
+        if self.removed:
+            return
+        start = time.monotonic()
+        checkpoint = self.get_checkpoint()
+        if checkpoint.exists():
+            self.log_text(
+                f"Resuming the interrupted run ({checkpoint.describe()}).", level=INFO
+            )
+        self.start_iostat()
+        with self.span("job", engine=self.engine) as args:
+            success = engine() if engine else self.run_engine()
+            args["success"] = success
+        self.stop_iostat()
+        if success:
+            checkpoint.clear()
+        self.add_history(success, time.monotonic() - start)
+        if success:
+            self.start_pruning()
+
+    def start_pruning(self):
+        """Delete the old entries of retention_dir in background."""
+        if not (self.keep_daily or self.keep_weekly or self.keep_monthly):
+            return
+        directory = pathlib.Path(self._mount_dir) / self.retention_dir
+        try:
+            # hidden entries are not complete snapshots (like partial archives)
+            names = [x.name for x in directory.iterdir() if not x.name.startswith(".")]
+        except OSError as e:
+            self.log_text(f"Unable to list {directory} ({e}).", level=WARNING)
+            return
+        dates = {x: date for x in names if (date := parse_date(x))}
+        kept = select_kept(dates, self.keep_daily, self.keep_weekly, self.keep_monthly)
+        removed = sorted(x for x in dates if x not in kept)
+        if not removed:
+            return
+        self.set_phase("prune")
+        self._pruner = Pruner(
+            [directory / x for x in removed],
+            workers=self.workers,
+            should_stop=lambda: self.removed,
+        )
+        self._pruner.start()
+
+    def wait_pruning(self):
+        if not self._pruner:
+            return
+        stats = self._pruner.wait()
+        self._pruner = None
+        self.log_text(f"Retention: {stats.report()}", level=INFO)
+        for error in stats.errors:
+            self.log_text(error, level=WARNING)
+
+    def get_checkpoint(self) -> Checkpoint:
+        """Return the checkpoint of an interrupted run, on the mounted file system."""
+        return Checkpoint(
+            pathlib.Path(self._mount_dir) / f".udevbackup-{self.fs_uuid}.state"
+        )
+
+    def run_engine(self) -> bool:
+        self.set_phase(self.engine)
+        if self.engine == "mirror":
+            return self.config.mirror([self])[0]
+        elif self.engine == "chunkstore":
+            return self.run_chunkstore()
+        elif self.engine == "archive":
+            return self.run_archive()
+        elif self.callable:
+            return self.run_callable()
+        env = {"UDEVBACKUP_STATE": str(self.get_checkpoint().path)}
+        if files_from := self.prepare_files_from():
+            env["UDEVBACKUP_FILES_FROM"] = files_from
         try:
-            self._stdout_fd = open(self.stdout_path, "wb")
+            return self.execute_script("script", cwd=self._mount_dir, env=env)
+        finally:
+            if files_from:
+                os.remove(files_from)
+
+    def prepare_files_from(self) -> str | None:
+        """Write the paths changed since the last successful run, for the script.
+
+        Return None if they are unknown (and a full scan is required).
+        """
+        self._journal_positions = None
+        if not self.journal:
+            return None
+        positions, paths, reason = self.get_journal_changes()
+        self._journal_positions = positions
+        if paths is None:
+            self.log_text(f"Full scan: {reason}.", level=INFO)
+            return None
+        # deleted paths would be reported as errors by `rsync --files-from`
+        existing = [x for x in paths if os.path.lexists(x)]
+        fd, path = tempfile.mkstemp(
+            prefix=f"{self.config.temp_prefix}_{self.fs_uuid}-files-from-"
+        )
+        with os.fdopen(fd, "wb") as fd:
+            fd.write(b"".join(x + b"\0" for x in existing))
+        if self.user:  # only readable by the user running the script
+            try:
+                pw = pwd.getpwnam(self.user)
+                os.chown(path, uid=pw.pw_uid, gid=pw.pw_gid)
+            except (KeyError, OSError) as e:
+                self.log_text(f"Unable to chown {path} ({e}).", level=WARNING)
+        deleted = len(paths) - len(existing)
+        self.log_text(
+            f"{len(paths)} paths changed since the last run ({deleted} deleted).",
+            level=INFO,
+        )
+        return path
+
+    def get_journal_changes(
+        self,
+    ) -> tuple[dict[str, tuple[str, int]] | None, list[bytes] | None, str]:
+        """Return the positions of the journals and the paths changed since the last
+        successful run (None and the reason if a full scan is required)."""
+        state_dir = self.config.state_dir
+        if get_watcher_pid(state_dir) is None:
+            return None, None, "the watcher is not running"
+        journals = [ChangeJournal(state_dir, x) for x in self.sources]
+        positions = {x.source: x.position() for x in journals}
+        if None in positions.values():
+            return None, None, "the sources are not watched"
+        previous = None
+        for entry in self.get_history().load():
+            if entry.get("success") and "journal" in entry:
+                previous = entry["journal"]
+        paths = []
+        for journal in journals:
+            if not previous or journal.source not in previous:
+                return positions, None, "no previous run with the watcher"
+            changes, reason = journal.changes_since(tuple(previous[journal.source]))
+            if changes is None:
+                return positions, None, reason
+            paths += changes
+        return positions, paths, ""
+
+    def start_prefetch(self):
+        """Warm the caches of the sources while the disk is unlocked and mounted."""
+        if not self.prefetch:
+            return
+        paths = self.get_journal_changes()[1] if self.journal else None
+        since = None
+        for entry in self.get_history().load():
+            if entry.get("success") and "ended_at" in entry:
+                since = entry["ended_at"] - entry.get("duration", 0)
+        self._prefetcher = Prefetcher(
+            self.sources,
+            workers=self.workers,
+            paths=paths,
+            since=since,
+            read_ahead=self.prefetch_read * 1024 * 1024,
+        )
+        self._prefetcher.start()
+
+    def stop_prefetch(self):
+        if self._prefetcher:
+            stats = self._prefetcher.stop()
+            self._prefetcher = None
+            self.log_text(f"Prefetch: {stats.report()}", level=INFO)
+
+    def run_callable(self) -> bool:
+        """Call the Python function of the rule, in a child process if required."""
+        self.log_text(f"Calling {self.callable}", INFO)
+
+        def handle(level: str, text: str):
+            if level == "error":
+                self.errors.append(text)
+            else:
+                self.log_text(text, level=WARNING if level == "warning" else INFO)
+
+        outputs = (self._stdout_fd.fileno(), self._stderr_fd.fileno())
+        if not self.user and not self.throttle:
+            success = call_redirected(
+                self.callable, self._mount_dir, Reporter(handle), outputs
+            )
+            # errors may be reported even if the function returns True
+            return success and not self.errors
+        success = run_in_worker(
+            self.callable,
+            self._mount_dir,
+            self.user,
+            handle,
+            started=functools.partial(self.callable_started, removed=self.removed),
+            outputs=outputs,
+        )
+        if not success and not self.errors:
+            self.errors.append(f"Unable to call {self.callable}.")
+        return success and not self.errors
+
+    def callable_started(self, pid: int, removed: bool = False):
+        if self.throttle:
+            self.throttle.apply(pid)
+        self.add_child(pid, removed)
+        self.set_phase("callable", child_pid=pid)
+
+    def run_archive(self) -> bool:
+        directory = pathlib.Path(self._mount_dir) / "archive" / self.config.run_date
+        self.log_text(f"Archiving sources in {directory}.", level=INFO)
+        try:
+            stats = create_archive(
+                self.sources,
+                directory,
+                compression=self.compression,
+                workers=self.workers,
+                block_size=self.chunk_size * 1024,
+                volume_size=self.volume_size * 1024 * 1024,
+                should_stop=lambda: self.removed,
+            )
         except Exception as e:
-            self.errors.append(f"Unable to open {self.stdout_path} ({e}).")
+            self.errors.append(f"Unable to archive sources in {directory} ({e}).")
+            return False
+        if stats.interrupted:
+            return False
+        for line in stats.report():
+            self.log_text(f"Archive: {line}", level=INFO)
+        for warning in stats.warnings:
+            self.log_text(warning, level=WARNING)
+        self.errors += stats.errors
+        return not stats.errors
+
+    def run_chunkstore(self) -> bool:
+        root = pathlib.Path(self._mount_dir) / "chunkstore"
+        self.log_text(f"Storing sources in {root}.", level=INFO)
+        store = ChunkStore(root, avg_size=self.chunk_size * 1024)
+        try:
+            stats = store.backup(
+                self.sources,
+                self.config.run_date,
+                self.workers,
+                checkpoint=self.get_checkpoint(),
+                should_stop=lambda: self.removed,
+            )
+        except Exception as e:
+            self.errors.append(f"Unable to store sources in {root} ({e}).")
+            return False
+        if stats.interrupted:
+            return False
+        for line in stats.report():
+            self.log_text(f"Chunkstore: {line}", level=INFO)
+        for warning in stats.warnings:
+            self.log_text(warning, level=WARNING)
+        self.errors += stats.errors
+        return not stats.errors
+
+    def is_connected(self) -> bool:
+        uuid = self.luks_uuid or self.fs_uuid
+        return (self.config.devices_root / "disk" / "by-uuid" / uuid).exists()
+
+    def ran_recently(self, delay: float) -> bool:
+        entries = self.get_history().load()
+        return bool(entries) and entries[-1].get("ended_at", 0) > time.time() - delay
+
+    def get_history(self) -> RunHistory:
+        return RunHistory(self.config.state_dir, self.fs_uuid)
+
+    def get_used_space(self) -> int | None:
+        try:
+            stat = os.statvfs(self._mount_dir)
+        except OSError:
+            return None
+        return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+    def add_history(self, success: bool, duration: float):
+        entry = {
+            "date": self.config.run_date,
+            "success": success,
+            "duration": duration,
+            "ended_at": time.time(),
+        }
+        used_space = self.get_used_space()
+        if used_space is not None and self._used_space is not None:
+            entry["written"] = max(used_space - self._used_space, 0)
+        if success and self._journal_positions:
+            entry["journal"] = self._journal_positions
+        if self._probe:
+            entry["probe"] = {"read": self._probe.read, "write": self._probe.write}
+        try:
+            self.get_history().append(entry)
+        except OSError as e:
+            self.log_text(f"Unable to write the run history ({e}).", level=WARNING)
+
+    def check_free_space(self) -> bool:
+        """Check that the mounted disk can hold the backup before running the script."""
+        self._used_space = self.get_used_space()
+        if not self.preflight:
+            return True
+        history = self.get_history()
+        duration = history.estimate("duration")
+        if duration is not None:
+            self.log_text(
+                f"Estimated duration: {format_duration(duration)}.", level=INFO
+            )
+        required = history.estimate("written")
+        if self.preflight == "scan" and (
+            required is None or self.engine not in self.incremental_engines
+        ):
+            required = scan_size(self.sources)
+        if required is None:
+            self.log_text(
+                "No previous run: unable to estimate the size of the backup.",
+                level=WARNING,
+            )
+            return True
+        stat = os.statvfs(self._mount_dir)
+        available = stat.f_bavail * stat.f_frsize
+        required *= self.preflight_margin
+        self.log_text(
+            f"Estimated size of the backup: {required / 1e6:.0f} MB "
+            f"({available / 1e6:.0f} MB available).",
+            level=INFO,
+        )
+        if required > available:
+            self.errors.append(
+                f"Not enough free space on {self.fs_uuid}: {available / 1e6:.0f} MB "
+                f"available, {required / 1e6:.0f} MB required. The script is not run."
+            )
             return False
+        return True
+
+    def start_status(self):
+        self.status = RunStatus(
+            self.config.status_directory,
+            self.name,
+            self.luks_uuid or self.fs_uuid,
+            refresh=self.get_progress,
+            interval=self.config.status_interval,
+        )
+        self.status.start()
+
+    def stop_status(self):
+        if self.status:
+            self.status.stop()
+            self.status = None
+
+    def log_text(self, text, level=INFO, duration: float | None = None):
+        self.config.log_text(text, level=level, rule=self, duration=duration)
+
+    def set_phase(self, phase: str, child_pid: int | None = None):
+        self.phase = phase
+        if self.status:
+            self.status.set_phase(phase, child_pid=child_pid)
+
+    def get_progress(self) -> dict:
+        """Return the bytes written on the file system and the last line of stdout."""
+        progress = {}
+        if self._status_device is None:
+            device = resolve_device(self.config.devices_root, self.fs_uuid)
+            stat = device and self.read_stat(device)
+            if stat:
+                self._status_device = (device, stat.write_sectors)
+        if self._status_device:
+            device, initial_sectors = self._status_device
+            if stat := self.read_stat(device):
+                written = (stat.write_sectors - initial_sectors) * SECTOR_SIZE
+                progress["bytes_written"] = written
+        if not self.output_compress:
+            progress["last_line"] = read_last_line(self.stdout_path)
+        return progress
+
+    def read_stat(self, device: str):
+        return read_device_stat(self.config.sysfs_root, self.config.procfs_root, device)
+
+    def start_iostat(self):
+        if self.iostat_interval <= 0:
+            return
+        device = resolve_device(self.config.devices_root, self.fs_uuid)
+        if not device:
+            self.log_text(
+                f"Unable to find the device of {self.fs_uuid} for I/O statistics.",
+                level=WARNING,
+            )
+            return
+        read_stat = functools.partial(
+            read_device_stat, self.config.sysfs_root, self.config.procfs_root, device
+        )
+        self.iostat_sampler = IOSampler(read_stat, interval=self.iostat_interval)
+        self.iostat_sampler.start()
+
+    def stop_iostat(self):
+        if not self.iostat_sampler:
+            return
+        self.iostat_sampler.stop()
+        for line in self.iostat_sampler.summary():
+            self.log_text(f"I/O statistics: {line}", level=INFO)
         try:
-            self._stderr_fd = open(self.stderr_path, "wb")
+            rotate_outputs(
+                self.iostat_path,
+                self.get_output_path(self.iostat_template, pattern=True),
+                self.output_history,
+                max_size=self.output_max_size * 1_000_000,
+            )
+            self.iostat_sampler.write_csv(self.iostat_path)
         except Exception as e:
-            self.errors.append(f"Unable to open {self.stderr_path} ({e}).")
+            self.log_text(f"Unable to write {self.iostat_path} ({e}).", level=WARNING)
+
+    def start_removal_watch(self):
+        uuid = self.luks_uuid or self.fs_uuid
+        self._removal_watcher = RemovalWatcher(
+            self.config.devices_root / "disk" / "by-uuid" / uuid,
+            removal_marker(self.config.run_dir, uuid),
+            self.abort,
+            interval=self.config.removal_check_interval,
+        )
+        self._removal_watcher.start()
+
+    def stop_removal_watch(self):
+        if self._removal_watcher:
+            self._removal_watcher.stop()
+            self._removal_watcher = None
+
+    def abort(self):
+        """Stop the run as soon as possible, since the device has been removed.
+
+        Called by the thread of the removal watcher: the child processes are killed,
+        the error is reported by the main thread at the end of the tear down.
+        A Python function called in-process (callable without user nor throttling)
+        cannot be aborted: the run goes on until it returns.
+        """
+        with self._children_lock:
+            # set before the snapshot: the commands started later are not killed
+            self.removed = True
+            children = list(self._children)
+        self.set_phase("aborted")
+        kill_process_groups(children)
+
+    def add_child(self, pid: int, removed: bool):
+        """Register a child process, killed by `abort`.
+
+        `removed` is the value of `self.removed` when the child was started: a child
+        started just before the removal, but registered after it, is killed now.
+        """
+        with self._children_lock:
+            self._children.add(pid)
+            aborted = self.removed and not removed
+        if aborted:
+            kill_process_groups([pid])
+
+    def set_up(self):
+        self.start_removal_watch()
+        self._stdout_fd = self.open_output(self.stdout_template, self.stdout_path)
+        if not self._stdout_fd:
             return False
+        self._stderr_fd = self.open_output(self.stderr_template, self.stderr_path)
+        if not self._stderr_fd:
+            return False
+        self.set_up_throttle()
         if not self.execute_script("pre_script", cwd=None):
             return False
 
+        if not self.open_session() and (self.errors or not self.unlock_and_mount()):
+            return False
+        self.set_up_tuning()
+        self.run_probe()
+        return self.check_free_space()
+
+    def unlock_and_mount(self) -> bool:
+        """Open the LUKS device (if any) and mount the file system."""
         if self.luks_uuid and self.luks_name:
-            cmd = ["cryptdisks_start", self.luks_name]
+            cmd = self.get_luks_command()
             if not self.execute_command(cmd):
                 self.errors.append(f"Unable to open LUKS device {self.luks_uuid}")
                 return False
             self._is_luks_opened = True
-            timeout = time.time() + self.config.luks_open_timeout
-            while not (
-                self.config.devices_root / "disk" / "by-uuid" / self.fs_uuid
-            ).exists():
-                if time.time() > timeout:
-                    self.errors.append(
-                        f"Timeout waiting for device {self.fs_uuid} after opening LUKS"
-                    )
-                    return False
-                time.sleep(0.5)
+            if not self.wait_for_device():
+                return False
 
         self._mount_dir = tempfile.mkdtemp(
             prefix=f"{self.config.temp_prefix}_{self.fs_uuid}-"
@@ -192,59 +1003,298 @@ class Rule(ConfigSection):
             self._is_mounted = True
         return self._is_mounted
 
+    def open_session(self) -> bool:
+        """Reuse the disk left unlocked and mounted by a previous run (keep_open).
+
+        Return False if the disk must be mounted (or if the session is used by another
+        run for too long, with an error).
+        """
+        if not self.keep_open:
+            return False
+        sessions = self.config.session_cache
+        lock = sessions.lock(self.fs_uuid)
+        if not lock.acquire(timeout=SESSION_LOCK_TIMEOUT):
+            self.errors.append(
+                f"The session of {self.fs_uuid} is used by another run: unable to "
+                f"lock it within {SESSION_LOCK_TIMEOUT:.0f} s."
+            )
+            return False
+        self._session_lock = lock
+        session = sessions.load(self.fs_uuid)
+        if session is None:
+            return False
+        if not self.config.is_mounted(session["mount_dir"]):
+            self.log_text(
+                f"The disk is no longer mounted on {session['mount_dir']}.",
+                level=WARNING,
+            )
+            self.config.close_session(session)
+            return False
+        self._mount_dir = session["mount_dir"]
+        self._is_mounted = True
+        self._is_luks_opened = bool(session["luks_name"])
+        opened = format_duration(time.time() - session["opened_at"])
+        self.log_text(
+            f"Reusing the disk mounted on {self._mount_dir} (opened {opened} ago).",
+            level=INFO,
+        )
+        return True
+
+    def keep_session(self) -> bool:
+        """Leave the disk unlocked and mounted for the next runs (keep_open)."""
+        if not self.keep_open or not self._is_mounted or self.errors or self.removed:
+            return False
+        # the disk is not unmounted: its data must be written now
+        if not self.execute_command(["sync", "-f", self._mount_dir]):
+            return False
+        self.config.session_cache.save(
+            self.fs_uuid,
+            self._mount_dir,
+            self.luks_name if self._is_luks_opened else None,
+            self.luks_uuid or self.fs_uuid,
+            self.keep_open,
+        )
+        self.log_text(
+            f"The disk stays mounted on {self._mount_dir} for "
+            f"{format_duration(self.keep_open)}.",
+            level=INFO,
+        )
+        self.schedule_close()
+        return True
+
+    def schedule_close(self):
+        """Run `udevbackup close` through `at` once the session has expired."""
+        minutes = math.ceil(self.keep_open / 60)
+        cmd = shlex.join(get_command() + ["close", "-C", self.config.config_dir])
+        try:
+            p = subprocess.Popen(  # nosec B603 B607
+                ["at", f"now + {minutes} minutes"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            p.communicate(cmd.encode())
+            error = f"exit code {p.returncode}" if p.returncode else None
+        except OSError as e:
+            error = str(e)
+        if error:
+            self.log_text(
+                f"Unable to schedule `{cmd}` ({error}): the session is closed by the "
+                "next run or by `udevbackup close`.",
+                level=WARNING,
+            )
+
+    def run_probe(self):
+        """Measure the throughput of the disk and compare it with the previous runs."""
+        if not self.probe:
+            return
+        with self.span("probe"):
+            try:
+                self._probe = probe_throughput(
+                    self._mount_dir, self.probe_size * 1024 * 1024
+                )
+            except OSError as e:
+                self.log_text(f"Unable to measure the throughput ({e}).", WARNING)
+                return
+        self.log_text(f"Disk throughput: {self._probe.summary()}.", level=INFO)
+        previous = [x["probe"] for x in self.get_history().load() if "probe" in x]
+        for message in compare_probes(self._probe, previous, self.probe_drop / 100):
+            self.slow_disk = True
+            self.log_text(f"Slow disk: {message}.", level=WARNING)
+
+    def get_luks_command(self) -> list[str]:
+        """Return the command opening the LUKS device, with the options of crypttab.
+
+        cryptdisks_start is used when crypttab has options unknown to udevbackup.
+        """
+        entry = self.luks_entry
+        if entry is None:
+            return ["cryptdisks_start", self.luks_name]
+        args, unsupported = entry.cryptsetup_args()
+        if unsupported:
+            self.log_text(
+                f"Unsupported options in {self.config.crypttab} "
+                f"({', '.join(unsupported)}): using cryptdisks_start.",
+                level=WARNING if self.luks_options else INFO,
+            )
+            return ["cryptdisks_start", self.luks_name]
+        device = self.config.devices_root / "disk" / "by-uuid" / self.luks_uuid
+        return (
+            ["cryptsetup", "open"]
+            + args
+            + ["--key-file", entry.key_file]
+            + self.luks_options
+            + [str(device), entry.name]
+        )
+
+    def wait_for_device(self) -> bool:
+        """Wait for the file system, once the LUKS device is opened."""
+        timeout = time.time() + self.config.luks_open_timeout
+        with self.span("wait for device"):
+            while not (
+                self.config.devices_root / "disk" / "by-uuid" / self.fs_uuid
+            ).exists():
+                if time.time() > timeout:
+                    self.errors.append(
+                        f"Timeout waiting for device {self.fs_uuid} after opening LUKS"
+                    )
+                    return False
+                time.sleep(0.5)
+        return True
+
+    def set_up_tuning(self):
+        """Apply the block-device settings to the disk of the file system."""
+        if not self.tuning:
+            return
+        device = resolve_device(
+            self.config.devices_root, self.luks_uuid or self.fs_uuid
+        )
+        if not device:
+            self.log_text(
+                f"Unable to find the disk of {self.fs_uuid}: it is not tuned.",
+                level=WARNING,
+            )
+            return
+        disk = parent_device(self.config.sysfs_root, device)
+        for error in self.tuning.apply(self.config.sysfs_root, disk):
+            self.log_text(error, level=WARNING)
+
+    def set_up_throttle(self):
+        """Create the cgroup limiting the resources of the commands."""
+        if not self.throttle or not self.throttle.uses_cgroup:
+            return
+        sysfs_root = self.config.sysfs_root
+        numbers = None
+        device = resolve_device(
+            self.config.devices_root, self.luks_uuid or self.fs_uuid
+        )
+        if device:
+            numbers = device_numbers(sysfs_root, parent_device(sysfs_root, device))
+        if self.throttle.io_max_bps and not numbers:
+            self.log_text(
+                f"Unable to find the disk of {self.fs_uuid}: I/O bandwidth is not limited.",
+                level=WARNING,
+            )
+        try:
+            self.throttle.create_cgroup(self.config.cgroup_root, self.fs_uuid, numbers)
+        except OSError as e:
+            self.log_text(
+                f"Unable to create a cgroup ({e}): only nice and I/O class are applied.",
+                level=WARNING,
+            )
+
     def tear_down(self):
+        self.wait_pruning()
         was_mounted = self._is_mounted
-        if was_mounted:
-            if self.execute_command(["umount", self._mount_dir]):
+        kept = self.keep_session()
+        if was_mounted and not kept:
+            # lazy unmount: the removed device cannot be synced
+            umount = ["umount", "-l"] if self.removed else ["umount"]
+            if self.execute_command(umount + [self._mount_dir]):
                 self._is_mounted = False
+        if self.tuning:
+            for error in self.tuning.restore():
+                self.log_text(error, level=WARNING)
         if self._is_luks_opened and not self._is_mounted:
-            if self.execute_command(["cryptsetup", "close", self.luks_name]):
+            close = ["cryptsetup", "close"] + (["--deferred"] if self.removed else [])
+            if self.execute_command(close + [self.luks_name]):
                 self._is_luks_opened = False
         if self._mount_dir and not self._is_mounted:
             os.rmdir(self._mount_dir)
             self._mount_dir = None
         if was_mounted:
             self.execute_script("post_script", cwd=None)
-        if self._stderr_fd:
-            self._stderr_fd.close()
-        if self._stdout_fd:
-            self._stdout_fd.close()
+        for output in (self._stderr_fd, self._stdout_fd):
+            if output:
+                output.close()
+                if output.error:
+                    self.log_text(output.error, level=WARNING)
+        self._stderr_fd = self._stdout_fd = None
+        if self.throttle:
+            self.throttle.remove_cgroup()
+        if self._session_lock:
+            if not self._is_mounted:
+                self.config.session_cache.remove(self.fs_uuid)
+            self._session_lock.release()
+            self._session_lock = None
+        self.log_text(
+            f"Resources used by {self.name}: {self.usage.summary()}.", level=INFO
+        )
+        self.stop_removal_watch()
+        if self.removed:
+            self.errors.append(
+                f"Device {self.luks_uuid or self.fs_uuid} has been removed: "
+                "the run is aborted."
+            )
+            self.log_text(self.errors[-1], level=ERROR)
 
-    def execute_script(self, script_attr_name: str, cwd: str = None) -> bool:
+    def execute_script(
+        self, script_attr_name: str, cwd: str = None, env: dict[str, str] | None = None
+    ) -> bool:
         script_content = getattr(self, script_attr_name)
         if not script_content:
             return True
+        if self.removed:
+            return False
         with tempfile.NamedTemporaryFile(
             prefix=f"{self.config.temp_prefix}_{self.fs_uuid}-{script_attr_name}"
         ) as fd:
             fd.write(script_content.encode())
             fd.flush()
             if self.user:
-                command = ["sudo", "-Hu", self.user] + self.command + [fd.name]
+                # sudo resets the environment
+                variables = [f"{k}={v}" for (k, v) in (env or {}).items()]
+                command = ["sudo", "-Hu", self.user]
+                command += (["env"] + variables if variables else []) + self.command
+                command += [fd.name]
             else:
                 command = self.command + [fd.name]
-            return self.execute_command(command, cwd=cwd, attr_name=script_attr_name)
+            return self.execute_command(
+                command, cwd=cwd, attr_name=script_attr_name, env=env
+            )
 
     def execute_command(
-        self, command: list[str], cwd: str | None = None, attr_name: str | None = None
+        self,
+        command: list[str],
+        cwd: str | None = None,
+        attr_name: str | None = None,
+        env: dict[str, str] | None = None,
     ) -> bool:
         title = attr_name or " ".join(command)
         ret_code = -1
-        self.config.log_text(f"Executing command {title}", INFO)
-        try:
-            p = subprocess.Popen(
-                command,
-                cwd=cwd,
-                stderr=self._stderr_fd,
-                stdout=self._stdout_fd,
-                stdin=subprocess.PIPE,
-            )
-            p.communicate(b"")
-            ret_code = p.returncode
-            if ret_code != 0:
-                self.errors.append(f"Unable to execute command {title}.")
-        except Exception as e:
-            self.errors.append(f"Unable to execute command {title} ({e}).")
+        self.log_text(f"Executing command {title}", INFO)
+        start = time.monotonic()
+        name = attr_name or command[0]
+        with self.span(name, category="command", command=command) as args:
+            try:
+                removed = self.removed
+                p = subprocess.Popen(
+                    self.throttle.wrap(command) if self.throttle else command,
+                    cwd=cwd,
+                    stderr=self._stderr_fd,
+                    stdout=self._stdout_fd,
+                    stdin=subprocess.DEVNULL,
+                    env={**os.environ, **env} if env else None,
+                    # its own process group, to be killed if the device is removed
+                    start_new_session=True,
+                )
+                self.add_child(p.pid, removed)
+                self.set_phase(name, child_pid=p.pid)
+                usage = wait_process(p, self.config.procfs_root)
+                with self._children_lock:
+                    self._children.discard(p.pid)
+                self.usage += usage
+                self.log_text(
+                    f"Resources of {title}: {usage.summary()}.",
+                    INFO,
+                    duration=time.monotonic() - start,
+                )
+                ret_code = p.returncode
+                if ret_code != 0:
+                    self.errors.append(f"Unable to execute command {title}.")
+            except Exception as e:
+                self.errors.append(f"Unable to execute command {title} ({e}).")
+            args["returncode"] = ret_code
         return ret_code == 0
 
 
@@ -259,7 +1309,20 @@ class Config(ConfigSection):
         "smtp_from_email": 'E-mail address for the FROM: value. Default to "".',
         "smtp_to_email": "Recipient of the e-mail. Required to send e-mails.",
         "log_file": "Name of the global log file.",
+        "log_format": '"text" to write messages as plain lines in log_file, "json" to write '
+        "JSON lines with time, run id, rule, phase, level and duration (see "
+        '`udevbackup logs`). Default to "text".',
         "lock_file": "Name of a global lock file to avoid parallel runs.",
+        "spool_dir": "Queue e-mails in this directory; they are sent by a background process "
+        "(or by `udevbackup flush`), with retries. "
+        'Default to "" (e-mails are sent before the end of the run).',
+        "run_dir": "Directory of the runtime files: queue of the runs waiting for lock_file "
+        'and status of the running rules. Default to "/run/udevbackup".',
+        "state_dir": "Directory storing the history of the runs of each disk. "
+        'Default to "/var/lib/udevbackup".',
+        "output_dir": "Directory of the stdout/stderr files (%(outputs)s in their names). "
+        "Use a disk-backed directory (like /var/log/udevbackup) to keep large outputs "
+        "out of a tmpfs. Default to the temporary directory.",
     }
     bool_options = {
         "use_stdout": "Display messages on stdout. Default to 0.",
@@ -268,8 +1331,29 @@ class Config(ConfigSection):
         "use_log_file": "Write all errors to the log file. Default to 1.",
         "smtp_use_tls": "Use TLS (smtps) for emails. Default to 0.",
         "smtp_use_starttls": "Use STARTTLS for emails. Default to 0.",
+        "trace": "Write the timeline of each run (lock wait, set up, commands, tear down, "
+        "e-mail) as a Chrome trace-event file (readable by https://ui.perfetto.dev) in the "
+        "output directory, attached to the e-mail. Default to 0.",
+    }
+    int_options = {
+        "smtp_smtp_port": "The SMTP port. Default to 25.",
+        "spool_max_attempts": "Number of attempts to send queued e-mails; an e-mail refused "
+        "this many times by the server is moved to the quarantine sub-directory of "
+        "spool_dir. Default to 8.",
+        "log_max_size": "Rotate log_file when it is larger than N MB (0 to disable the "
+        "rotation). Default to 10 with log_format = json, 0 with text.",
+        "log_backups": "Number of rotated log files to keep (log_file.1, log_file.2…). "
+        "Default to 5.",
+    }
+    float_options = {
+        "status_interval": "Update the status of the running rules (see `udevbackup status`) "
+        "every N seconds. Default to 5 (0 to update it only at each phase change).",
+        "partition_wait": "When a disk has several configured partitions, maximum time "
+        "(in seconds) to wait for all of them before backing them up in a single session. "
+        "Default to 10 (0 to back up each partition on its own).",
+        "spool_retry_delay": "Delay (in seconds) before the second attempt to send queued "
+        "e-mails, doubled after each failure. Default to 30.",
     }
-    int_options = {"smtp_smtp_port": "The SMTP port. Default to 25."}
 
     def __init__(
         self,
@@ -285,7 +1369,19 @@ class Config(ConfigSection):
         use_smtp: bool = False,
         use_log_file: bool = True,
         log_file: str | None = None,
+        log_format: str = "text",
+        log_max_size: int | None = None,
+        log_backups: int = 5,
         lock_file: str | None = None,
+        output_dir: str | None = None,
+        state_dir: str = "/var/lib/udevbackup",
+        run_dir: str = "/run/udevbackup",
+        spool_dir: str | None = None,
+        spool_max_attempts: int = 8,
+        spool_retry_delay: float = 30.0,
+        partition_wait: float = 10.0,
+        status_interval: float = 5.0,
+        trace: bool = False,
     ):
 
         self.use_smtp = use_smtp
@@ -298,36 +1394,80 @@ class Config(ConfigSection):
         self.smtp_use_starttls: bool = smtp_use_starttls
         self.smtp_use_tls: bool = smtp_use_tls
 
+        self.spool_dir: str | None = spool_dir
+        self.spool_max_attempts: int = spool_max_attempts
+        self.spool_retry_delay: float = spool_retry_delay
+
         self.use_stdout: bool = use_stdout
 
         self.use_log_file: bool = use_log_file
         self.log_file: str | None = log_file
+        if log_format not in LOG_FORMATS:
+            raise ValueError(f"Invalid log format {log_format}")
+        self.log_format: str = log_format
+        if log_max_size is None:
+            # text logs are usually rotated by logrotate
+            log_max_size = 10 if log_format == "json" else 0
+        self.log_max_size: int = log_max_size
+        self.log_backups: int = log_backups
 
         self.lock_file: str | None = lock_file
+        self.partition_wait: float = partition_wait
+
+        self.output_dir: str | None = output_dir
+        self.state_dir: str = state_dir
+        self.run_dir: str = run_dir
+        self.status_interval: float = status_interval
+        self.run_date: str = time.strftime(DATE_FORMAT)
+        self.run_id: str = uuid.uuid4().hex[:12]
+        self.trace: bool = trace
+        self.tracer: Tracer | None = None
 
         self.rules: dict[str, Rule] = {}  # rules[fs_uuid] = Rule()
 
         self._log_content: str = ""
+        self._log_lock = threading.Lock()
 
         self.temp_prefix: str = "udevbackup_"
+        self.config_dir: str = "/etc/udevbackup"  # set by load_config
+        # set by load_config when only the drop-ins of connected devices are read
+        self.load_drop_ins: Callable[[set[str]], None] | None = None
         # these constants simplify tests
-        self.devices_root: pathlib.Path = pathlib.Path("/dev/disk")
+        self.devices_root: pathlib.Path = pathlib.Path("/dev")
+        self.sysfs_root: pathlib.Path = pathlib.Path("/sys")
+        self.procfs_root: pathlib.Path = pathlib.Path("/proc")
+        self.cgroup_root: pathlib.Path = pathlib.Path("/sys/fs/cgroup")
         self.crypttab: pathlib.Path = pathlib.Path("/etc/crypttab")
         self.temp_directory: pathlib.Path = pathlib.Path(tempfile.gettempdir())
         self.luks_open_timeout: float = 300.0  # seconds
+        self.removal_check_interval: float = 1.0  # seconds
         self.stdout = sys.stdout
         self.stderr = sys.stderr
 
+    @property
+    def output_directory(self) -> pathlib.Path:
+        if self.output_dir:
+            return pathlib.Path(self.output_dir)
+        return self.temp_directory
+
     def register(self, rule: Rule):
         self.rules[rule.luks_uuid or rule.fs_uuid] = rule
 
+    def get_connected_uuids(self) -> list[str]:
+        """Return the UUID of all connected file systems (and LUKS devices)."""
+        root = self.devices_root / "disk" / "by-uuid"
+        if not root.is_dir():
+            return []
+        return [x.name for x in root.iterdir()]
+
     def identify_cryptodevices(self):
         """Parse /etc/crypttab to get the mapping between LUKS UUID and name."""
-        luks_names = self.get_luks_names()
+        entries = self.get_crypttab_entries()
         for rule in self.rules.values():
-            rule.luks_name = luks_names.get(rule.luks_uuid)
+            rule.luks_entry = entries.get(rule.luks_uuid)
+            rule.luks_name = rule.luks_entry.name if rule.luks_entry else None
 
-    def get_luks_names(self) -> dict[str, str]:
+    def get_crypttab_entries(self) -> dict[str, CrypttabEntry]:
         content = ""
         if not self.crypttab.is_file():
             return {}
@@ -338,24 +1478,20 @@ class Config(ConfigSection):
             self.log_text(
                 "Unable to read /etc/crypttab (permission denied).", level=WARNING
             )
-        return self.parse_crypttab(content)
+        return self.parse_crypttab_entries(content)
 
     def parse_crypttab(self, content: str) -> dict[str, str]:
+        return {k: v.name for k, v in self.parse_crypttab_entries(content).items()}
+
+    def parse_crypttab_entries(self, content: str) -> dict[str, CrypttabEntry]:
+        """Return the crypttab entries (with a key file) by LUKS UUID."""
         aliases = self.load_device_aliases()
-        luks_uuid_to_luks_name: dict[str, str] = {}
+        entries: dict[str, CrypttabEntry] = {}
         for line in content.splitlines():
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            parts = line.split()
-            if len(parts) < 4:
-                continue
-            name = parts[0]
-            device = parts[1]
-            key = parts[2]
-            if device in aliases and key != "none":
-                luks_uuid_to_luks_name[aliases[device]] = name
-        return luks_uuid_to_luks_name
+            entry = parse_entry(line)
+            if entry and entry.device in aliases and entry.key_file != "none":
+                entries[aliases[entry.device]] = entry
+        return entries
 
     def load_device_aliases(self) -> dict[str, str]:
         synonyms: dict[str, str] = {}
@@ -385,46 +1521,483 @@ class Config(ConfigSection):
             # no message: we don't want a message everytime a device is connected
             return False
         os.chdir(self.temp_directory)
-        rule: Rule = self.rules[fs_uuid]
+        self.close_expired_sessions()
+        if self.trace:
+            self.tracer = Tracer(f"udevbackup {fs_uuid}")
+        with self.span("run", category="run", device=fs_uuid) as args:
+            args["success"] = self.run_device(fs_uuid)
+        self.write_trace()
+        return args["success"]
+
+    def span(self, name: str, category: str = "run", **args):
+        """Record a span of the trace of the run (if enabled)."""
+        if self.tracer:
+            return self.tracer.span(name, category=category, **args)
+        return nullcontext({})
+
+    @property
+    def trace_path(self) -> pathlib.Path:
+        return (
+            self.output_directory
+            / f"udevbackup-{self.run_date}-{self.run_id}.trace.json"
+        )
 
+    def write_trace(self) -> str | None:
+        """Write the trace of the run (also the unfinished spans) and return its path."""
+        if not self.tracer:
+            return None
+        path = self.trace_path
+        try:
+            if not path.exists():
+                pattern = str(self.output_directory / "udevbackup-*.trace.json")
+                rotate_outputs(str(path), pattern, TRACE_HISTORY)
+            self.tracer.write(path)
+        except OSError as e:
+            self.log_text(f"Unable to write {path} ({e}).", level=WARNING)
+            return None
+        return str(path)
+
+    def run_device(self, fs_uuid: str) -> bool:
+        rule: Rule = self.rules[fs_uuid]
         self.log_text(f"Device {fs_uuid} is connected.", level=INFO)
+        if rule.fanout:
+            return self.run_fanout(rule)
+        disk = self.get_disk(rule) if self.partition_wait > 0 else None
+        if disk:
+            return self.run_disk(rule, disk)
+        self.execute_locked(rule.execute, [rule])
+        self.report(rule.name, [rule])
+        self.log_text(f"Device {fs_uuid} can be disconnected.", level=INFO)
+        return len(rule.errors) == 0
+
+    def execute_locked(self, action: Callable, rules: list[Rule]):
+        """Execute the action while holding the global lock.
+
+        Processes waiting for the lock are queued by priority of their rules.
+        """
+        for rule in rules:
+            rule.start_status()
+            rule.start_prefetch()
         try:
-            if self.lock_file:
-                self.log_text(f"Waiting for {self.lock_file}.", level=INFO)
-                with fasteners.InterProcessLock(self.lock_file):
-                    self.log_text(f"{self.lock_file} acquired.", level=INFO)
-                    rule.execute()
-                    self.log_text(f"{self.lock_file} release.", level=INFO)
-            else:
-                rule.execute()
+            self.execute_queued(action, rules)
+        finally:
+            for rule in rules:
+                rule.stop_prefetch()
+                rule.stop_status()
+
+    def execute_queued(self, action: Callable, rules: list[Rule]):
+        if not self.lock_file:
+            try:
+                action()
+            except Exception as e:
+                self.log_text(f"An error happened: {e}.")
+            return
+        queue = self.job_queue
+        job_id = None
+        try:
+            job_id = queue.add(
+                " + ".join(x.name for x in rules),
+                rules[0].luks_uuid or rules[0].fs_uuid,
+                max(x.priority for x in rules),
+            )
+            self.log_text(f"Waiting for {self.lock_file} (job {job_id}).", level=INFO)
+            for rule in rules:
+                rule.set_phase("waiting")
+            lock = fasteners.InterProcessLock(self.lock_file)
+            with self.span("lock wait", category="lock", job=job_id):
+                if not queue.wait(job_id):
+                    for rule in rules:
+                        rule.errors.append(f"Job {job_id} has been cancelled.")
+                    return
+                lock.acquire()
+            try:
+                self.log_text(f"{self.lock_file} acquired.", level=INFO)
+                action()
+                self.log_text(f"{self.lock_file} release.", level=INFO)
+            finally:
+                lock.release()
         except Exception as e:
             self.log_text(f"An error happened: {e}.")
-        if rule.errors:
+        finally:
+            if job_id:
+                queue.remove(job_id)
+
+    @property
+    def status_directory(self) -> pathlib.Path:
+        return pathlib.Path(self.run_dir) / "status"
+
+    @property
+    def job_queue(self) -> JobQueue:
+        return JobQueue(pathlib.Path(self.run_dir) / "queue")
+
+    @property
+    def session_cache(self) -> SessionCache:
+        return SessionCache(pathlib.Path(self.run_dir) / "sessions")
+
+    def is_mounted(self, path: str) -> bool:
+        return os.path.ismount(path)
+
+    def close_expired_sessions(self, close_all: bool = False) -> bool:
+        """Close the disks left open by keep_open, once expired or removed.
+
+        Sessions used by a run are locked, and skipped.
+        """
+        success = True
+        sessions = self.session_cache
+        for session in sessions.sessions():
+            lock = sessions.lock(session["fs_uuid"])
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                # the session may have been refreshed before the lock was acquired
+                session = sessions.load(session["fs_uuid"])
+                if session and (
+                    close_all
+                    or session["expires_at"] < time.time()
+                    or self.is_removed(session)
+                ):
+                    success = self.close_session(session) and success
+            finally:
+                lock.release()
+        return success
+
+    def is_removed(self, session: dict) -> bool:
+        path = self.devices_root / "disk" / "by-uuid" / session["device_uuid"]
+        return not os.path.lexists(path)
+
+    def close_session(self, session: dict) -> bool:
+        """Unmount and close the disk of a locked session, then forget it."""
+        mount_dir = session["mount_dir"]
+        # lazy unmount: the removed device cannot be synced
+        lazy = self.is_removed(session)
+        commands = []
+        if self.is_mounted(mount_dir):
+            commands.append(["umount"] + (["-l"] if lazy else []) + [mount_dir])
+        if session["luks_name"]:
+            close = ["cryptsetup", "close"] + (["--deferred"] if lazy else [])
+            commands.append(close + [session["luks_name"]])
+        for command in commands:
+            try:
+                p = subprocess.Popen(  # nosec B603
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                p.communicate()
+                error = f"return code {p.returncode}" if p.returncode else None
+            except OSError as e:
+                error = str(e)
+            if error:
+                self.log_text(
+                    f"Unable to close the session of {session['fs_uuid']}: "
+                    f"`{' '.join(command)}` failed ({error}).",
+                    level=ERROR,
+                )
+                return False
+        try:
+            os.rmdir(mount_dir)
+        except OSError:
+            pass
+        self.session_cache.remove(session["fs_uuid"])
+        self.log_text(
+            f"The disk {session['fs_uuid']} is unmounted (session closed).", level=INFO
+        )
+        return True
+
+    def report(self, name: str, rules: list[Rule]):
+        """Log the result of the rules, and send it by e-mail."""
+        errors = []
+        for rule in rules:
+            prefix = f"[{rule.name}] " if len(rules) > 1 else ""
+            errors += [f"{prefix}{error}" for error in rule.errors]
+        if errors:
             self.log_text("An error happened.", level=ERROR)
-            for error in rule.errors:
+            for error in errors:
                 self.log_text(error, level=ERROR)
         else:
             self.log_text("Successful.", level=INFO)
+        trace_path = self.write_trace()
         if self.use_smtp:
-            subject = str(rule.name)
-            if rule.errors:
+            subject = str(name)
+            if errors or not rules:
                 subject += " [KO]"
             else:
                 subject += " [OK]"
-            self.send_email(
-                self._log_content,
-                subject=subject,
-                attachments=[rule.stdout_path, rule.stderr_path],
+            if any(x.slow_disk for x in rules):
+                subject += " [SLOW DISK]"
+            attachments = [x for rule in rules for x in rule.get_attachments()]
+            if trace_path:
+                attachments.append(trace_path)
+            with self.span("email", category="email"):
+                if self.spool_dir:
+                    self.spool_email(
+                        self._log_content, subject=subject, attachments=attachments
+                    )
+                else:
+                    self.send_email(
+                        self._log_content, subject=subject, attachments=attachments
+                    )
+
+    def run_fanout(self, rule: Rule) -> bool:
+        """Back up all the connected disks of the fan-out group of the rule."""
+        group = [x for x in self.rules.values() if x.fanout == rule.fanout]
+        window = max(x.fanout_window for x in group)
+
+        def get_rules():
+            rules = [rule]
+            for other in group:
+                if other is rule:
+                    continue
+                if other.ran_recently(window):
+                    self.log_text(
+                        f"{other.name} has been backed up less than {window:.0f} s ago.",
+                        level=INFO,
+                    )
+                else:
+                    rules.append(other)
+            return self.wait_for_devices(rules, window)
+
+        return self.run_session(f"fan-out {rule.fanout}", rule, get_rules, fanout=True)
+
+    def run_disk(self, rule: Rule, disk: str) -> bool:
+        """Back up all the configured partitions of the disk in a single session."""
+        get_rules = functools.partial(self.wait_for_partitions, rule, disk)
+        return self.run_session(f"disk {disk}", rule, get_rules, fanout=False)
+
+    def run_session(
+        self,
+        title: str,
+        rule: Rule,
+        get_rules: Callable[[], list[Rule]],
+        fanout: bool = False,
+    ) -> bool:
+        """Execute several rules together, with a single report.
+
+        Only one process handles a given session at a time: other events wait for the
+        end of the running session. Devices backed up by this session are not backed
+        up again; other ones (like a disk of a fan-out group connected after the end
+        of its window) are backed up in a new session.
+        """
+        name = "udevbackup-" + title.replace(" ", "-").replace("/", "_")
+        lock = fasteners.InterProcessLock(self.temp_directory / f"{name}.lock")
+        record = self.temp_directory / f"{name}.json"
+        started_at = time.time()
+        lock.acquire()
+        rules = [rule]
+        try:
+            handled = self.read_session_record(record, started_at)
+            if (rule.luks_uuid or rule.fs_uuid) in handled:
+                self.log_text(
+                    f"{rule.name} has been backed up by the {title} of another process.",
+                    level=INFO,
+                )
+                return True
+            rules = [
+                x
+                for x in get_rules()
+                if x is rule or (x.luks_uuid or x.fs_uuid) not in handled
+            ]
+            name = rule.fanout or " + ".join(x.name for x in rules)
+            action = functools.partial(self.execute_session, rules, fanout=fanout)
+            self.execute_locked(action, rules)
+            self.write_session_record(record, rules)
+            self.report(name, rules)
+        finally:
+            lock.release()
+        for other in rules:
+            self.log_text(
+                f"Device {other.luks_uuid or other.fs_uuid} can be disconnected.",
+                level=INFO,
             )
-        self.log_text(f"Device {fs_uuid} can be disconnected.", level=INFO)
-        return len(rule.errors) == 0
+        return all(not x.errors for x in rules)
+
+    @staticmethod
+    def read_session_record(path: pathlib.Path, since: float) -> set[str]:
+        """Return the UUIDs of the devices of the last session, if it ended after
+        `since`.
+        """
+        try:
+            content = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return set()
+        if content.get("ended_at", 0) < since:
+            return set()
+        return set(content.get("uuids", []))
 
-    def log_text(self, text, level=INFO):
+    def write_session_record(self, path: pathlib.Path, rules: list[Rule]):
+        content = {
+            "uuids": [x.luks_uuid or x.fs_uuid for x in rules],
+            "ended_at": time.time(),
+        }
+        try:
+            path.write_text(json.dumps(content), encoding="utf-8")
+        except OSError as e:
+            self.log_text(f"Unable to write {path} ({e}).", level=WARNING)
+
+    def wait_for_devices(self, rules: list[Rule], window: float) -> list[Rule]:
+        """Wait (at most `window` seconds) for the devices and return the connected ones."""
+        timeout = time.time() + window
+        while True:
+            connected = [x for x in rules if x.is_connected()]
+            if len(connected) == len(rules) or time.time() >= timeout:
+                break
+            time.sleep(0.5)
+        for rule in rules:
+            if rule not in connected:
+                self.log_text(
+                    f"Device {rule.luks_uuid or rule.fs_uuid} ({rule.name}) "
+                    "is not connected.",
+                    level=WARNING,
+                )
+        return connected
+
+    def get_disk(self, rule: Rule) -> str | None:
+        """Return the name of the disk of the partition of a rule, if connected."""
+        device = resolve_device(self.devices_root, rule.luks_uuid or rule.fs_uuid)
+        if not device:
+            return None
+        disk = parent_device(self.sysfs_root, device)
+        return disk if disk != device else None
+
+    def wait_for_partitions(self, rule: Rule, disk: str) -> list[Rule]:
+        """Wait until udev has processed all partitions of the disk.
+
+        Return the rules of the partitions of this disk, starting with `rule`.
+        """
+        timeout = time.time() + self.partition_wait
+        while time.time() < timeout:
+            processed = set()
+            for method in ("uuid", "partuuid"):
+                root = self.devices_root / "disk" / f"by-{method}"
+                if root.is_dir():
+                    processed |= {x.resolve().name for x in root.iterdir()}
+            if set(partitions(self.sysfs_root, disk)) <= processed:
+                break
+            time.sleep(0.5)
+        if self.load_drop_ins:
+            # partitions processed by udev after the configuration has been loaded
+            self.load_drop_ins(set(self.get_connected_uuids()))
+        return [rule] + [
+            x
+            for x in self.rules.values()
+            if x is not rule and not x.fanout and self.get_disk(x) == disk
+        ]
+
+    def execute_session(self, rules: list[Rule], fanout: bool = False):
+        """Mount all disks, run the jobs and umount them.
+
+        With fan-out, all jobs are run in parallel (or the sources are read once by the
+        mirror engine), otherwise only the rules with the parallel option.
+        """
+        targets = []
+        try:
+            for rule in rules:
+                with rule.span("set_up"):
+                    rule.set_up()
+                if not rule.errors:
+                    targets.append(rule)
+            shared = None
+            if fanout and self.can_share_mirror(targets):
+
+                def mirror(jobs: list[Rule]) -> list[bool]:
+                    with self.span("mirror", category="rule"):
+                        return self.mirror(jobs)
+
+                shared = SharedMirror(mirror, targets)
+
+            def run_job(rule: Rule):
+                if not shared:
+                    rule.run_job()
+                    return
+
+                def engine() -> bool:
+                    rule.set_phase(rule.engine)
+                    return shared.join(rule)
+
+                try:
+                    rule.run_job(engine=engine)
+                finally:
+                    shared.leave(rule)
+
+            threads = [
+                threading.Thread(target=run_job, args=(x,), name=x.name)
+                for x in targets
+                if fanout or x.parallel
+            ]
+            for thread in threads:
+                thread.start()
+            for rule in targets:
+                if not (fanout or rule.parallel):
+                    run_job(rule)
+            for thread in threads:
+                thread.join()
+        finally:
+            # in the reverse order, so settings shared by disks are correctly restored
+            for rule in reversed(rules):
+                with rule.span("tear_down"):
+                    rule.tear_down()
+
+    @staticmethod
+    def can_share_mirror(rules: list[Rule]) -> bool:
+        """Return True if the sources can be read once for all the mirror rules."""
+        return bool(rules) and all(
+            x.engine == "mirror" and x.sources == rules[0].sources for x in rules
+        )
+
+    def mirror(self, rules: list[Rule]) -> list[bool]:
+        """Copy the sources of the rules (the same ones) to all mounted disks."""
+        targets = [
+            MirrorTarget(
+                rule.name, rule._mount_dir, should_stop=lambda x=rule: x.removed
+            )
+            for rule in rules
+        ]
+        mirror = Mirror(rules[0].sources, targets)
+        mirror.run()
+        for line in mirror.report():
+            self.log_text(f"Mirror: {line}", level=INFO)
+        results = []
+        for rule, target in zip(rules, targets):
+            rule.errors += mirror.errors
+            if target.error and not rule.removed:
+                rule.errors.append(f"Unable to write to {rule.name} ({target.error}).")
+            results.append(not mirror.errors and not target.error)
+        return results
+
+    @property
+    def log_path(self) -> pathlib.Path:
+        return pathlib.Path(self.log_file or self.temp_directory / "udevbackup.log")
+
+    def log_text(
+        self,
+        text,
+        level=INFO,
+        rule: "Rule | None" = None,
+        duration: float | None = None,
+    ):
+        with self._log_lock:
+            self._log_text(text, level=level, rule=rule, duration=duration)
+
+    def _log_text(self, text, level=INFO, rule=None, duration=None):
         if self.use_log_file:
-            log_filepath = self.log_file or self.temp_directory / "udevbackup.log"
+            log_filepath = self.log_path
+            line = text
+            if self.log_format == "json":
+                line = make_record(
+                    text,
+                    level,
+                    self.run_id,
+                    rule=rule.name if rule else None,
+                    phase=rule.phase if rule else None,
+                    duration=duration,
+                )
             try:
+                rotate_log(
+                    log_filepath, self.log_max_size * 1024 * 1024, self.log_backups
+                )
                 with open(log_filepath, "a") as fd:
-                    fd.write(f"{text}\n")
+                    fd.write(f"{line}\n")
             except Exception as e:
                 text += f"\nERROR: Unable to use append text to {log_filepath} ({e})\n"
         logger.log(level, text)
@@ -439,7 +2012,9 @@ class Config(ConfigSection):
         self._log_content += "\n"
 
     def show(self):
-        self.show_rule_file(stdout=self.stdout, stderr=self.stderr)
+        self.show_rule_file(
+            stdout=self.stdout, stderr=self.stderr, run_dir=self.run_dir
+        )
         for rule in self.rules.values():
             options = " ".join(rule.mount_options)
             cmd = " ".join(shlex.quote(x) for x in rule.command)
@@ -475,20 +2050,53 @@ class Config(ConfigSection):
                 force_color=True,
                 file=self.stdout,
             )
-            cprint("command to execute: ", "green", force_color=True, file=self.stdout)
-            cprint("MOUNT_POINT=[mount point]", force_color=True, file=self.stdout)
-            if rule.user:
+            if rule.output_history > 1:
                 cprint(
-                    f"cat << EOF > [tmpfile] ; sudo -Hu {rule.user} {cmd} [tmpfile]\n{rule.script}\nEOF",
+                    f"number of kept stdout/stderr files: {rule.output_history}",
+                    "green",
                     force_color=True,
                     file=self.stdout,
                 )
-            else:
+            if rule.fanout:
                 cprint(
-                    f"cat << EOF > [tmpfile] ; {cmd} [tmpfile]\n{rule.script}\nEOF",
+                    f"fan-out group: {rule.fanout}",
+                    "green",
+                    force_color=True,
+                    file=self.stdout,
+                )
+            if rule.engine != "script":
+                sources = " ".join(shlex.quote(x) for x in rule.sources)
+                cprint(
+                    f"{rule.engine} engine, sources: {sources}",
+                    "green",
+                    force_color=True,
+                    file=self.stdout,
+                )
+            elif rule.callable:
+                user = f" (as {rule.user})" if rule.user else ""
+                cprint(
+                    f"Python function to call{user}: {rule.callable}",
+                    "green",
                     force_color=True,
                     file=self.stdout,
                 )
+            else:
+                cprint(
+                    "command to execute: ", "green", force_color=True, file=self.stdout
+                )
+                cprint("MOUNT_POINT=[mount point]", force_color=True, file=self.stdout)
+                if rule.user:
+                    cprint(
+                        f"cat << EOF > [tmpfile] ; sudo -Hu {rule.user} {cmd} [tmpfile]\n{rule.script}\nEOF",
+                        force_color=True,
+                        file=self.stdout,
+                    )
+                else:
+                    cprint(
+                        f"cat << EOF > [tmpfile] ; {cmd} [tmpfile]\n{rule.script}\nEOF",
+                        force_color=True,
+                        file=self.stdout,
+                    )
         if not self.rules:
             cprint(
                 "Please create a 'rule.ini' file in the config dir.",
@@ -498,13 +2106,15 @@ class Config(ConfigSection):
             )
 
     @classmethod
-    def show_rule_file(cls, stdout=sys.stdout, stderr=sys.stderr):
+    def show_rule_file(
+        cls, stdout=sys.stdout, stderr=sys.stderr, run_dir: str = "/run/udevbackup"
+    ):
         if not cls.udev_rule_path.is_file():
             cprint(
                 "A udev rule must be added first.", "red", file=stderr, force_color=True
             )
             cprint(
-                f"echo '{cls.udev_rule()}' | sudo tee {cls.udev_rule_path}",
+                f"echo '{cls.udev_rule(run_dir)}' | sudo tee {cls.udev_rule_path}",
                 "green",
                 file=stdout,
                 force_color=True,
@@ -514,50 +2124,109 @@ class Config(ConfigSection):
             )
 
     @classmethod
-    def udev_rule(cls) -> str:
+    def udev_rule(cls, run_dir: str = "/run/udevbackup") -> str:
+        """Return the udev rules; `run_dir` is the one of the configuration."""
         cmd = get_command() + ["at"]
         at_cmd = shlex.join(cmd)
-        return f'ACTION=="add", ENV{{DEVTYPE}}=="partition", RUN+="{at_cmd}"'
+        removed_cmd = shlex.join(get_command() + ["removed", "--run-dir", run_dir])
+        return (
+            f'ACTION=="add", ENV{{DEVTYPE}}=="partition", RUN+="{at_cmd}"\n'
+            f'ACTION=="remove", ENV{{DEVTYPE}}=="partition", RUN+="{removed_cmd}"'
+        )
+
+    def smtp_connect(self) -> smtplib.SMTP:
+        if self.smtp_use_tls:
+            smtp = smtplib.SMTP_SSL(self.smtp_server, self.smtp_smtp_port)
+            smtp.set_debuglevel(0)
+        else:
+            smtp = smtplib.SMTP(self.smtp_server, self.smtp_smtp_port)
+            smtp.set_debuglevel(0)
+            if self.smtp_use_starttls:
+                smtp.starttls()
+        if self.smtp_auth_user and self.smtp_auth_password:
+            smtp.login(self.smtp_auth_user, self.smtp_auth_password)
+        return smtp
+
+    def get_email(self, content, subject=None, attachments=None) -> MIMEMultipart:
+        msg = MIMEMultipart()
+        msg["From"] = self.smtp_from_email
+        msg["To"] = self.smtp_to_email
+        if subject:
+            msg["Subject"] = subject
+        msg.attach(MIMEText(content, "plain"))
+        if attachments:
+            for attachment in attachments:
+                if os.path.isfile(attachment):
+                    part = MIMEBase("application", "octet-stream")
+                    with open(attachment, "rb") as fd:
+                        attachment_content = fd.read()
+                    part.set_payload(attachment_content)
+                    encoders.encode_base64(part)
+                    part.add_header(
+                        "Content-Disposition",
+                        f"attachment; filename= {os.path.basename(attachment)}",
+                    )
+                    msg.attach(part)
+        return msg
+
+    def check_email_addresses(self) -> bool:
+        if not self.smtp_from_email or not self.smtp_to_email:
+            self.log_text(
+                "Unable to send e-mail: SMTP from/to e-mail address is not configured.",
+                level=ERROR,
+            )
+            return False
+        return True
 
     def send_email(self, content, subject=None, attachments=None):
         try:
-            if self.smtp_use_tls:
-                smtp = smtplib.SMTP_SSL(self.smtp_server, self.smtp_smtp_port)
-                smtp.set_debuglevel(0)
-            else:
-                smtp = smtplib.SMTP(self.smtp_server, self.smtp_smtp_port)
-                smtp.set_debuglevel(0)
-                if self.smtp_use_starttls:
-                    smtp.starttls()
-            if self.smtp_auth_user and self.smtp_auth_password:
-                smtp.login(self.smtp_auth_user, self.smtp_auth_password)
-            if not self.smtp_from_email or not self.smtp_to_email:
-                self.log_text(
-                    "Unable to send e-mail: SMTP from/to e-mail address is not configured.",
-                    level=ERROR,
-                )
+            smtp = self.smtp_connect()
+            if not self.check_email_addresses():
                 return
-            msg = MIMEMultipart()
-            msg["From"] = self.smtp_from_email
-            msg["To"] = self.smtp_to_email
-            if subject:
-                msg["Subject"] = subject
-            msg.attach(MIMEText(content, "plain"))
-            if attachments:
-                for attachment in attachments:
-                    if os.path.isfile(attachment):
-                        part = MIMEBase("application", "octet-stream")
-                        with open(attachment, "rb") as fd:
-                            attachment_content = fd.read()
-                        part.set_payload(attachment_content)
-                        encoders.encode_base64(part)
-                        part.add_header(
-                            "Content-Disposition",
-                            f"attachment; filename= {os.path.basename(attachment)}",
-                        )
-                        msg.attach(part)
+            msg = self.get_email(content, subject=subject, attachments=attachments)
             smtp.sendmail(self.smtp_from_email, [self.smtp_to_email], msg.as_string())
         except Exception as e:
             self.log_text(
                 f"Unable to send mail to {self.smtp_to_email}: {e}.", level=ERROR
             )
+
+    def spool_email(self, content, subject=None, attachments=None):
+        """Queue the e-mail in the spool directory and start a background sender."""
+        if not self.check_email_addresses():
+            return
+        try:
+            msg = self.get_email(content, subject=subject, attachments=attachments)
+            path = MailSpool(self.spool_dir).enqueue(msg.as_bytes())
+        except Exception as e:
+            self.log_text(
+                f"Unable to queue e-mail in {self.spool_dir} ({e}).", level=WARNING
+            )
+            self.send_email(content, subject=subject, attachments=attachments)
+            return
+        self.log_text(f"E-mail queued as {path}.", level=INFO)
+        cmd = get_command() + ["flush", "-C", self.config_dir]
+        try:
+            subprocess.Popen(  # nosec B603
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except Exception as e:
+            self.log_text(f"Unable to start `{shlex.join(cmd)}` ({e}).", level=ERROR)
+
+    def flush_spool(self) -> bool:
+        """Send all queued e-mails (should be run in background)."""
+        if not self.spool_dir:
+            return True
+        if not self.check_email_addresses():
+            return False
+        return MailSpool(self.spool_dir).deliver(
+            self.smtp_connect,
+            self.smtp_from_email,
+            [self.smtp_to_email],
+            max_attempts=self.spool_max_attempts,
+            retry_delay=self.spool_retry_delay,
+            log=self.log_text,
+        )
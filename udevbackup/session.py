@@ -0,0 +1,73 @@
+import json
+import os
+import pathlib
+import time
+
+import fasteners
+
+# maximum wait for a session used by another run
+SESSION_LOCK_TIMEOUT = 60.0
+
+
+class SessionCache:
+    """Disks left unlocked and mounted by the rules with keep_open.
+
+    Each session is a JSON file of the run directory (so it is forgotten at reboot,
+    like the mounts), with its mount point, its LUKS name and its expiration date.
+    A session is locked while a run uses it, so it is not closed under its feet.
+    """
+
+    def __init__(self, directory: str | pathlib.Path):
+        self.directory: pathlib.Path = pathlib.Path(directory)
+
+    def path(self, fs_uuid: str) -> pathlib.Path:
+        return self.directory / f"{fs_uuid}.json"
+
+    def lock(self, fs_uuid: str) -> fasteners.InterProcessLock:
+        return fasteners.InterProcessLock(str(self.directory / f"{fs_uuid}.lock"))
+
+    def load(self, fs_uuid: str) -> dict | None:
+        try:
+            with self.path(fs_uuid).open("r", encoding="utf-8") as fd:
+                session = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        return session if isinstance(session, dict) else None
+
+    def save(
+        self,
+        fs_uuid: str,
+        mount_dir: str,
+        luks_name: str | None,
+        device_uuid: str,
+        ttl: float,
+    ):
+        """Record the session; `device_uuid` is the UUID of the LUKS partition (if any)."""
+        now = time.time()
+        session = self.load(fs_uuid) or {"opened_at": now}
+        session.update(
+            {
+                "fs_uuid": fs_uuid,
+                "mount_dir": mount_dir,
+                "luks_name": luks_name,
+                "device_uuid": device_uuid,
+                "used_at": now,
+                "expires_at": now + ttl,
+            }
+        )
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(fs_uuid)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(session), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def remove(self, fs_uuid: str):
+        self.path(fs_uuid).unlink(missing_ok=True)
+
+    def sessions(self) -> list[dict]:
+        sessions = []
+        for path in sorted(self.directory.glob("*.json")):
+            session = self.load(path.stem)
+            if session:
+                sessions.append(session)
+        return sessions
@@ -0,0 +1,155 @@
+import gzip
+import os
+import pathlib
+import smtplib
+import time
+from collections.abc import Callable
+from logging import ERROR, INFO
+
+import fasteners
+
+# maximum delay between two delivery attempts
+MAX_RETRY_DELAY = 3600.0
+
+
+class MailSpool:
+    """Directory of e-mails waiting to be sent.
+
+    Each e-mail is stored as a gzipped file, written atomically so a sender never
+    reads a partial message. Only one sender delivers the spool at a time.
+    """
+
+    suffix = ".eml.gz"
+
+    def __init__(self, directory: str | pathlib.Path):
+        self.directory: pathlib.Path = pathlib.Path(directory)
+
+    def enqueue(self, message: bytes) -> pathlib.Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{time.time_ns()}-{os.getpid()}{self.suffix}"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with gzip.open(tmp_path, "wb") as fd:
+            fd.write(message)
+        os.replace(tmp_path, path)
+        return path
+
+    def pending(self) -> list[pathlib.Path]:
+        if not self.directory.is_dir():
+            return []
+        return sorted(self.directory.glob(f"[0-9]*{self.suffix}"))
+
+    def attempts(self, message: pathlib.Path) -> int:
+        """Return the number of times the message has been refused by the server."""
+        try:
+            return int(self.attempts_path(message).read_text())
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def attempts_path(message: pathlib.Path) -> pathlib.Path:
+        return message.with_name(f"{message.name}.attempts")
+
+    def refused(
+        self, message: pathlib.Path, error: Exception, max_attempts: int, log: Callable
+    ) -> bool:
+        """Count a refusal of the message; quarantine it after `max_attempts`.
+
+        Return True if the message has been quarantined.
+        """
+        attempts = self.attempts(message) + 1
+        log(
+            f"The server refused the e-mail {message.name}: {error} "
+            f"(attempt {attempts}/{max_attempts}).",
+            level=ERROR,
+        )
+        if attempts < max_attempts:
+            self.attempts_path(message).write_text(str(attempts))
+            return False
+        quarantine = self.directory / "quarantine"
+        quarantine.mkdir(exist_ok=True)
+        os.replace(message, quarantine / message.name)
+        self.attempts_path(message).unlink(missing_ok=True)
+        log(f"The e-mail {message.name} has been moved to {quarantine}.", level=ERROR)
+        return True
+
+    def deliver(
+        self,
+        connect: Callable,
+        from_addr: str,
+        to_addrs: list[str],
+        max_attempts: int = 1,
+        retry_delay: float = 0.0,
+        log: Callable = lambda text, level=INFO: None,
+        sleep: Callable = time.sleep,
+    ) -> bool:
+        """Send all pending e-mails, reusing a single SMTP connection.
+
+        When the server cannot be reached (or refuses a message), retry with an
+        exponential backoff; the lock is released while waiting. A message refused
+        `max_attempts` times is moved to the quarantine sub-directory, so it does not
+        block the other ones. Return True if all e-mails have been sent.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        attempt = 0
+        quarantined = 0
+        while True:
+            with fasteners.InterProcessLock(self.directory / ".lock"):
+                messages = self.pending()
+                if not messages:
+                    break
+                try:
+                    smtp = connect()
+                    sent, refused = self._deliver(smtp, messages, from_addr, to_addrs)
+                except Exception as e:
+                    log(
+                        f"Unable to send mail to {', '.join(to_addrs)}: {e} "
+                        f"(attempt {attempt + 1}/{max_attempts}).",
+                        level=ERROR,
+                    )
+                else:
+                    if sent:
+                        log(f"{sent} e-mail(s) sent.", level=INFO)
+                    for message, error in refused:
+                        quarantined += self.refused(message, error, max_attempts, log)
+                    if not self.pending():
+                        break
+            attempt += 1
+            if attempt >= max_attempts:
+                break
+            sleep(min(retry_delay * 2 ** (attempt - 1), MAX_RETRY_DELAY))
+        return not quarantined and not self.pending()
+
+    def _deliver(
+        self, smtp, messages: list[pathlib.Path], from_addr, to_addrs
+    ) -> tuple[int, list[tuple[pathlib.Path, Exception]]]:
+        """Send the messages; return the number of sent ones and the refused ones.
+
+        A lost connection is raised, since the next messages cannot be sent.
+        """
+        sent = 0
+        refused = []
+        try:
+            for message in messages:
+                with gzip.open(message, "rb") as fd:
+                    content = fd.read()
+                try:
+                    smtp.sendmail(from_addr, to_addrs, content)
+                except smtplib.SMTPServerDisconnected:
+                    raise
+                except smtplib.SMTPException as e:
+                    refused.append((message, e))
+                    continue
+                except OSError:
+                    raise
+                except Exception as e:
+                    refused.append((message, e))
+                    continue
+                message.unlink()
+                self.attempts_path(message).unlink(missing_ok=True)
+                sent += 1
+        finally:
+            try:
+                smtp.quit()
+            except Exception:  # nosec B110
+                pass
+        return sent, refused
@@ -0,0 +1,126 @@
+import json
+import os
+import pathlib
+import threading
+import time
+from collections.abc import Callable
+
+from udevbackup.removal import is_alive
+
+# only the end of the output is read to find its last line
+TAIL_SIZE = 4096
+
+
+def read_last_line(path: str | pathlib.Path, max_length: int = 200) -> str | None:
+    """Return the last non-empty line of a text file."""
+    try:
+        with open(path, "rb") as fd:
+            fd.seek(max(os.fstat(fd.fileno()).st_size - TAIL_SIZE, 0))
+            content = fd.read(TAIL_SIZE)
+    except OSError:
+        return None
+    for line in reversed(content.decode(errors="replace").splitlines()):
+        if line.strip():
+            return line.strip()[:max_length]
+    return None
+
+
+class RunStatus:
+    """State of a running rule, in a JSON file of the run directory.
+
+    The file is atomically replaced at each phase change, and every `interval` seconds
+    with the values returned by `refresh`, so it can be read at any time.
+    """
+
+    def __init__(
+        self,
+        directory: str | pathlib.Path,
+        name: str,
+        uuid: str,
+        refresh: Callable[[], dict] | None = None,
+        interval: float = 5.0,
+    ):
+        self.path: pathlib.Path = pathlib.Path(directory) / f"{uuid}.json"
+        self.refresh: Callable[[], dict] | None = refresh
+        self.interval: float = interval
+        now = time.time()
+        self.values: dict = {
+            "rule": name,
+            "uuid": uuid,
+            "pid": os.getpid(),
+            "phase": "starting",
+            "phase_started_at": now,
+            "started_at": now,
+            "updated_at": now,
+            "child_pid": None,
+            "bytes_written": 0,
+            "last_line": None,
+        }
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.update()
+        if self.interval > 0 and self.refresh:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.path.unlink(missing_ok=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.update()
+
+    def set_phase(self, phase: str, child_pid: int | None = None):
+        self.update(phase=phase, phase_started_at=time.time(), child_pid=child_pid)
+
+    def update(self, **values):
+        with self._lock:
+            self.values.update(values)
+            if self.refresh:
+                try:
+                    self.values.update(self.refresh())
+                except Exception:  # nosec B110
+                    # the status is only informative
+                    pass
+            self.values["updated_at"] = time.time()
+            tmp_path = self.path.with_name(f".{self.path.name}.{threading.get_ident()}")
+            try:
+                tmp_path.write_text(json.dumps(self.values), encoding="utf-8")
+                os.replace(tmp_path, self.path)
+            except OSError:
+                pass
+
+
+def read_statuses(directory: str | pathlib.Path) -> list[dict]:
+    """Read the state of all running rules, without any configuration.
+
+    The files left by dead processes (killed before removing them) are removed.
+    """
+    statuses = []
+    try:
+        paths = sorted(pathlib.Path(directory).glob("*.json"))
+    except OSError:
+        return statuses
+    for path in paths:
+        try:
+            status = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        pid = status.get("pid") if isinstance(status, dict) else None
+        if isinstance(pid, int) and not is_alive(pid):
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:  # nosec B110
+                # the status directory may not be writable by this user
+                pass
+            continue
+        statuses.append(status)
+    return statuses
@@ -0,0 +1,151 @@
+import ctypes
+import os
+import pathlib
+import platform
+from collections.abc import Callable
+
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set has no wrapper in the libc nor in the os module
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "riscv64": 30,
+    "s390x": 282,
+}
+
+
+def get_ioprio_set() -> Callable | None:
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    return lambda which, who, ioprio: libc.syscall(number, which, who, ioprio)
+
+
+class Throttle:
+    """Limit the resources used by the commands of a rule.
+
+    Commands are prefixed with `nice` and `ionice`, and with a shell moving itself
+    to the cgroup, so the limits are set before they are executed and inherited
+    by all their children (a `preexec_fn` is not safe in a multi-threaded process).
+    When cgroup v2 is available, children are moved to a dedicated sub-group,
+    limiting the bandwidth of the target disk, the CPU weight and the memory.
+    """
+
+    def __init__(
+        self,
+        io_class: str | None = None,
+        io_priority: int | None = None,
+        nice: int | None = None,
+        io_max_bps: int = 0,
+        cpu_weight: int = 0,
+        memory_high: str | None = None,
+    ):
+        if io_class is not None and io_class not in IOPRIO_CLASSES:
+            choices = ", ".join(IOPRIO_CLASSES)
+            raise ValueError(f"Invalid I/O class {io_class} (valid: {choices})")
+        if io_priority is not None and not 0 <= io_priority <= 7:
+            raise ValueError(f"Invalid I/O priority {io_priority} (valid: 0 to 7)")
+        if nice is not None and not -20 <= nice <= 19:
+            raise ValueError(f"Invalid nice value {nice} (valid: -20 to 19)")
+        self.nice: int | None = nice
+        self.ioprio: int | None = None
+        if io_class == "idle":
+            self.ioprio = IOPRIO_CLASSES["idle"] << IOPRIO_CLASS_SHIFT
+        elif io_class or io_priority is not None:
+            io_class = IOPRIO_CLASSES[io_class or "best-effort"]
+            io_priority = 4 if io_priority is None else io_priority
+            self.ioprio = (io_class << IOPRIO_CLASS_SHIFT) | io_priority
+        self.io_max_bps: int = io_max_bps
+        self.cpu_weight: int = cpu_weight
+        self.memory_high: str | None = memory_high
+        self.cgroup: pathlib.Path | None = None
+        self._ioprio_set = get_ioprio_set() if self.ioprio is not None else None
+
+    @property
+    def uses_cgroup(self) -> bool:
+        return bool(self.io_max_bps or self.cpu_weight or self.memory_high)
+
+    def create_cgroup(
+        self, cgroup_root: pathlib.Path, name: str, device: str | None = None
+    ):
+        """Create the cgroup v2 sub-group `udevbackup/name`.
+
+        `device` is the "major:minor" of the disk whose bandwidth is limited.
+        Raise OSError if cgroup v2 is not available.
+        """
+        if not (cgroup_root / "cgroup.controllers").is_file():
+            raise OSError(f"cgroup v2 is not mounted on {cgroup_root}")
+        controllers = []
+        limits = {}
+        if self.io_max_bps and device:
+            controllers.append("+io")
+            limits["io.max"] = f"{device} rbps={self.io_max_bps} wbps={self.io_max_bps}"
+        if self.cpu_weight:
+            controllers.append("+cpu")
+            limits["cpu.weight"] = str(self.cpu_weight)
+        if self.memory_high:
+            controllers.append("+memory")
+            limits["memory.high"] = self.memory_high
+        parent = cgroup_root / "udevbackup"
+        parent.mkdir(exist_ok=True)
+        if controllers:
+            for path in (cgroup_root, parent):
+                (path / "cgroup.subtree_control").write_text(" ".join(controllers))
+        cgroup = parent / name
+        cgroup.mkdir(exist_ok=True)
+        self.cgroup = cgroup
+        for filename, value in limits.items():
+            (cgroup / filename).write_text(value)
+
+    def remove_cgroup(self):
+        if self.cgroup is None:
+            return
+        try:
+            self.cgroup.rmdir()
+        except OSError:  # some processes are still running
+            pass
+        self.cgroup = None
+
+    def wrap(self, command: list[str]) -> list[str]:
+        """Return `command`, prefixed to apply the limits before it is executed.
+
+        The command is still executed if the limits cannot be applied.
+        """
+        prefix = []
+        if self.cgroup is not None:
+            procs = str(self.cgroup / "cgroup.procs")
+            prefix += ["sh", "-c", '{ echo $$ > "$0"; } 2>/dev/null; exec "$@"', procs]
+        if self.ioprio is not None:
+            io_class = self.ioprio >> IOPRIO_CLASS_SHIFT
+            prefix += ["ionice", "-t", "-c", str(io_class)]
+            if io_class != IOPRIO_CLASSES["idle"]:
+                prefix += ["-n", str(self.ioprio & 7)]
+        if self.nice is not None:
+            prefix += ["nice", "-n", str(self.nice)]
+        return prefix + command
+
+    def apply(self, pid: int):
+        """Apply the limits to the child process `pid` (called by the parent).
+
+        Only used for Python functions: processes forked by the child before this
+        call are not limited.
+        """
+        try:
+            if self.cgroup is not None:
+                (self.cgroup / "cgroup.procs").write_text(str(pid))
+            if self.nice is not None:
+                os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+            if self._ioprio_set is not None:
+                self._ioprio_set(IOPRIO_WHO_PROCESS, pid, self.ioprio)
+        except OSError:  # nosec B110
+            # the command is run without these limits
+            pass
@@ -0,0 +1,98 @@
+import itertools
+import json
+import os
+import pathlib
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+# number of trace files kept in the output directory
+TRACE_HISTORY = 20
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+class Tracer:
+    """Timeline of a run, as Chrome trace events (readable by Perfetto).
+
+    Each span is a complete event ("X") on the track of its thread, so nested spans
+    are displayed as nested slices. Unfinished spans are written with their current
+    duration.
+    """
+
+    def __init__(self, process_name: str = "udevbackup"):
+        self.process_name: str = process_name
+        self.pid: int = os.getpid()
+        self.events: list[dict] = []
+        self.threads: dict[int, str] = {}
+        self._open: dict[int, dict] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, category: str = "udevbackup", **args) -> Iterator[dict]:
+        """Record the duration of the block; the yielded dict is added to its args."""
+        tid = threading.get_native_id()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": now_us(),
+            "pid": self.pid,
+            "tid": tid,
+            "args": args,
+        }
+        span_id = next(self._ids)
+        with self._lock:
+            self.threads.setdefault(tid, threading.current_thread().name)
+            self._open[span_id] = event
+        try:
+            yield event["args"]
+        finally:
+            event["dur"] = now_us() - event["ts"]
+            with self._lock:
+                del self._open[span_id]
+                self.events.append(event)
+
+    def get_events(self) -> list[dict]:
+        now = now_us()
+        with self._lock:
+            events = list(self.events)
+            for event in self._open.values():
+                events.append(
+                    {
+                        **event,
+                        "dur": now - event["ts"],
+                        "args": {**event["args"], "unfinished": True},
+                    }
+                )
+            threads = dict(self.threads)
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": self.process_name},
+            }
+        ]
+        for tid, name in threads.items():
+            metadata.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        return metadata + sorted(events, key=lambda x: (x["ts"], -x["dur"]))
+
+    def write(self, path: str | pathlib.Path):
+        path = pathlib.Path(path)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        content = {"traceEvents": self.get_events(), "displayTimeUnit": "ms"}
+        tmp_path.write_text(json.dumps(content), encoding="utf-8")
+        os.replace(tmp_path, path)
@@ -0,0 +1,60 @@
+import pathlib
+import re
+
+# changing the scheduler resets the other queue attributes (like nr_requests),
+# so it is always written first
+SCHEDULER = "queue/scheduler"
+
+
+def read_sysfs_value(path: pathlib.Path) -> str:
+    """Read a sysfs attribute; for a list of choices, return the selected one."""
+    value = path.read_text().strip()
+    if selected := re.search(r"\[([^]]+)]", value):
+        return selected.group(1)
+    return value
+
+
+class BlockTuning:
+    """Temporary settings of a disk, restored at the end of the run.
+
+    Settings are sysfs attributes relative to /sys/block/<disk>, like
+    "queue/read_ahead_kb" or "bdi/max_ratio".
+    """
+
+    def __init__(self, settings: dict[str, str]):
+        self.settings: dict[str, str] = settings
+        self.previous: dict[pathlib.Path, str] = {}
+
+    def apply(self, sysfs_root: pathlib.Path, disk: str) -> list[str]:
+        """Apply the settings to the disk and return the errors."""
+        errors = []
+        root = sysfs_root / "block" / disk
+        settings = sorted(self.settings.items(), key=lambda x: x[0] != SCHEDULER)
+        for name, value in settings:
+            path = root / name
+            try:
+                previous = read_sysfs_value(path)
+                if previous == value:
+                    continue
+                path.write_text(value)
+            except OSError as e:
+                errors.append(f"Unable to set {path} to {value} ({e}).")
+                continue
+            self.previous[path] = previous
+        return errors
+
+    def restore(self) -> list[str]:
+        """Restore the previous values and return the errors.
+
+        The scheduler is restored first, then the other values in the reverse order.
+        """
+        errors = []
+        previous = reversed(self.previous.items())
+        previous = sorted(previous, key=lambda x: not x[0].match(SCHEDULER))
+        for path, value in previous:
+            try:
+                path.write_text(value)
+            except OSError as e:
+                errors.append(f"Unable to restore {path} to {value} ({e}).")
+        self.previous = {}
+        return errors
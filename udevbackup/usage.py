@@ -0,0 +1,79 @@
+import os
+import pathlib
+import subprocess
+from typing import NamedTuple
+
+
+class ResourceUsage(NamedTuple):
+    """Resources used by a command (and its waited-for children)."""
+
+    user_time: float = 0.0  # seconds
+    system_time: float = 0.0  # seconds
+    max_rss: int = 0  # kilobytes
+    block_in: int = 0  # 512-byte blocks
+    block_out: int = 0  # 512-byte blocks
+    voluntary_switches: int = 0
+    involuntary_switches: int = 0
+    read_bytes: int = 0  # from /proc/<pid>/io
+    write_bytes: int = 0  # from /proc/<pid>/io
+
+    @classmethod
+    def from_rusage(cls, rusage, io: dict[str, int]) -> "ResourceUsage":
+        return cls(
+            user_time=rusage.ru_utime,
+            system_time=rusage.ru_stime,
+            max_rss=rusage.ru_maxrss,
+            block_in=rusage.ru_inblock,
+            block_out=rusage.ru_oublock,
+            voluntary_switches=rusage.ru_nvcsw,
+            involuntary_switches=rusage.ru_nivcsw,
+            read_bytes=io.get("read_bytes", 0),
+            write_bytes=io.get("write_bytes", 0),
+        )
+
+    def __add__(self, other: "ResourceUsage") -> "ResourceUsage":
+        """Sum two usages (the maximum RSS is the largest one)."""
+        values = [x + y for (x, y) in zip(self, other)]
+        values[2] = max(self.max_rss, other.max_rss)
+        return ResourceUsage(*values)
+
+    def summary(self) -> str:
+        return (
+            f"CPU {self.user_time:.1f} s user, {self.system_time:.1f} s system, "
+            f"max RSS {self.max_rss / 1024:.1f} MB, "
+            f"blocks {self.block_in} in / {self.block_out} out, "
+            f"I/O {self.read_bytes / 1e6:.1f} MB read / "
+            f"{self.write_bytes / 1e6:.1f} MB written, "
+            f"context switches {self.voluntary_switches} voluntary / "
+            f"{self.involuntary_switches} involuntary"
+        )
+
+
+def read_process_io(procfs_root: pathlib.Path, pid: int) -> dict[str, int]:
+    """Read the I/O counters of a process (empty if not available)."""
+    try:
+        content = (procfs_root / str(pid) / "io").read_text()
+    except OSError:
+        return {}
+    values = {}
+    for line in content.splitlines():
+        key, sep, value = line.partition(":")
+        if sep and value.strip().isdigit():
+            values[key.strip()] = int(value)
+    return values
+
+
+def wait_process(p: subprocess.Popen, procfs_root: pathlib.Path) -> ResourceUsage:
+    """Wait for the end of a process, then reap it and return its resource usage.
+
+    The process is first waited for without being reaped, so its I/O counters can
+    still be read in procfs. `p.returncode` is set.
+    """
+    try:
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        pass
+    io = read_process_io(procfs_root, p.pid)
+    __, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return ResourceUsage.from_rusage(rusage, io)